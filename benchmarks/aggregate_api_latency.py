@@ -0,0 +1,109 @@
+"""
+Percentiles of the AWS API call latency per stage and operation.
+
+Reads the ApiCallLatency lines printed by forensic_common.instrumentation from Lambda
+logs, merges the histograms of every invocation, and prints p50/p95/p99 per operation
+per stage along with the retries, throttled attempts and errors.  Lines can carry any
+prefix, such as the timestamp and request id of an exported CloudWatch log or the
+columns of `aws logs filter-log-events --output text`.
+
+    aws logs filter-log-events --log-group-name /aws/lambda/<function> \\
+        --filter-pattern '"ApiCallLatency"' --output text > latency.log
+    python benchmarks/aggregate_api_latency.py latency.log [--json]
+
+Reads standard input when no file is given.
+"""
+import argparse
+import fileinput
+import json
+import sys
+
+import fixtures
+
+sys.path.insert(0, str(fixtures.COMMON_LAYER_PATH))
+from forensic_common import instrumentation  # noqa: E402
+
+MARKER = '"Type": "{}"'.format(instrumentation.LOG_TYPE)
+PERCENTILES = (50, 95, 99)
+
+
+def parse_line(line: str):
+    """
+    Returns the ApiCallLatency record in the line, or None if there is none.
+    """
+    if MARKER not in line:
+        return None
+    start = line.find('{')
+    try:
+        record, _ = json.JSONDecoder().raw_decode(line[start:])
+    except ValueError:
+        return None
+    if list(record.get('Buckets', [])) != list(instrumentation.BUCKETS_MS):
+        print("Skipping a line written with other histogram buckets", file=sys.stderr)
+        return None
+    return record
+
+
+def aggregate(lines) -> dict:
+    """
+    Merges the records into {(stage, operation): stats}.
+    """
+    merged = {}
+    for line in lines:
+        record = parse_line(line)
+        if record is None:
+            continue
+        for operation, stats in record['Operations'].items():
+            key = (record['Stage'], operation)
+            if key not in merged:
+                merged[key] = {'Latency': instrumentation.Histogram(), 'Invocations': 0, 'Retries': 0,
+                               'Throttles': 0, 'Errors': {}}
+            total = merged[key]
+            total['Latency'].merge(instrumentation.Histogram.from_dict(stats['Latency']))
+            total['Invocations'] += 1
+            total['Retries'] += stats['Retries']
+            total['Throttles'] += stats['Throttles']
+            for code, count in stats['Errors'].items():
+                total['Errors'][code] = total['Errors'].get(code, 0) + count
+    return merged
+
+
+def summarize(merged: dict) -> list:
+    rows = []
+    for (stage, operation), total in sorted(merged.items()):
+        latency = total['Latency']
+        row = {'Stage': stage, 'Operation': operation, 'Calls': latency.count,
+               'Invocations': total['Invocations']}
+        for percent in PERCENTILES:
+            row['P{}Ms'.format(percent)] = round(latency.percentile(percent), 1)
+        row.update({'MaxMs': round(latency.max_ms, 1),
+                    'MeanMs': round(latency.total_ms / latency.count, 1) if latency.count else 0.0,
+                    'Retries': total['Retries'], 'Throttles': total['Throttles'], 'Errors': total['Errors']})
+        rows.append(row)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('files', nargs='*', help="Log files.  Standard input is read when none is given.")
+    parser.add_argument('--json', action='store_true', help="Print the results as JSON")
+    args = parser.parse_args()
+
+    with fileinput.input(args.files) as lines:
+        rows = summarize(aggregate(lines))
+
+    if args.json:
+        print(json.dumps(rows, indent=2))
+        return
+
+    print("{:<22}{:<34}{:>7}{:>10}{:>10}{:>10}{:>10}{:>9}{:>10}  {}".format(
+        'stage', 'operation', 'calls', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms', 'retries', 'throttles', 'errors'))
+    for row in rows:
+        errors = ", ".join("{}={}".format(code, count) for code, count in sorted(row['Errors'].items()))
+        print("{:<22}{:<34}{:>7}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.1f}{:>9}{:>10}  {}".format(
+            row['Stage'], row['Operation'], row['Calls'], row['P50Ms'], row['P95Ms'], row['P99Ms'],
+            row['MaxMs'], row['Retries'], row['Throttles'], errors))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""
+Cold start benchmark of the Lambda handlers.
+
+Each handler is loaded in a fresh Python process, the way Lambda loads it in a new container,
+and three numbers are measured:
+
+* import: time to import the handler module (the Lambda init phase)
+* first call: the first invocation, which creates the clients and loads the service models
+* warm call: the median of the following invocations, which reuse everything cached
+
+AWS is stubbed out by replacing BaseClient._make_api_call with canned responses, so the
+numbers cover Python and botocore work only, never the network.  Every handler is run
+--repeat times and the median of each number is reported.
+
+    python benchmarks/bench_handlers.py [--repeat 5] [--warm-calls 20] [--json]
+"""
+import argparse
+import importlib
+import importlib.abc
+import importlib.util
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import fixtures
+
+# Stage name to (asset path, module name)
+HANDLERS = {
+    'Invoke': (fixtures.INVOKE_ASSETS_PATH, 'disk_invoke_guardduty'),
+    'CreateSnapshot': (fixtures.ASSETS_PATH, 'create_snapshot.lambda_function'),
+    'CheckSnapshot': (fixtures.ASSETS_PATH, 'check_snapshot.lambda_function'),
+    'CopySnapshot': (fixtures.ASSETS_PATH, 'copy_snapshot.lambda_function'),
+    'CheckCopySnapshot': (fixtures.ASSETS_PATH, 'check_copy_snapshot.lambda_function'),
+    'ShareSnapshot': (fixtures.ASSETS_PATH, 'share_snapshot.lambda_function'),
+    'FinalCopySnapshot': (fixtures.ASSETS_PATH, 'final_copy_snapshot.lambda_function'),
+    'FinalCheckSnapshot': (fixtures.ASSETS_PATH, 'final_check_snapshot.lambda_function'),
+    'CreateVolume': (fixtures.ASSETS_PATH, 'create_volume.lambda_function'),
+    'RunInstances': (fixtures.ASSETS_PATH, 'run_instances.lambda_function'),
+    'MountVolume': (fixtures.ASSETS_PATH, 'mount_volume.lambda_function'),
+}
+
+
+class _StubBotocore(importlib.abc.MetaPathFinder):
+    """
+    Patches botocore.client as soon as something imports it, so that the stub does not
+    load botocore before the handler does and hide its import cost.
+    """
+    def find_spec(self, name, path, target=None):
+        if name != 'botocore.client':
+            return None
+        sys.meta_path.remove(self)
+        spec = importlib.util.find_spec(name)
+        exec_module = spec.loader.exec_module
+
+        def patched_exec_module(module):
+            exec_module(module)
+
+            def _make_api_call(client, operation_name, api_params):
+                return fixtures.response(operation_name)
+            module.BaseClient._make_api_call = _make_api_call
+
+        spec.loader.exec_module = patched_exec_module
+        return spec
+
+
+def _run_child(stage: str, warm_calls: int) -> dict:
+    asset_path, module_name = HANDLERS[stage]
+    sys.path[:0] = [str(fixtures.COMMON_LAYER_PATH), str(asset_path)]
+    sys.meta_path.insert(0, _StubBotocore())
+    devnull = open(os.devnull, 'w')
+
+    start = time.perf_counter()
+    module = importlib.import_module(module_name)
+    imported = time.perf_counter()
+
+    stdout, sys.stdout = sys.stdout, devnull
+    try:
+        module.lambda_handler(fixtures.stage_event(stage), None)
+        first = time.perf_counter()
+        warm = []
+        for _ in range(warm_calls):
+            call_start = time.perf_counter()
+            module.lambda_handler(fixtures.stage_event(stage), None)
+            warm.append(time.perf_counter() - call_start)
+    finally:
+        sys.stdout = stdout
+
+    return {'import_ms': (imported - start) * 1000,
+            'first_call_ms': (first - imported) * 1000,
+            'warm_call_ms': statistics.median(warm) * 1000}
+
+
+def measure(stage: str, repeat: int, warm_calls: int) -> dict:
+    runs = []
+    env = dict(os.environ, **fixtures.ENVIRONMENT)
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, __file__, '--child', stage, '--warm-calls', str(warm_calls)],
+                                env=env, check=True, capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    result = {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+    result['cold_start_ms'] = result['import_ms'] + result['first_call_ms']
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--warm-calls', type=int, default=20)
+    parser.add_argument('--json', action='store_true', help="Print the results as JSON")
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(_run_child(args.child, args.warm_calls)))
+        return
+
+    results = {stage: measure(stage, args.repeat, args.warm_calls) for stage in HANDLERS}
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print("{:<20}{:>12}{:>14}{:>14}{:>14}".format('stage', 'import ms', 'first call ms', 'cold start ms',
+                                                   'warm call ms'))
+    for stage, result in results.items():
+        print("{:<20}{:>12.1f}{:>14.1f}{:>14.1f}{:>14.2f}".format(stage, result['import_ms'],
+                                                                   result['first_call_ms'],
+                                                                   result['cold_start_ms'],
+                                                                   result['warm_call_ms']))
+    total = sum(result['cold_start_ms'] for result in results.values())
+    print("{:<20}{:>40.1f}".format('total', total))
+
+
+if __name__ == '__main__':
+    main()
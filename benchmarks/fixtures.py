@@ -0,0 +1,163 @@
+"""
+Sample events, environment and canned AWS responses used by the benchmarks.
+
+The events follow the shape of the state as it moves through the step function:
+INCIDENT_EVENT is the execution input built by disk_invoke_guardduty, and VOLUME_EVENT
+is one CapturedSnapshots element as seen by the tasks inside the ProcessSnaps Map.
+"""
+import copy
+import datetime
+import pathlib
+
+ROOT = pathlib.Path(__file__).parents[1]
+ASSETS_PATH = ROOT / 'src/forensic_auto_capture/disk_functions/assets'
+INVOKE_ASSETS_PATH = ROOT / 'src/forensic_auto_capture/invoke/assets'
+COMMON_LAYER_PATH = ROOT / 'src/forensic_auto_capture/common_layer/python'
+
+ACCOUNT_ID = '111111111111'
+REGION = 'us-east-1'
+
+ENVIRONMENT = {
+    'AWS_ACCESS_KEY_ID': 'AKIAEXAMPLEEXAMPLE12',
+    'AWS_SECRET_ACCESS_KEY': 'secret',
+    'AWS_DEFAULT_REGION': REGION,
+    'ROLE_NAME': 'MemberAutomationRole',
+    'EVIDENCE_BUCKET': 'evidence-bucket',
+    'LOG_GROUP': 'ForensicAuditLogGroup',
+    'READINESS_LOG_GROUP': 'ForensicDiskReadiness',
+    'KMS_KEY': 'arn:aws:kms:us-east-1:111111111111:key/00000000-0000-0000-0000-000000000000',
+    'SECURITY_ACCOUNT': ACCOUNT_ID,
+    'SUPPORTED_AZS': '["us-east-1a","us-east-1b"]',
+    'AMI_ID': 'ami-00000000000000000',
+    'VPC_ID': 'vpc-00000000',
+    'INSTANCE_PROFILE_NAME': 'EC2ForensicProfile',
+    'SECURITY_GROUP': 'sg-00000000',
+    'INSTANCE_TYPE': 'm5a.large',
+    'ForensicSFNARN': 'arn:aws:states:us-east-1:111111111111:stateMachine:Forensics',
+}
+
+INSTANCE_ID = 'i-0123456789abcdef0'
+FINDING_ID = 'finding/0ac0000000000000000000000000000a'
+INCIDENT_ID = '0ac0000000000000000000000000000a'
+
+INSTANCE_DETAILS = {
+    'instanceId': INSTANCE_ID,
+    'instanceType': 'm5.large',
+    'availabilityZone': 'us-east-1a',
+    'imageId': 'ami-0123456789abcdef0',
+    'networkInterfaces': [{'privateIpAddress': '10.0.0.10', 'subnetId': 'subnet-00000000',
+                           'vpcId': 'vpc-00000000',
+                           'securityGroups': [{'groupId': 'sg-00000000', 'groupName': 'default'}]}],
+    'tags': [{'key': 'Name', 'value': 'web-01'}],
+}
+
+INCIDENT_EVENT = {
+    'AwsAccountId': ACCOUNT_ID,
+    'Types': 'Backdoor:EC2/C&CActivity.B!DNS',
+    'FirstObservedAt': '2021-10-01T00:00:00.000Z',
+    'LastObservedAt': '2021-10-01T00:00:00.000Z',
+    'CreatedAt': '2021-10-01T00:00:00.000Z',
+    'UpdatedAt': '2021-10-01T00:00:00.000Z',
+    'Severity': 8,
+    'Title': 'Command and Control server domain name queried by EC2 instance',
+    'Description': 'EC2 instance is querying a domain name associated with a known Command & Control server.',
+    'FindingId': FINDING_ID,
+    'Resource': {'Type': 'Instance', 'Arn': '', 'Id': INSTANCE_ID, 'Partition': 'aws', 'Region': REGION,
+                 'Details': INSTANCE_DETAILS},
+}
+
+GUARDDUTY_EVENT = {
+    'source': 'aws.guardduty',
+    'detail-type': 'GuardDuty Finding',
+    'detail': {
+        'accountId': ACCOUNT_ID,
+        'region': REGION,
+        'partition': 'aws',
+        'id': INCIDENT_ID,
+        'type': INCIDENT_EVENT['Types'],
+        'severity': 8,
+        'createdAt': INCIDENT_EVENT['CreatedAt'],
+        'updatedAt': INCIDENT_EVENT['UpdatedAt'],
+        'title': INCIDENT_EVENT['Title'],
+        'description': INCIDENT_EVENT['Description'],
+        'resource': {'resourceType': 'Instance', 'instanceDetails': INSTANCE_DETAILS},
+    },
+}
+
+VOLUME_EVENT = {
+    'SourceSnapshotID': 'snap-0000000000000000a',
+    'SourceVolumeID': 'vol-0000000000000000a',
+    'SourceDeviceName': '/dev/xvda',
+    'VolumeSize': 8,
+    'InstanceID': INSTANCE_ID,
+    'FindingID': FINDING_ID,
+    'IncidentID': INCIDENT_ID,
+    'AccountID': ACCOUNT_ID,
+    'Region': REGION,
+    'EvidenceBucket': 'evidence-bucket',
+    'CopiedSnapshotID': 'snap-0000000000000000b',
+    'EncryptionKey': ENVIRONMENT['KMS_KEY'],
+    'FinalCopiedSnapshotID': 'snap-0000000000000000c',
+    'ForensicVolumeID': 'vol-0000000000000000f',
+    'VolumeAZ': 'us-east-1a',
+    'ForensicInstances': ['i-0fedcba9876543210'],
+}
+
+_NOW = datetime.datetime(2021, 10, 1, tzinfo=datetime.timezone.utc)
+
+# Canned response per API operation name
+RESPONSES = {
+    'AssumeRole': {'Credentials': {'AccessKeyId': 'ASIAEXAMPLEEXAMPLE12', 'SecretAccessKey': 'secret',
+                                   'SessionToken': 'token',
+                                   'Expiration': datetime.datetime(2999, 1, 1, tzinfo=datetime.timezone.utc)}},
+    'DescribeInstances': {'Reservations': [{'Instances': [{
+        'InstanceId': INSTANCE_ID,
+        'RootDeviceName': '/dev/xvda',
+        'Placement': {'AvailabilityZone': 'us-east-1a'},
+        'BlockDeviceMappings': [
+            {'DeviceName': '/dev/xvda', 'Ebs': {'Status': 'attached', 'VolumeId': 'vol-0000000000000000a'}},
+            {'DeviceName': '/dev/sdb', 'Ebs': {'Status': 'attached', 'VolumeId': 'vol-0000000000000000b'}},
+        ]}]}]},
+    'CreateSnapshot': {'SnapshotId': 'snap-0000000000000000a', 'VolumeId': 'vol-0000000000000000a',
+                       'VolumeSize': 8, 'State': 'pending', 'StartTime': _NOW},
+    'DescribeSnapshots': {'Snapshots': [{'SnapshotId': 'snap-0000000000000000a', 'State': 'completed',
+                                         'Progress': '100%', 'VolumeSize': 8, 'StartTime': _NOW}]},
+    'CopySnapshot': {'SnapshotId': 'snap-0000000000000000b'},
+    'ModifySnapshotAttribute': {},
+    'CreateVolume': {'VolumeId': 'vol-0000000000000000f', 'AvailabilityZone': 'us-east-1a'},
+    'DescribeSubnets': {'Subnets': [{'SubnetId': 'subnet-00000000', 'AvailabilityZone': 'us-east-1a',
+                                     'AvailableIpAddressCount': 200}]},
+    'DescribeInstanceTypeOfferings': {'InstanceTypeOfferings': [
+        {'InstanceType': 'm5a.large', 'LocationType': 'availability-zone', 'Location': 'us-east-1a'}]},
+    'RunInstances': {'Instances': [{'InstanceId': 'i-0fedcba9876543210'}]},
+    'GetLogEvents': {'events': [{'timestamp': 0, 'message': 'incron is running'}]},
+    'AttachVolume': {},
+    'PutObject': {},
+    'CreateLogStream': {},
+    'DescribeLogStreams': {'logStreams': [{'logStreamName': INCIDENT_ID}]},
+    'PutLogEvents': {},
+    'StartExecution': {'executionArn': 'arn:aws:states:us-east-1:111111111111:execution:Forensics:1',
+                       'startDate': _NOW},
+}
+
+
+def response(operation_name: str) -> dict:
+    result = copy.deepcopy(RESPONSES.get(operation_name, {}))
+    result['ResponseMetadata'] = {'HTTPStatusCode': 200, 'RetryAttempts': 0}
+    return result
+
+
+def stage_event(stage: str) -> dict:
+    """
+    Returns the task payload the step function sends to the stage.
+    """
+    if stage == 'Invoke':
+        return copy.deepcopy(GUARDDUTY_EVENT)
+    if stage == 'CreateSnapshot':
+        return {'DiskProcess': copy.deepcopy(INCIDENT_EVENT)}
+    if stage == 'CheckSnapshot':
+        event = copy.deepcopy(INCIDENT_EVENT)
+        event.update({'EvidenceBucket': 'evidence-bucket', 'IncidentID': INCIDENT_ID,
+                      'CapturedSnapshots': [copy.deepcopy(VOLUME_EVENT)]})
+        return {'DiskProcess': event}
+    return {'DiskProcess': copy.deepcopy(VOLUME_EVENT)}
@@ -0,0 +1,125 @@
+"""
+Simulated duration of the ProcessSnaps iterator, from CopySnapshot to MountVolume, per volume size.
+
+No AWS call is made.  Each Lambda task takes --stage-seconds, each snapshot copy takes
+--copy-seconds-per-gib for every GiB of the volume, and the check stages notice that a copy
+completed the way the state machine polls it:
+
+* retry: the check is retried on RuntimeError every 30 seconds, with a backoff rate of 1.5
+* adaptive: the check waits the NextPollSeconds estimated by forensic_common.polling
+* callback: the check is resumed by the snapshot event, --event-seconds after the copy completes
+
+Two paths are compared:
+
+* cross-account: CopySnapshot, CheckCopySnapshot, ShareSnapshot, FinalCopySnapshot and
+  FinalCheckSnapshot, so two full copies
+* same-account: CopySnapshot and CheckCopySnapshot only, when the member account is the
+  security account
+
+    python benchmarks/pipeline_simulator.py [--sizes 8 100 500 2000] [--polling retry] [--json]
+"""
+import argparse
+import datetime
+import json
+import sys
+
+import fixtures
+
+sys.path.insert(0, str(fixtures.COMMON_LAYER_PATH))
+
+from forensic_common import polling  # noqa: E402
+
+RETRY_INTERVAL = 30
+RETRY_BACKOFF = 1.5
+RETRY_ATTEMPTS = 60
+
+# CreateInstanceWait
+INSTANCE_WAIT_SECONDS = 120
+
+# The tasks run by either path, in order.  "wait" is a copy being checked until it completes.
+PATHS = {
+    'cross-account': ['CopySnapshot', 'wait', 'ShareSnapshot', 'FinalCopySnapshot', 'wait'],
+    'same-account': ['CopySnapshot', 'wait'],
+}
+TAIL = ['CreateVolume', 'RunInstances', 'CreateInstanceWait', 'MountVolume']
+
+
+def retry_detection(copy_seconds: float, stage_seconds: float) -> float:
+    """
+    Seconds from the first check until a check finds the copy completed, when the check is retried.
+    """
+    elapsed, interval = stage_seconds, RETRY_INTERVAL
+    for _ in range(RETRY_ATTEMPTS):
+        if elapsed >= copy_seconds:
+            return elapsed
+        elapsed += interval + stage_seconds
+        interval *= RETRY_BACKOFF
+    raise RuntimeError("The copy outlasts the retries of the check")
+
+
+def adaptive_detection(copy_seconds: float, stage_seconds: float, size: int) -> float:
+    """
+    Seconds until a check finds the copy completed, when the check waits the delay it estimates.
+    """
+    now = datetime.datetime(2021, 10, 1, tzinfo=datetime.timezone.utc)
+    elapsed = stage_seconds
+    while elapsed < copy_seconds:
+        snapshot = {'State': 'pending', 'Progress': '{:.0f}%'.format(100 * elapsed / copy_seconds),
+                    'StartTime': now - datetime.timedelta(seconds=elapsed)}
+        elapsed += polling.next_poll_seconds([snapshot], size, now) + stage_seconds
+    return elapsed
+
+
+def detection(mode: str, copy_seconds: float, stage_seconds: float, event_seconds: float, size: int) -> float:
+    if mode == 'retry':
+        return retry_detection(copy_seconds, stage_seconds)
+    if mode == 'adaptive':
+        return adaptive_detection(copy_seconds, stage_seconds, size)
+    return max(copy_seconds, stage_seconds) + event_seconds + stage_seconds
+
+
+def simulate(path: str, size: int, mode: str, stage_seconds: float, copy_seconds_per_gib: float,
+             event_seconds: float) -> float:
+    """
+    :return: The simulated seconds of the iterator for one volume of the given size in GiB
+    """
+    total = 0.0
+    for step in PATHS[path] + TAIL:
+        if step == 'wait':
+            total += detection(mode, size * copy_seconds_per_gib, stage_seconds, event_seconds, size)
+        elif step == 'CreateInstanceWait':
+            total += INSTANCE_WAIT_SECONDS
+        else:
+            total += stage_seconds
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[8, 100, 500, 2000], help="Volume sizes in GiB")
+    parser.add_argument('--polling', choices=['retry', 'adaptive', 'callback'], default='retry')
+    parser.add_argument('--stage-seconds', type=float, default=1.0)
+    parser.add_argument('--copy-seconds-per-gib', type=float, default=polling.DEFAULT_SECONDS_PER_GIB)
+    parser.add_argument('--event-seconds', type=float, default=2.0)
+    parser.add_argument('--json', action='store_true', help="Print the results as JSON")
+    args = parser.parse_args()
+
+    results = {}
+    for size in args.sizes:
+        result = {path: simulate(path, size, args.polling, args.stage_seconds, args.copy_seconds_per_gib,
+                                 args.event_seconds) for path in PATHS}
+        result['saved'] = result['cross-account'] - result['same-account']
+        results[size] = result
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print("{:<10}{:>18}{:>18}{:>12}{:>10}".format('GiB', 'cross-account s', 'same-account s', 'saved s', 'saved %'))
+    for size, result in results.items():
+        print("{:<10}{:>18.0f}{:>18.0f}{:>12.0f}{:>10.1f}".format(size, result['cross-account'],
+                                                                  result['same-account'], result['saved'],
+                                                                  100 * result['saved'] / result['cross-account']))
+
+
+if __name__ == '__main__':
+    main()
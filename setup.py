@@ -22,8 +22,9 @@ setuptools.setup(
     include_package_data=True,
     package_data={
         # If any package contains *.txt or *.rst files, include them:
-        "": ["*.yml"]
-
+        "": ["*.yml"],
+        # The layer's python/ directory is not a package, so its modules are listed as data
+        "forensic_auto_capture.common_layer": ["python/forensic_common/*.py"],
     },
 
     install_requires=[
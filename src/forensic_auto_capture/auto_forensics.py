@@ -2,7 +2,7 @@ from aws_cdk import (
     core as cdk,
     aws_ec2 as ec2
 )
-from typing import Union, List
+from typing import Dict, Union, List
 from .forensics_resources.construct import ForensicResources
 from .disk_functions.construct import DiskFunctions
 from .step_function.construct import StepFunctionConstruct
@@ -16,9 +16,64 @@ class AutoForensicsConstruct(cdk.Construct):
                  region: str,
                  vpc: ec2.Vpc,
                  supported_azs: List[str],
-                 readiness_log_name: str = "ForensicDiskReadiness") -> None:
+                 readiness_log_name: str = "ForensicDiskReadiness",
+                 stage_dispatcher: bool = False,
+                 multi_volume_snapshots: bool = False,
+                 exclude_boot_volume: bool = False,
+                 exclude_device_names: List[str] = None,
+                 exclude_volume_tags: List[str] = None,
+                 fast_path_snapshots: bool = False,
+                 scan_snapshot_max_age: cdk.Duration = None,
+                 snapshot_callbacks: bool = False,
+                 adaptive_polling: bool = False,
+                 batched_polling: cdk.Duration = None,
+                 copy_lineage: bool = False,
+                 copy_concurrency: int = None,
+                 multi_region: bool = False,
+                 regional_copy_budgets: Dict[str, int] = None,
+                 retention_days: int = None,
+                 cleanup_dry_run: bool = False,
+                 imaging_throughput: int = None,
+                 volume_cost_ceiling: float = None,
+                 fast_restore_min_size: int = None,
+                 fast_restore_max_wait: cdk.Duration = None,
+                 execution_timeout: cdk.Duration = None) -> None:
         """
         Centralized CDK Construct that builds out the entire project
+        :param stage_dispatcher: Run every stage of the step function in one dispatcher Lambda function
+        instead of one function per stage
+        :param multi_volume_snapshots: Snapshot all the volumes of the instance with one crash-consistent
+        CreateSnapshots call instead of one CreateSnapshot call per volume
+        :param exclude_boot_volume: Do not capture the boot volume of the instance
+        :param exclude_device_names: Device names of the volumes not to capture
+        :param exclude_volume_tags: Tags of the volumes not to capture, as "Key" or "Key=Value"
+        :param fast_path_snapshots: Start the snapshots in the invoke function, as soon as the finding arrives,
+        instead of in the CreateSnapshotTask of the step function
+        :param scan_snapshot_max_age: Adopt GuardDuty Malware Protection snapshots of the instance at most this
+        old instead of taking new ones
+        :param snapshot_callbacks: Resume the snapshot check stages on the EBS snapshot completion events,
+        with task tokens, instead of polling every 30 seconds
+        :param adaptive_polling: Poll the snapshot check stages after the delay they estimate from the snapshot
+        progress instead of on a fixed backoff.  Ignored with snapshot_callbacks or batched_polling.
+        :param batched_polling: Check the snapshots waited on by every execution together, on this schedule,
+        with batched DescribeSnapshots calls per account and region, instead of each check polling its own
+        :param copy_lineage: Record the last copy of each source volume, which the next copy of the volume is copied
+        incrementally from, or reuses when it is of the same snapshot
+        :param copy_concurrency: The most snapshot copies in flight per destination account and region, shared by
+        every execution, with the largest volumes admitted first and the others queued
+        :param multi_region: Copy the snapshots of the instances of every region into the region of this stack, and
+        image them there
+        :param regional_copy_budgets: The most copies in flight from each source region, overriding copy_concurrency
+        :param retention_days: Delete the snapshots and volumes of a capture once its image is verified, keeping the
+        final copy this many days.  None keeps everything.
+        :param cleanup_dry_run: Only report what the cleanup would delete
+        :param imaging_throughput: The throughput in MiB/s provisioned on the forensic volumes
+        :param volume_cost_ceiling: The highest monthly price in USD of a forensic volume
+        :param fast_restore_min_size: Enable Fast Snapshot Restore on the final copy of the volumes of at least
+        this many GiB until their forensic volume is attached.  None never enables it.
+        :param fast_restore_max_wait: How long to wait for Fast Snapshot Restore before creating the volume without it.
+        The volumes expected to take longer to be enabled skip it.
+        :param execution_timeout: The timeout of a capture.  None uses the shortest timeout covering the copy queue.
         """
         super().__init__(scope, id=id)
         self.member_account_id = member_account_id
@@ -26,6 +81,27 @@ class AutoForensicsConstruct(cdk.Construct):
         self.region = region
         self.vpc = vpc
         self.supported_azs = supported_azs
+        self.stage_dispatcher = stage_dispatcher
+        self.multi_volume_snapshots = multi_volume_snapshots
+        self.exclude_boot_volume = exclude_boot_volume
+        self.exclude_device_names = exclude_device_names
+        self.exclude_volume_tags = exclude_volume_tags
+        self.fast_path_snapshots = fast_path_snapshots
+        self.scan_snapshot_max_age = scan_snapshot_max_age
+        self.snapshot_callbacks = snapshot_callbacks
+        self.adaptive_polling = adaptive_polling
+        self.batched_polling = batched_polling
+        self.copy_lineage = copy_lineage
+        self.copy_concurrency = copy_concurrency
+        self.multi_region = multi_region
+        self.regional_copy_budgets = regional_copy_budgets
+        self.retention_days = retention_days
+        self.cleanup_dry_run = cleanup_dry_run
+        self.imaging_throughput = imaging_throughput
+        self.volume_cost_ceiling = volume_cost_ceiling
+        self.fast_restore_min_size = fast_restore_min_size
+        self.fast_restore_max_wait = fast_restore_max_wait
+        self.execution_timeout = execution_timeout
         self._forensic_image = None
         self.forensic_resources_construct = None
         self.functions_construct = None
@@ -60,18 +136,45 @@ class AutoForensicsConstruct(cdk.Construct):
                                                  ec2_forensic_profile=self.forensic_resources_construct.collection_profile,
                                                  ec2_forensic_role=self.forensic_resources_construct.collection_role,
                                                  forensic_security_group=self.forensic_resources_construct.forensic_security_group,
-                                                 vpc=self.vpc)
+                                                 vpc=self.vpc,
+                                                 stage_dispatcher=self.stage_dispatcher,
+                                                 multi_volume_snapshots=self.multi_volume_snapshots,
+                                                 exclude_boot_volume=self.exclude_boot_volume,
+                                                 exclude_device_names=self.exclude_device_names,
+                                                 exclude_volume_tags=self.exclude_volume_tags,
+                                                 scan_snapshot_max_age=self.scan_snapshot_max_age,
+                                                 snapshot_callbacks=self.snapshot_callbacks,
+                                                 adaptive_polling=self.adaptive_polling,
+                                                 batched_polling=self.batched_polling,
+                                                 copy_lineage=self.copy_lineage,
+                                                 copy_concurrency=self.copy_concurrency,
+                                                 multi_region=self.multi_region,
+                                                 regional_copy_budgets=self.regional_copy_budgets,
+                                                 retention_days=self.retention_days,
+                                                 cleanup_dry_run=self.cleanup_dry_run,
+                                                 imaging_throughput=self.imaging_throughput,
+                                                 volume_cost_ceiling=self.volume_cost_ceiling,
+                                                 fast_restore_min_size=self.fast_restore_min_size,
+                                                 fast_restore_max_wait=self.fast_restore_max_wait)
 
     def build_step_function(self):
         self.step_function_construct = StepFunctionConstruct(scope=self, id="StepFunction",
-                                                             functions_construct=self.functions_construct)
+                                                             functions_construct=self.functions_construct,
+                                                             same_account=self.member_account_id ==
+                                                             self.security_account_id,
+                                                             execution_timeout=self.execution_timeout)
         return True
 
     def build_invoke(self):
         self.invoke_construct = InvokeConstruct(scope=self,
                                                 id="InvokeConstruct",
                                                 automation_role=self.functions_construct.automation_role,
-                                                forensic_sfn=self.step_function_construct.state_machine)
+                                                forensic_sfn=self.step_function_construct.state_machine,
+                                                common_layer=self.functions_construct.common_layer,
+                                                evidence_bucket=self.forensic_resources_construct.artifact_bucket,
+                                                evidence_key=self.forensic_resources_construct.encryption_key,
+                                                member_role=self.functions_construct.member_role if self.fast_path_snapshots else None,
+                                                snapshot_environment=self.functions_construct.snapshot_environment)
         # Getting a circular reference problem, so hiding for now.
         # self.invoke_construct.node.add_dependency(self.step_function_construct.state_machine)
         # self.step_function_construct.state_machine.grant_execution(self.invoke_construct.disk_process.role,"states:StartExecution")
@@ -0,0 +1,7 @@
+"""
+Runtime code shared by the disk forensic Lambda functions.
+
+This package is published as a Lambda layer by DiskFunctions, so it is importable as
+``forensic_common`` from every function that has the layer attached (the layer is
+extracted under /opt/python).
+"""
@@ -0,0 +1,136 @@
+"""
+Audit trail written to the forensic audit log group, one log stream per incident.
+
+Records are buffered during an invocation and written when the handler exits, one
+PutLogEvents call per log stream.  The stream is not looked up first: the write is
+attempted directly, and the stream is only created when CloudWatch Logs answers that it
+does not exist.  No sequence token is read up front either.  Every Map iteration of an
+incident writes to the same stream, so a token read before the write was often already
+stale.  If CloudWatch Logs still asks for a token, the one it expects is taken from the
+error and the write is retried.
+"""
+import json
+import threading
+import time
+
+from . import clients
+
+# PutLogEvents limits.  Each event counts for its UTF-8 size plus 26 bytes.
+MAX_BATCH_EVENTS = 10000
+MAX_BATCH_BYTES = 1048576
+EVENT_OVERHEAD_BYTES = 26
+
+# Attempts at writing one batch when concurrent writers keep moving the sequence token
+MAX_TOKEN_ATTEMPTS = 5
+
+
+class AuditLogger:
+    def __init__(self, logs_client=None) -> None:
+        """
+        Buffers audit records per (log group, log stream) until flush() is called.
+        :param logs_client: The CloudWatch Logs client.  The shared client is used if not given.
+
+        :ivar calls: Number of CloudWatch Logs API calls made, for the unit tests and the benchmarks
+        """
+        self._logs_client = logs_client
+        self._buffers = {}
+        self._known_streams = set()
+        self._lock = threading.Lock()
+        self.calls = 0
+
+    @property
+    def logs(self):
+        if self._logs_client is None:
+            self._logs_client = clients.client('logs')
+        return self._logs_client
+
+    def record(self, log_event: dict, log_group: str) -> None:
+        """
+        Buffers the event for the log stream named after its IncidentID.
+        :param log_event: The event to record.  Must contain IncidentID.
+        :param log_group: The name of the audit log group
+        """
+        entry = {
+            'timestamp': int(round(time.time() * 1000)),
+            'message': json.dumps(log_event)
+        }
+        with self._lock:
+            self._buffers.setdefault((log_group, log_event['IncidentID']), []).append(entry)
+
+    def pending(self) -> int:
+        with self._lock:
+            return sum(len(entries) for entries in self._buffers.values())
+
+    def flush(self) -> None:
+        """
+        Writes every buffered record.  Records of a stream that could not be written are
+        dropped and the error is raised once the other streams have been written.
+        """
+        with self._lock:
+            buffers, self._buffers = self._buffers, {}
+        error = None
+        for (log_group, stream), entries in buffers.items():
+            try:
+                for batch in _batches(sorted(entries, key=lambda entry: entry['timestamp'])):
+                    self._put(log_group, stream, batch)
+            except Exception as e:
+                error = e
+        if error is not None:
+            raise error
+
+    def _put(self, log_group: str, stream: str, batch: list) -> None:
+        kwargs = {}
+        for attempt in range(MAX_TOKEN_ATTEMPTS):
+            try:
+                self.calls += 1
+                self.logs.put_log_events(logGroupName=log_group, logStreamName=stream, logEvents=batch, **kwargs)
+                self._known_streams.add((log_group, stream))
+                return
+            except self.logs.exceptions.ResourceNotFoundException:
+                if (log_group, stream) in self._known_streams:
+                    raise
+                self._create_stream(log_group, stream)
+            except self.logs.exceptions.InvalidSequenceTokenException as e:
+                kwargs['sequenceToken'] = e.response.get('expectedSequenceToken')
+                if kwargs['sequenceToken'] is None:
+                    del kwargs['sequenceToken']
+            except self.logs.exceptions.DataAlreadyAcceptedException:
+                return
+        raise Exception("Could not write {} audit records to {}/{} after {} attempts".format(
+            len(batch), log_group, stream, MAX_TOKEN_ATTEMPTS))
+
+    def _create_stream(self, log_group: str, stream: str) -> None:
+        try:
+            self.calls += 1
+            self.logs.create_log_stream(logGroupName=log_group, logStreamName=stream)
+        except self.logs.exceptions.ResourceAlreadyExistsException:
+            pass
+        self._known_streams.add((log_group, stream))
+
+
+def _batches(entries: list):
+    batch, size = [], 0
+    for entry in entries:
+        entry_size = len(entry['message'].encode('utf-8')) + EVENT_OVERHEAD_BYTES
+        if batch and (len(batch) == MAX_BATCH_EVENTS or size + entry_size > MAX_BATCH_BYTES):
+            yield batch
+            batch, size = [], 0
+        batch.append(entry)
+        size += entry_size
+    if batch:
+        yield batch
+
+
+# Module level logger, flushed by forensic_handler when the handler exits
+LOGGER = AuditLogger()
+
+
+def record(log_event: dict, log_group: str) -> None:
+    """
+    Buffers the event for the audit log group.  It is written when the handler exits.
+    """
+    LOGGER.record(log_event, log_group)
+
+
+def flush() -> None:
+    LOGGER.flush()
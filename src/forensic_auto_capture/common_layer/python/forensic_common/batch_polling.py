@@ -0,0 +1,53 @@
+"""
+Batched status checks of the snapshots waited on by every execution.
+
+The SnapshotPoller function runs on a schedule.  It reads the snapshots registered in the
+SNAPSHOT_WAIT_TABLE (see callbacks), groups them by account and region, and checks each
+group with paginated ec2:DescribeSnapshots calls of up to BATCH_SIZE snapshot IDs.  The
+checks waiting on a completed or failed snapshot are then invoked again.  The number of
+describe calls depends on the number of snapshots in flight divided by BATCH_SIZE, instead
+of one call per snapshot, per execution and per retry.
+
+Snapshots missing from the response are left registered.  A copy can take a moment to be
+listed, and the task timeout of the check still covers the ones that never are.
+"""
+from . import callbacks, clients, sessions
+
+# Most snapshot IDs in the snapshot-id filter of one ec2:DescribeSnapshots call
+BATCH_SIZE = 200
+
+# Snapshots in these states no longer change, so their checks are invoked again
+FINISHED_STATES = ('completed', 'error')
+
+
+def batches(snapshot_ids, size: int = BATCH_SIZE) -> list:
+    snapshot_ids = sorted(snapshot_ids)
+    return [snapshot_ids[i:i + size] for i in range(0, len(snapshot_ids), size)]
+
+
+def ec2_client(account_id: str, region: str, role_name: str):
+    """
+    The EC2 client of the account and region of a group of snapshots.
+    :param account_id: The member account ID, or callbacks.SELF_ACCOUNT
+    :param role_name: The member automation role
+    """
+    if account_id == callbacks.SELF_ACCOUNT:
+        return clients.client('ec2', region_name=region or None)
+    return sessions.member_ec2_client(account_id, role_name, region, session_name="snapshot-poller")
+
+
+def finished(ec2, snapshot_ids, size: int = BATCH_SIZE) -> tuple:
+    """
+    Looks up which of the snapshots are done.
+    :param ec2: The EC2 client of the account and region of the snapshots
+    :param snapshot_ids: The snapshots to check
+    :return: (the IDs of the completed or failed snapshots, the number of describe calls made)
+    """
+    done, calls = set(), 0
+    paginator = ec2.get_paginator('describe_snapshots')
+    for batch in batches(snapshot_ids, size):
+        for page in paginator.paginate(Filters=[{'Name': 'snapshot-id', 'Values': batch}]):
+            calls += 1
+            done.update(snapshot['SnapshotId'] for snapshot in page['Snapshots']
+                        if snapshot['State'] in FINISHED_STATES)
+    return done, calls
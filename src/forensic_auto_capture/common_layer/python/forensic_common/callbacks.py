@@ -0,0 +1,231 @@
+"""
+Task token callbacks for the snapshot check stages.
+
+In callback mode the check tasks wait for a task token instead of failing with RuntimeError
+until the snapshot completes.  Before checking, forensic_handler registers the token in the
+SNAPSHOT_WAIT_TABLE DynamoDB table under every snapshot the stage waits on, along with the
+function and the payload of the task.  When EventBridge reports that one of those snapshots
+completed or failed, the SnapshotEvent function invokes the check again with the same
+payload, and the check sends the task success, or failure, once the snapshots are done.
+Registering before checking means a snapshot completing in between still has its event find
+the token.
+
+forensic_handler answers the task: the result of the handler is sent with SendTaskSuccess
+and its error with SendTaskFailure, while a RuntimeError, the snapshots still pending, is
+not raised and leaves the token registered for the snapshot event.
+
+The check tasks time out after a long interval and are retried, which checks again with a
+new token.  That polling fallback covers events that never reach this account, such as the
+ones of snapshots in a member account.  The SnapshotPoller function, when deployed, checks
+every registered snapshot on a schedule instead, in batches per account and region, using
+the AccountId and Region kept with each registration.
+
+The registrations of a capture that failed are removed by the FailureCleanup stage, and the
+ones of an execution that timed out expire after REGISTRATION_TTL_SECONDS, the timeout of
+the execution.
+"""
+import hashlib
+import json
+import os
+import time
+
+from botocore.exceptions import ClientError
+
+from . import clients, events, regions
+
+TASK_TOKEN = 'TaskToken'
+
+# AccountId of the snapshots in the account of the pipeline itself
+SELF_ACCOUNT = 'self'
+
+# Registrations left behind by executions that stopped are expired by DynamoDB after this many seconds,
+# without REGISTRATION_TTL_SECONDS
+REGISTRATION_TTL = 24 * 60 * 60
+
+# Errors sending the result of a task that has already moved on, after a timeout or a duplicate check
+STALE_TOKEN_ERRORS = ('TaskTimedOut', 'TaskDoesNotExist', 'InvalidToken')
+
+# Longest cause sent with a task failure
+MAX_CAUSE_CHARS = 32768
+
+
+def _table() -> str:
+    return os.environ['SNAPSHOT_WAIT_TABLE']
+
+
+def registration_ttl() -> int:
+    return int(os.environ.get('REGISTRATION_TTL_SECONDS') or REGISTRATION_TTL)
+
+
+def token_hash(token: str) -> str:
+    """
+    Task tokens can be longer than a DynamoDB key, so the registrations are keyed by their hash.
+    """
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def waited_snapshot_ids(state: dict) -> list:
+    """
+    The snapshots a check stage waits on: every source snapshot of the incident for CheckSnapshot,
+    then the copy and the final copy of the volume.
+    :param state: The DiskProcess state of the stage
+    """
+    if 'FinalCopiedSnapshotID' in state:
+        return [state['FinalCopiedSnapshotID']]
+    if 'CopiedSnapshotID' in state:
+        return [state['CopiedSnapshotID']]
+    return [snapshot['SourceSnapshotID'] for snapshot in state.get('CapturedSnapshots', [])]
+
+
+def waited_location(state: dict) -> tuple:
+    """
+    The (account ID, region) of the snapshots a check stage waits on.  The final copy is in the
+    account and region of the pipeline, the copy in the member account and the region of the copy, and the
+    snapshots of the instance in the member account and region of the instance.
+    """
+    if 'FinalCopiedSnapshotID' in state:
+        return SELF_ACCOUNT, os.environ.get('AWS_REGION', '')
+    if 'CopiedSnapshotID' in state:
+        return events.account_id(state), regions.snapshot_copy_region(state)
+    return events.account_id(state), events.region(state)
+
+
+def event_snapshot_ids(detail: dict) -> list:
+    """
+    The snapshots of an "EBS Snapshot Notification" event.  createSnapshots events list every
+    snapshot, and the others name one.  The snapshots are given as ARNs.
+    :param detail: The detail of the event
+    """
+    arns = [snapshot['snapshot_id'] for snapshot in detail.get('snapshots', [])]
+    if detail.get('snapshot_id'):
+        arns.append(detail['snapshot_id'])
+    return [arn.split('/')[-1] for arn in arns]
+
+
+def register(task_input: dict, state: dict, function_name: str) -> None:
+    """
+    Registers the task token of the invocation under every snapshot the stage waits on.
+    :param task_input: The raw task input, with TaskToken and DiskProcess, used to invoke the check again
+    :param state: The DiskProcess state of the stage
+    :param function_name: The function to invoke again when a snapshot completes
+    """
+    dynamodb = clients.client('dynamodb')
+    payload = json.dumps(task_input, default=str)
+    expires = str(int(time.time()) + registration_ttl())
+    account_id, region = waited_location(state)
+    for snapshot_id in waited_snapshot_ids(state):
+        dynamodb.put_item(TableName=_table(), Item={
+            'SnapshotId': {'S': snapshot_id},
+            'TokenHash': {'S': token_hash(task_input[TASK_TOKEN])},
+            'FunctionName': {'S': function_name},
+            'Payload': {'S': payload},
+            'AccountId': {'S': account_id},
+            'Region': {'S': region},
+            'ExpiresAt': {'N': expires},
+        })
+
+
+def unregister(token: str, snapshot_ids: list) -> None:
+    dynamodb = clients.client('dynamodb')
+    for snapshot_id in snapshot_ids:
+        dynamodb.delete_item(TableName=_table(), Key={'SnapshotId': {'S': snapshot_id},
+                                                      'TokenHash': {'S': token_hash(token)}})
+
+
+def waiters(snapshot_id: str) -> list:
+    """
+    The registrations waiting on the snapshot.
+    :return: [{"SnapshotId", "TokenHash", "FunctionName", "Payload"}]
+    """
+    response = clients.client('dynamodb').query(
+        TableName=_table(),
+        KeyConditionExpression='SnapshotId = :snapshot',
+        ExpressionAttributeValues={':snapshot': {'S': snapshot_id}},
+        ConsistentRead=True,
+    )
+    return [{key: value['S'] for key, value in item.items() if 'S' in value} for item in response['Items']]
+
+
+def remove_waiter(waiter: dict) -> None:
+    clients.client('dynamodb').delete_item(TableName=_table(), Key={'SnapshotId': {'S': waiter['SnapshotId']},
+                                                                    'TokenHash': {'S': waiter['TokenHash']}})
+
+
+def resume(snapshot_id: str) -> int:
+    """
+    Invokes the checks waiting on the snapshot again, asynchronously and with the payload of their
+    task, and removes their registrations.  A check still waiting on other snapshots registers again.
+    :return: The number of checks invoked
+    """
+    found = waiters(snapshot_id)
+    for waiter in found:
+        clients.client('lambda').invoke(
+            FunctionName=waiter['FunctionName'],
+            InvocationType='Event',
+            Payload=waiter['Payload'].encode()
+        )
+        remove_waiter(waiter)
+    return len(found)
+
+
+def forget(state: dict) -> int:
+    """
+    Removes every registration left on the snapshots of a failed capture, including the ones of checks that
+    timed out into a new token.
+    :param state: The DiskProcess state of the failed stage
+    :return: The number of registrations removed
+    """
+    if not os.environ.get('SNAPSHOT_WAIT_TABLE'):
+        return 0
+    snapshot_ids = {state.get(key) for key in ('SourceSnapshotID', 'CopiedSnapshotID', 'FinalCopiedSnapshotID')}
+    snapshot_ids.update(snapshot['SourceSnapshotID'] for snapshot in state.get('CapturedSnapshots', []))
+    snapshot_ids.discard(None)
+    removed = 0
+    for snapshot_id in sorted(snapshot_ids):
+        for waiter in waiters(snapshot_id):
+            remove_waiter(waiter)
+            removed += 1
+    return removed
+
+
+def waited_snapshots() -> dict:
+    """
+    Every registered snapshot, grouped by where it is.
+    :return: (account ID, region) to the set of snapshot IDs
+    """
+    found = {}
+    paginator = clients.client('dynamodb').get_paginator('scan')
+    for page in paginator.paginate(TableName=_table(),
+                                   ProjectionExpression='SnapshotId, AccountId, Region'):
+        for item in page['Items']:
+            location = (item.get('AccountId', {}).get('S', SELF_ACCOUNT), item.get('Region', {}).get('S', ''))
+            found.setdefault(location, set()).add(item['SnapshotId']['S'])
+    return found
+
+
+def succeed(token: str, result: dict) -> bool:
+    """
+    Sends the result of the stage as the task output, under Payload like a Lambda invocation result.
+    :return: False when the task had already moved on
+    """
+    return _send(clients.client('stepfunctions').send_task_success,
+                 taskToken=token, output=json.dumps({'Payload': result}, default=str))
+
+
+def fail(token: str, error: Exception) -> bool:
+    """
+    Fails the task with the error raised by the stage.
+    :return: False when the task had already moved on
+    """
+    return _send(clients.client('stepfunctions').send_task_failure,
+                 taskToken=token, error=type(error).__name__, cause=str(error)[:MAX_CAUSE_CHARS])
+
+
+def _send(call, **kwargs) -> bool:
+    try:
+        call(**kwargs)
+    except ClientError as e:
+        if e.response['Error']['Code'] in STALE_TOKEN_ERRORS:
+            return False
+        raise
+    return True
@@ -0,0 +1,106 @@
+"""
+Claim check for the bulky incident context carried by the step function state.
+
+The instance details of the finding (Resource.Details and Resource.Tags) can be large,
+and the state machine serializes the whole state on every transition, bounded by the
+256 KB payload limit.  offload() stores the context once in the evidence bucket and
+leaves a ContextRef in the event in its place.  The handlers that need the context call
+resolve() or expand(), which read it from S3 on first use and keep it for the following
+warm invocations.
+"""
+import collections
+import json
+import threading
+
+from . import clients, events
+
+CONTEXT_REF = 'ContextRef'
+
+# Keys of Resource moved to the evidence bucket
+OFFLOADED_KEYS = ('Details', 'Tags')
+
+# Number of resolved contexts kept per container
+MAX_CACHED_CONTEXTS = 32
+
+_cache = collections.OrderedDict()
+_lock = threading.Lock()
+
+
+def context_key(incident_id: str) -> str:
+    return incident_id + '/' + 'IncidentContext.json'
+
+
+def offload(event: dict, bucket: str) -> dict:
+    """
+    Moves the incident context of the event to the evidence bucket and replaces it with a
+    ContextRef.  Events that were already offloaded, or that have no context, are
+    returned unchanged.
+    :param event: The incident event, with Resource
+    :param bucket: The evidence bucket
+    :return: The event
+    """
+    resource = event.get('Resource', {})
+    context = {key: resource[key] for key in OFFLOADED_KEYS if key in resource}
+    if CONTEXT_REF in event or not context:
+        return event
+
+    key = context_key(events.incident_id(events.finding_id(event)))
+    clients.client('s3').put_object(
+        Body=json.dumps(context),
+        Bucket=bucket,
+        Key=key,
+    )
+    for name in context:
+        del resource[name]
+    event[CONTEXT_REF] = {'Bucket': bucket, 'Key': key}
+    _remember((bucket, key), context)
+    return event
+
+
+def resolve(event: dict) -> dict:
+    """
+    Returns the incident context of the event: {"Details": ..., "Tags": ...}.  Read from S3
+    on first use of each reference, or taken from Resource when it was never offloaded.
+    """
+    if CONTEXT_REF not in event:
+        resource = event.get('Resource', {})
+        return {key: resource[key] for key in OFFLOADED_KEYS if key in resource}
+
+    ref = (event[CONTEXT_REF]['Bucket'], event[CONTEXT_REF]['Key'])
+    with _lock:
+        if ref in _cache:
+            _cache.move_to_end(ref)
+            return _cache[ref]
+    response = clients.client('s3').get_object(Bucket=ref[0], Key=ref[1])
+    context = json.loads(response['Body'].read())
+    _remember(ref, context)
+    return context
+
+
+def expand(event: dict) -> dict:
+    """
+    Returns a copy of the event with the incident context put back into Resource, as it was
+    before offload().
+    """
+    if CONTEXT_REF not in event:
+        return event
+    expanded = dict(event)
+    del expanded[CONTEXT_REF]
+    expanded['Resource'] = dict(event.get('Resource', {}), **resolve(event))
+    return expanded
+
+
+def _remember(ref: tuple, context: dict) -> None:
+    with _lock:
+        _cache[ref] = context
+        _cache.move_to_end(ref)
+        while len(_cache) > MAX_CACHED_CONTEXTS:
+            _cache.popitem(last=False)
+
+
+def clear() -> None:
+    """
+    Drops every cached context.  Used by the unit tests.
+    """
+    with _lock:
+        _cache.clear()
@@ -0,0 +1,93 @@
+"""
+Registry of boto3 clients that are reused across warm invocations.
+
+Creating a client loads the service model and a new connection pool, and the first
+request on it pays for the TLS handshake.  Keeping the clients at module level means
+that cost is paid once per Lambda container instead of once per state transition.
+
+botocore is only imported when the first client is created, and every client, including
+the member account clients built by sessions, comes from one botocore session.  The
+session caches the endpoint data and the service models it loads, so a second session
+does not parse them again.
+"""
+import threading
+
+from . import instrumentation
+
+_clients = {}
+_lock = threading.Lock()
+_session = None
+_config = None
+
+
+def client_config():
+    """
+    Returns the botocore Config shared by every client.
+
+    Adaptive retries back off client side when EC2 or STS start throttling, which is what
+    happens during a fleet wide incident.  Keep-alive lets the pooled connections survive
+    the idle time between warm invocations.
+    """
+    global _config
+    if _config is None:
+        from botocore.config import Config
+        _config = Config(
+            retries={'mode': 'adaptive', 'max_attempts': 10},
+            max_pool_connections=25,
+            tcp_keepalive=True,
+            connect_timeout=5,
+            read_timeout=30
+        )
+    return _config
+
+
+def botocore_session():
+    """
+    Returns the botocore session every client is created from, creating it on first use.
+    The API call instrumentation is registered on it, so every client is timed.
+    """
+    global _session
+    if _session is None:
+        import botocore.session
+        _session = botocore.session.get_session()
+        instrumentation.RECORDER.register(_session.get_component('event_emitter'))
+    return _session
+
+
+def create_client(service: str, region_name: str = None, credentials: dict = None):
+    """
+    Creates a new client from the shared botocore session.  Use client() unless the
+    client has to be created with other credentials than the function's own.
+    :param service: The boto3 service name, such as "ec2" or "logs"
+    :param region_name: The region of the client.  None uses the Lambda function's own region.
+    :param credentials: The Credentials returned by sts:AssumeRole.  None uses the function's own role.
+    """
+    kwargs = {}
+    if credentials is not None:
+        kwargs = {
+            'aws_access_key_id': credentials['AccessKeyId'],
+            'aws_secret_access_key': credentials['SecretAccessKey'],
+            'aws_session_token': credentials['SessionToken'],
+        }
+    return botocore_session().create_client(service, region_name=region_name, config=client_config(), **kwargs)
+
+
+def client(service: str, region_name: str = None):
+    """
+    Returns the shared client for the service and region, creating it on first use.
+    :param service: The boto3 service name, such as "ec2" or "logs"
+    :param region_name: The region of the client.  None uses the Lambda function's own region.
+    """
+    key = (service, region_name)
+    with _lock:
+        if key not in _clients:
+            _clients[key] = create_client(service, region_name=region_name)
+        return _clients[key]
+
+
+def clear() -> None:
+    """
+    Drops every cached client.  Used by the unit tests.
+    """
+    with _lock:
+        _clients.clear()
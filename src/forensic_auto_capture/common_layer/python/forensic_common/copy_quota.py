@@ -0,0 +1,182 @@
+"""
+Budget of the snapshot copies in flight per destination account and region, shared by every execution.
+
+EBS limits the concurrent snapshot copies per destination region, and a copy started over
+the limit fails with ResourceLimitExceeded.  With COPY_CONCURRENCY_BUDGET set, the copy
+stages take a lease from the COPY_LEASE_TABLE DynamoDB table before copying.  The table
+holds one item per destination, whose Leases string set has one entry per copy in flight.
+A lease is only added while the set is smaller than the budget, in one conditional update,
+so concurrent executions never admit more copies than the budget between them.
+
+A copy that finds no room raises CopyQuotaExceeded, which the state machine retries after
+a delay, so the copy is queued instead of failing.  ResourceLimitExceeded from EC2, when
+other copies outside the pipeline use up the limit, is raised as CopyQuotaExceeded too.
+The check stages release the lease once the copy completed or failed, and the FailureCleanup
+stage releases the leases of a capture failing in between.  Every lease carries its expiry,
+COPY_LEASE_SECONDS, the timeout of the execution, so the leases of executions that timed out
+or were stopped are dropped once they could no longer be in use.
+
+The copies from another region, in multi-region mode (see regions), get a budget per source
+region, from REGIONAL_COPY_BUDGETS, a JSON object of region to budget.  Every source region
+then copies into the forensic region at once, and a large incident in one region does not
+hold up the others.
+"""
+import contextlib
+import json
+import os
+import time
+
+from botocore.exceptions import ClientError
+
+from . import callbacks, clients, regions
+
+# Leases of copies never checked are dropped after this many seconds, without COPY_LEASE_SECONDS
+LEASE_SECONDS = 6 * 60 * 60
+
+
+class CopyQuotaExceeded(RuntimeError):
+    """
+    No copy can start in the destination before another one completes.  The state machine retries the
+    copy stage on it, by name, and forensic_handler logs it as pending work like any RuntimeError.
+    """
+
+
+def budget(source_region: str = None) -> int:
+    """
+    The most copies in flight per destination, or from the source region.  0, the default, turns the
+    budget off.
+    """
+    regional = json.loads(os.environ.get('REGIONAL_COPY_BUDGETS') or '{}')
+    return int(regional.get(source_region) or os.environ.get('COPY_CONCURRENCY_BUDGET') or 0)
+
+
+def lease_seconds() -> int:
+    return int(os.environ.get('COPY_LEASE_SECONDS') or LEASE_SECONDS)
+
+
+def destination(account_id: str, region: str, source_region: str = None) -> str:
+    """
+    The destination of a copy in a member account.  The final copies go to own_destination().
+    :param source_region: The region copied from, when it is not the region of the copy
+    """
+    if source_region and source_region != region:
+        return '{}#{}#{}'.format(account_id, region, source_region)
+    return '{}#{}'.format(account_id, region)
+
+
+def own_destination(region: str) -> str:
+    return destination(callbacks.SELF_ACCOUNT, region)
+
+
+def lease_expiry(lease: str) -> int:
+    return int(lease.rsplit('@', 1)[1])
+
+
+def acquire(dynamodb, dest: str, snapshot_id: str, now: float = None, source_region: str = None):
+    """
+    Takes a lease for copying the snapshot to the destination.
+    :param dynamodb: The DynamoDB client
+    :param dest: The destination, see destination()
+    :param snapshot_id: The snapshot being copied
+    :param source_region: The region of the snapshot, which selects its regional budget
+    :return: The lease, to release once the copy is done, or None when the budget is off
+    :raises CopyQuotaExceeded: The budget of the destination is used up
+    """
+    limit = budget(source_region)
+    if limit <= 0:
+        return None
+    now = time.time() if now is None else now
+    lease = '{}@{}'.format(snapshot_id, int(now) + lease_seconds())
+    for _ in range(2):
+        try:
+            dynamodb.update_item(
+                TableName=os.environ['COPY_LEASE_TABLE'],
+                Key={'Destination': {'S': dest}},
+                UpdateExpression='ADD Leases :lease',
+                ConditionExpression='attribute_not_exists(Leases) OR size(Leases) < :budget',
+                ExpressionAttributeValues={':lease': {'SS': [lease]}, ':budget': {'N': str(limit)}},
+            )
+            return lease
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+        if not _drop_expired(dynamodb, dest, now):
+            break
+    raise CopyQuotaExceeded("{} copies already in flight to {}".format(limit, dest))
+
+
+def release(dynamodb, dest: str, lease: str) -> None:
+    """
+    Gives the lease back.  Releasing a lease twice, or no lease, does nothing.
+    """
+    if not lease:
+        return
+    dynamodb.update_item(
+        TableName=os.environ['COPY_LEASE_TABLE'],
+        Key={'Destination': {'S': dest}},
+        UpdateExpression='DELETE Leases :lease',
+        ExpressionAttributeValues={':lease': {'SS': [lease]}},
+    )
+
+
+@contextlib.contextmanager
+def admitted(dest: str, snapshot_id: str, source_region: str = None):
+    """
+    Holds a lease while the copy of the snapshot is started.  The lease is released when starting the
+    copy fails, and ResourceLimitExceeded is raised as CopyQuotaExceeded.  Otherwise it is kept, for the
+    check stage to release with finish() once the copy is done.
+    :return: The lease, or None when the budget is off
+    """
+    dynamodb = clients.client('dynamodb')
+    lease = acquire(dynamodb, dest, snapshot_id, source_region=source_region)
+    try:
+        yield lease
+    except Exception as e:
+        release(dynamodb, dest, lease)
+        if isinstance(e, ClientError) and e.response['Error']['Code'] == 'ResourceLimitExceeded':
+            raise CopyQuotaExceeded("EC2 refused the copy of {} to {}".format(snapshot_id, dest)) from e
+        raise
+
+
+def finish(dest: str, lease) -> None:
+    """
+    Releases the lease of a copy that completed or failed.
+    """
+    if lease:
+        release(clients.client('dynamodb'), dest, lease)
+
+
+def release_held(state: dict) -> list:
+    """
+    Releases the leases still held by the state of a capture that failed before its copies were checked.
+    :param state: The DiskProcess state of a ProcessSnaps Map iteration
+    :return: The leases released
+    """
+    held = []
+    if state.get('CopyLease'):
+        held.append((destination(state['AccountID'], regions.snapshot_copy_region(state), state['Region']),
+                     state.pop('CopyLease')))
+    if state.get('FinalCopyLease'):
+        held.append((own_destination(os.environ.get('AWS_REGION', '')), state.pop('FinalCopyLease')))
+    for dest, lease in held:
+        finish(dest, lease)
+    return [lease for _, lease in held]
+
+
+def _drop_expired(dynamodb, dest: str, now: float) -> bool:
+    """
+    Removes the expired leases of the destination.
+    :return: Whether any lease was removed
+    """
+    response = dynamodb.get_item(TableName=os.environ['COPY_LEASE_TABLE'], Key={'Destination': {'S': dest}},
+                                 ConsistentRead=True)
+    expired = [lease for lease in response.get('Item', {}).get('Leases', {}).get('SS', [])
+               if lease_expiry(lease) <= now]
+    if expired:
+        dynamodb.update_item(
+            TableName=os.environ['COPY_LEASE_TABLE'],
+            Key={'Destination': {'S': dest}},
+            UpdateExpression='DELETE Leases :expired',
+            ExpressionAttributeValues={':expired': {'SS': expired}},
+        )
+    return bool(expired)
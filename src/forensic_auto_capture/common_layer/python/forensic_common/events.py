@@ -0,0 +1,38 @@
+"""
+Accessors for the events passed between the states of the forensic step function.
+
+Two shapes of event travel through the state machine.  The incident event built by the
+invoke function (AwsAccountId, FindingId, Resource) is used up to the ProcessSnaps Map,
+and each Map iteration gets one CapturedSnapshots element (AccountID, FindingID,
+InstanceID, Region, ...).  The accessors below work on both.
+"""
+
+
+def disk_process(event: dict) -> dict:
+    """
+    The step function passes the state to every Lambda function under the DiskProcess key.
+    """
+    return event['DiskProcess']
+
+
+def incident_id(finding_id: str) -> str:
+    """
+    The incident ID is the GuardDuty finding ID without the "finding/" prefix.
+    """
+    return finding_id.split('finding/')[1]
+
+
+def account_id(event: dict) -> str:
+    return event['AccountID'] if 'AccountID' in event else event['AwsAccountId']
+
+
+def finding_id(event: dict) -> str:
+    return event['FindingID'] if 'FindingID' in event else event['FindingId']
+
+
+def instance_id(event: dict) -> str:
+    return event['InstanceID'] if 'InstanceID' in event else event['Resource']['Id']
+
+
+def region(event: dict) -> str:
+    return event['Region'] if 'Region' in event else event['Resource']['Region']
@@ -0,0 +1,37 @@
+"""
+Starting the step function execution of a finding, shared by the invoke functions of each finding source.
+
+The execution input is the finding as built by the invoke function, with:
+
+* in fast path mode, with FAST_PATH_SNAPSHOTS set to "true", the snapshots already started by
+  snapshots.pre_capture()
+* with EVIDENCE_BUCKET set, the instance details stored in the evidence bucket by
+  claim_check.offload(), so they do not ride through every state
+
+ForensicSFNARN  The ARN of the state machine
+"""
+import json
+import os
+import time
+
+from . import claim_check, clients, snapshots
+
+
+def start(event: dict, logger) -> str:
+    """
+    Starts the step function execution of the finding.
+    :param event: The execution input built by the invoke function
+    :param logger: The logger of the invoke function
+    :return: The ARN of the execution
+    """
+    if os.environ.get('FAST_PATH_SNAPSHOTS', '').lower() == 'true':
+        snapshots.pre_capture(event, logger)
+    if os.environ.get('EVIDENCE_BUCKET'):
+        claim_check.offload(event, os.environ['EVIDENCE_BUCKET'])
+    response = clients.client('stepfunctions').start_execution(
+        stateMachineArn=os.environ['ForensicSFNARN'],
+        name=str(time.time()) + "-" + event['Resource']['Id'],
+        input=json.dumps(event)
+    )
+    logger.info("Started execution", ExecutionArn=response['executionArn'])
+    return response['executionArn']
@@ -0,0 +1,129 @@
+"""
+Fast Snapshot Restore of the final copy before the forensic volume is created from it.
+
+A volume created from a snapshot is loaded from S3 as its blocks are first read, so the
+first full read by dc3dd runs at the speed of that loading rather than of the volume.  A
+volume created from a snapshot with Fast Snapshot Restore enabled in its availability zone
+is fully loaded from the start.  With FAST_RESTORE_MIN_GIB set, the EnableFastRestore stage
+picks the availability zone of the forensic volume and enables Fast Snapshot Restore on the
+final copy there, for volumes of at least that size.  CheckFastRestore waits until it is
+enabled, CreateVolume creates the volume in that zone, and DisableFastRestore disables it
+again once the volume is attached, since it is billed for every hour it stays enabled.
+
+EC2 takes about ENABLE_SECONDS_PER_TIB to optimize each TiB of the snapshot before Fast
+Snapshot Restore is enabled.  A volume whose expected enable time is over
+FAST_RESTORE_MAX_WAIT_SECONDS is skipped up front rather than enabled and given up on.
+
+The FastRestore of the state holds {"AvailabilityZone", "EnabledAt", "State"}, where the
+State is one of:
+
+* enabling: enabled on the snapshot, not yet ready
+* enabled: ready, the volume is created fully loaded
+* skipped: too large to be ready within FAST_RESTORE_MAX_WAIT_SECONDS, not ready within it
+  after all, or refused by EC2, such as over the limit of snapshots with Fast Snapshot
+  Restore.  The volume is created without it.
+* disabled: disabled after the attachment
+
+FAST_RESTORE_MIN_GIB           The smallest volume it is enabled for.  Unset never enables it.
+FAST_RESTORE_MAX_WAIT_SECONDS  How long CheckFastRestore waits for it to be enabled
+"""
+import datetime
+import math
+import os
+
+DEFAULT_MAX_WAIT_SECONDS = 3600
+
+# EC2 optimizes a snapshot for Fast Snapshot Restore at about an hour per TiB
+ENABLE_SECONDS_PER_TIB = 3600
+
+ENABLING = 'enabling'
+ENABLED = 'enabled'
+SKIPPED = 'skipped'
+DISABLED = 'disabled'
+
+# States reported by EC2 while Fast Snapshot Restore is on its way to enabled
+EC2_PENDING_STATES = ('enabling', 'optimizing')
+
+
+def min_volume_size() -> int:
+    return int(os.environ.get('FAST_RESTORE_MIN_GIB') or 0)
+
+
+def max_wait_seconds() -> float:
+    return float(os.environ.get('FAST_RESTORE_MAX_WAIT_SECONDS') or DEFAULT_MAX_WAIT_SECONDS)
+
+
+def expected_enable_seconds(volume_size: int) -> int:
+    """
+    How long Fast Snapshot Restore is expected to take to be enabled on the snapshot of a volume of this size,
+    in GiB.
+    """
+    return math.ceil((volume_size or 0) / 1024 * ENABLE_SECONDS_PER_TIB)
+
+
+def wanted(volume_size: int) -> bool:
+    """
+    Whether the volume is large enough for Fast Snapshot Restore, in GiB.
+    """
+    return 0 < min_volume_size() <= (volume_size or 0)
+
+
+def applies(volume_size: int) -> bool:
+    """
+    Whether Fast Snapshot Restore is enabled for a volume of this size, in GiB: large enough for it, and small
+    enough for it to be expected ready within the wait.
+    """
+    return wanted(volume_size) and expected_enable_seconds(volume_size) <= max_wait_seconds()
+
+
+def skip(volume_size: int) -> dict:
+    """
+    The FastRestore of the state of a volume too large for it to be ready within the wait.
+    """
+    return {'State': SKIPPED,
+            'Reason': "Expected to take {} seconds, over the wait of {}".format(
+                expected_enable_seconds(volume_size), int(max_wait_seconds()))}
+
+
+def enable(ec2, snapshot_id: str, availability_zone: str, now: datetime.datetime = None) -> dict:
+    """
+    Enables Fast Snapshot Restore on the snapshot in the availability zone.
+    :return: The FastRestore of the state, enabling, or skipped when EC2 refused it
+    """
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    response = ec2.enable_fast_snapshot_restores(AvailabilityZones=[availability_zone], SourceSnapshotIds=[snapshot_id])
+    fast_restore = {'AvailabilityZone': availability_zone, 'EnabledAt': now.isoformat(), 'State': ENABLING}
+    for unsuccessful in response.get('Unsuccessful', []):
+        for error in unsuccessful.get('FastSnapshotRestoreStateErrors', []):
+            return dict(fast_restore, State=SKIPPED, Reason=error['Error']['Message'])
+    return fast_restore
+
+
+def ec2_state(ec2, snapshot_id: str, availability_zone: str):
+    """
+    The state of Fast Snapshot Restore on the snapshot in the availability zone as reported by EC2, such as
+    "optimizing", or None when it is not enabled.
+    """
+    response = ec2.describe_fast_snapshot_restores(Filters=[
+        {'Name': 'snapshot-id', 'Values': [snapshot_id]},
+        {'Name': 'availability-zone', 'Values': [availability_zone]},
+    ])
+    restores = response['FastSnapshotRestores']
+    return restores[0]['State'] if restores else None
+
+
+def waited_seconds(fast_restore: dict, now: datetime.datetime = None) -> float:
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    return (now - datetime.datetime.fromisoformat(fast_restore['EnabledAt'])).total_seconds()
+
+
+def disable(ec2, snapshot_id: str, fast_restore: dict) -> dict:
+    """
+    Disables Fast Snapshot Restore on the snapshot, unless it was never enabled.
+    :return: The FastRestore of the state
+    """
+    if fast_restore['State'] not in (ENABLING, ENABLED):
+        return fast_restore
+    ec2.disable_fast_snapshot_restores(AvailabilityZones=[fast_restore['AvailabilityZone']],
+                                       SourceSnapshotIds=[snapshot_id])
+    return dict(fast_restore, State=DISABLED)
@@ -0,0 +1,90 @@
+"""
+Wrapper shared by the Lambda handlers of the step function.
+"""
+import functools
+import json
+import time
+
+from . import audit, callbacks, events, instrumentation, log, metrics
+
+
+def forensic_handler(request_name: str):
+    """
+    Decorates a lambda_handler so that it receives the DiskProcess state instead of the raw
+    task input, with its errors logged and raised back to the step function with their type
+    kept.  The duration and outcome of each invocation are emitted as stage metrics, sampled
+    while the stage is pending (see log), and buffered audit records are written once the
+    handler returns.  A task input with a TaskToken is answered by callback (see callbacks).
+    :param request_name: The name of the request used in the error message, such as "createSnapshot"
+    """
+    logger = log.get_logger(request_name)
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(event, context):
+            instrumentation.release(request_name)
+            start = time.perf_counter()
+            state = {}
+            outcome = 'Completed'
+            token = event.get(callbacks.TASK_TOKEN)
+            try:
+                state = events.disk_process(event)
+                if token:
+                    callbacks.register(event, state, context.function_name)
+                result = func(state, context)
+                audit.flush()
+                if isinstance(result, dict) and result.get('SnapshotStatus') == 'pending':
+                    # Adaptive polling returns pending snapshots instead of raising RuntimeError
+                    outcome = 'Pending'
+                if token:
+                    callbacks.unregister(token, callbacks.waited_snapshot_ids(state))
+                    if not callbacks.succeed(token, result):
+                        logger.info("Task had already moved on", Stage=request_name)
+                return result
+            except Exception as e:
+                # RuntimeError means the work is still in progress and the step function retries
+                outcome = 'Pending' if isinstance(e, RuntimeError) else 'Failed'
+                logger.log('DEBUG' if outcome == 'Pending' else 'ERROR',
+                           "Received error while processing {} request".format(request_name), Error=repr(e))
+                if audit.LOGGER.pending():
+                    # Only logged, so the error of the handler is the one that reaches the step function
+                    try:
+                        audit.flush()
+                    except Exception as audit_error:
+                        logger.error("Could not write the audit records", Error=repr(audit_error))
+                if token and outcome == 'Pending':
+                    # The snapshot event, or the task timeout, invokes the check again
+                    return {'Waiting': callbacks.waited_snapshot_ids(state)}
+                if token and state:
+                    callbacks.fail(token, e)
+                raise
+            finally:
+                # Only the counter of the outcome is sent.  Its Sum is the same as with zeros
+                # for the other two.
+                values = {'StageDuration': ((time.perf_counter() - start) * 1000, 'Milliseconds')}
+                key = _poll_key(request_name, state)
+                if outcome == 'Pending':
+                    polls = logger.count(key)
+                    emitted = logger.sampled(polls)
+                    values['StagePending'] = (1 if polls == 1 else logger.poll_every, 'Count')
+                else:
+                    polls = logger.forget(key)
+                    held = (polls - 1) % logger.poll_every if polls else 0
+                    emitted = True
+                    values['Stage' + outcome] = (1, 'Count')
+                    if held:
+                        values['StagePending'] = (held, 'Count')
+                if emitted:
+                    metrics.emit(request_name, state, values, Outcome=outcome)
+                    instrumentation.flush(request_name)
+                else:
+                    instrumentation.hold(request_name)
+        return wrapper
+    return decorator
+
+
+def _poll_key(request_name: str, state: dict) -> str:
+    """
+    The key the pending invocations of the stage are counted under: the dimensions of its metrics and the volume.
+    """
+    return json.dumps([metrics.dimensions(request_name, state), state.get('SourceVolumeID')], sort_keys=True)
@@ -0,0 +1,246 @@
+"""
+Latency of the AWS API calls made by the handlers.
+
+Handlers registered on botocore's before-call and after-call events time every API call
+made by a client from clients.botocore_session(), which is every client of the handlers.
+Per operation, the latency goes into a histogram together with the number of retries,
+throttled attempts and errors.  The histograms are printed as one JSON log line at the
+end of each invocation and then reset, and benchmarks/aggregate_api_latency.py turns
+those lines into percentiles per operation per stage.  The invocations of a check stage
+that end pending hold their histograms back, see hold(), so the polls of a snapshot add
+up to one line in every POLL_LOG_EVERY.
+"""
+import bisect
+import functools
+import json
+import threading
+import time
+
+# Upper bounds of the histogram buckets, in milliseconds.  One more bucket holds everything slower.
+BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+# Error codes AWS services return when a request is throttled
+THROTTLING_ERRORS = frozenset([
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestThrottledException',
+    'RequestThrottled',
+    'RequestLimitExceeded',
+    'TooManyRequestsException',
+    'ProvisionedThroughputExceededException',
+    'TransactionInProgressException',
+    'BandwidthLimitExceeded',
+    'SlowDown',
+    'EC2ThrottledException',
+])
+
+# Type of the log line written by flush()
+LOG_TYPE = 'ApiCallLatency'
+
+_START = 'forensic_instrumentation_start'
+_OPERATION = 'forensic_instrumentation_operation'
+_THROTTLES = 'forensic_instrumentation_throttles'
+
+
+class Histogram:
+    def __init__(self, counts: list = None, total_ms: float = 0.0, max_ms: float = 0.0) -> None:
+        """
+        Latency histogram with the fixed BUCKETS_MS buckets, so histograms from different
+        invocations can be merged by adding their counts.
+        :param counts: The number of samples in each bucket
+        :param total_ms: The sum of the samples
+        :param max_ms: The largest sample
+        """
+        self.counts = list(counts) if counts else [0] * (len(BUCKETS_MS) + 1)
+        self.total_ms = total_ms
+        self.max_ms = max_ms
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def add(self, latency_ms: float) -> None:
+        self.counts[bisect.bisect_left(BUCKETS_MS, latency_ms)] += 1
+        self.total_ms += latency_ms
+        self.max_ms = max(self.max_ms, latency_ms)
+
+    def merge(self, other: 'Histogram') -> None:
+        self.counts = [mine + theirs for mine, theirs in zip(self.counts, other.counts)]
+        self.total_ms += other.total_ms
+        self.max_ms = max(self.max_ms, other.max_ms)
+
+    def percentile(self, percent: float) -> float:
+        """
+        Estimates the percentile by interpolating inside the bucket it falls in.  The last
+        bucket is bounded by the largest sample.
+        :param percent: The percentile, between 0 and 100
+        """
+        total = self.count
+        if total == 0:
+            return 0.0
+        rank = percent / 100.0 * total
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = BUCKETS_MS[index - 1] if index > 0 else 0.0
+                upper = BUCKETS_MS[index] if index < len(BUCKETS_MS) else self.max_ms
+                upper = min(upper, self.max_ms)
+                lower = min(lower, upper)
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.max_ms
+
+    def to_dict(self) -> dict:
+        return {'Counts': self.counts, 'TotalMs': round(self.total_ms, 3), 'MaxMs': round(self.max_ms, 3)}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'Histogram':
+        return cls(data['Counts'], data['TotalMs'], data['MaxMs'])
+
+
+class Recorder:
+    def __init__(self) -> None:
+        """
+        Collects the latency, retries, throttles and errors of each API operation, keyed by
+        "<service>.<Operation>" such as "ec2.DescribeInstances".
+        """
+        self._operations = {}
+        self._lock = threading.Lock()
+
+    def register(self, events) -> None:
+        """
+        Registers the handlers on a botocore event emitter.  Registering on the emitter of a
+        botocore session covers every client created from the session afterwards.
+        :param events: The event_emitter component of a botocore session, or the meta.events of a client
+        """
+        events.register_first('before-call.*.*', self._before_call, unique_id='forensic-instrumentation-before-call')
+        events.register('needs-retry.*.*', self._needs_retry, unique_id='forensic-instrumentation-needs-retry')
+        events.register('after-call.*.*', self._after_call, unique_id='forensic-instrumentation-after-call')
+        events.register('after-call-error.*.*', self._after_call_error,
+                        unique_id='forensic-instrumentation-after-call-error')
+
+    def record(self, operation: str, latency_ms: float, retries: int = 0, throttles: int = 0,
+               error: str = None) -> None:
+        with self._lock:
+            stats = self._operations.get(operation)
+            if stats is None:
+                stats = {'Latency': Histogram(), 'Retries': 0, 'Throttles': 0, 'Errors': {}}
+                self._operations[operation] = stats
+            stats['Latency'].add(latency_ms)
+            stats['Retries'] += retries
+            stats['Throttles'] += throttles
+            if error is not None:
+                stats['Errors'][error] = stats['Errors'].get(error, 0) + 1
+
+    def operations(self) -> dict:
+        """
+        Returns the recorded operations in the form written to the log line.
+        """
+        with self._lock:
+            return {operation: {'Calls': stats['Latency'].count,
+                                'Latency': stats['Latency'].to_dict(),
+                                'Retries': stats['Retries'],
+                                'Throttles': stats['Throttles'],
+                                'Errors': dict(stats['Errors'])}
+                    for operation, stats in self._operations.items()}
+
+    def reset(self) -> None:
+        with self._lock:
+            self._operations.clear()
+
+    @staticmethod
+    def _operation(model) -> str:
+        return "{}.{}".format(model.service_model.service_name, model.name)
+
+    def _before_call(self, model, context, **kwargs):
+        context[_START] = time.perf_counter()
+        context[_OPERATION] = self._operation(model)
+
+    def _needs_retry(self, response, request_dict, **kwargs):
+        # Called after every attempt, so throttled attempts that were retried are counted too
+        if response is None:
+            return
+        if response[1].get('Error', {}).get('Code') in THROTTLING_ERRORS:
+            context = request_dict['context']
+            context[_THROTTLES] = context.get(_THROTTLES, 0) + 1
+
+    def _after_call(self, model, parsed, context, **kwargs):
+        start = context.pop(_START, None)
+        context.pop(_OPERATION, None)
+        if start is None:
+            return
+        self.record(self._operation(model),
+                    (time.perf_counter() - start) * 1000,
+                    retries=parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0),
+                    throttles=context.pop(_THROTTLES, 0),
+                    error=parsed.get('Error', {}).get('Code'))
+
+    def _after_call_error(self, context, exception, **kwargs):
+        # botocore sends no model with after-call-error, so the operation comes from _before_call
+        start = context.pop(_START, None)
+        operation = context.pop(_OPERATION, None)
+        if start is None:
+            return
+        if operation is None:
+            operation = '.'.join(kwargs.get('event_name', 'after-call-error.unknown.unknown').split('.')[1:3])
+        self.record(operation,
+                    (time.perf_counter() - start) * 1000,
+                    throttles=context.pop(_THROTTLES, 0),
+                    error=type(exception).__name__)
+
+
+# Module level recorder, registered on the shared botocore session by clients
+RECORDER = Recorder()
+
+# The stage whose operations the recorder holds back for its next flush, or None
+_held = None
+
+
+def flush(stage: str) -> None:
+    """
+    Prints the operations recorded since the last flush as one JSON log line, then resets
+    the recorder.  Nothing is printed when no API call was made.
+    :param stage: The name of the handler, used to group the lines by stage
+    """
+    global _held
+    operations = RECORDER.operations()
+    RECORDER.reset()
+    _held = None
+    if operations:
+        print(json.dumps({'Type': LOG_TYPE, 'Stage': stage, 'Buckets': BUCKETS_MS, 'Operations': operations}))
+
+
+def hold(stage: str) -> None:
+    """
+    Keeps the operations recorded by the stage for its next flush instead of printing them now.
+    """
+    global _held
+    _held = stage
+
+
+def release(stage: str) -> None:
+    """
+    Flushes the operations held back by another stage, before the stage records its own.  Only a container
+    running every stage, see StageDispatcher, runs another stage in between.
+    """
+    if _held is not None and _held != stage:
+        flush(_held)
+
+
+def instrumented(stage: str):
+    """
+    Decorates a lambda_handler so that the API calls it made are flushed when it returns
+    or raises.
+    :param stage: The name of the handler, such as "createSnapshot"
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(event, context):
+            release(stage)
+            try:
+                return func(event, context)
+            finally:
+                flush(stage)
+        return wrapper
+    return decorator
@@ -0,0 +1,105 @@
+"""
+Index of the forensic copies made of each source volume, which keeps the base of the
+incremental copies of EBS.
+
+EBS copies a snapshot incrementally, copying only the blocks changed since the previous
+copy, when the previous copy of the same volume still exists in the destination, under the
+same KMS key, along with the source snapshot it was copied from.  Otherwise the copy is
+full.  The COPY_LINEAGE_TABLE DynamoDB table records, per member account, source volume and
+copy stage, the last completed copy and its source snapshot, which the check stages record
+once the copy completes.  The Cleanup function keeps both (see retention), so the next
+capture of the volume has its base.
+
+Before copying, the copy handlers look up the base of the new copy:
+
+* a copy of the same source snapshot, from a re-triggered finding: the copy is reused and
+  no new copy is made
+* an earlier copy of the volume: EBS copies the new snapshot incrementally from it
+* none, or one under another key or no longer usable: the copy is full
+
+The copy handlers log the base of each copy and keep it in LineageBase, and the check stages
+emit CopiesWithLineageBase next to the copy time, so the average is the share of the copies
+that had a base.
+
+Without COPY_LINEAGE_TABLE, lookups find nothing and nothing is recorded.
+"""
+import datetime
+import os
+
+from . import clients
+
+COPY = 'Copy'
+FINAL_COPY = 'FinalCopy'
+
+# Copies in these states cannot be reused or copied incrementally from
+UNUSABLE_STATES = ('error', 'recoverable', 'recovering')
+
+
+def enabled() -> bool:
+    return bool(os.environ.get('COPY_LINEAGE_TABLE'))
+
+
+def lineage_key(account_id: str, volume_id: str) -> str:
+    return '{}#{}'.format(account_id, volume_id)
+
+
+def previous(stage: str, account_id: str, volume_id: str):
+    """
+    The last copy recorded for the volume at this stage, or None.
+    :param stage: COPY for the copy in the member account, FINAL_COPY for the copy in the security account
+    :param account_id: The member account of the volume
+    :param volume_id: The source volume
+    :return: {"SourceSnapshotId", "SnapshotId", "KmsKeyId", "Region", "CopiedAt"}
+    """
+    if not enabled():
+        return None
+    response = clients.client('dynamodb').get_item(
+        TableName=os.environ['COPY_LINEAGE_TABLE'],
+        Key={'Lineage': {'S': lineage_key(account_id, volume_id)}, 'Stage': {'S': stage}},
+        ConsistentRead=True,
+    )
+    if 'Item' not in response:
+        return None
+    return {key: value['S'] for key, value in response['Item'].items() if 'S' in value}
+
+
+def usable(ec2, copy: dict, region: str) -> bool:
+    """
+    Whether the recorded copy can be reused or copied incrementally from: it still exists in the region of the new
+    copy and has not failed.
+    :param ec2: The EC2 client of the destination account
+    """
+    if copy is None or copy.get('Region') != region:
+        return False
+    response = ec2.describe_snapshots(Filters=[{'Name': 'snapshot-id', 'Values': [copy['SnapshotId']]}])
+    return any(snapshot['State'] not in UNUSABLE_STATES for snapshot in response['Snapshots'])
+
+
+def base(ec2, stage: str, account_id: str, volume_id: str, region: str, kms_key: str):
+    """
+    The last copy of the volume at this stage, when a new copy can reuse it or be copied incrementally from it.
+    :param kms_key: The KMS key of the new copy.  A copy under another key is no base.
+    :return: The copy, as returned by previous(), or None
+    """
+    copy = previous(stage, account_id, volume_id)
+    if copy is None or copy['KmsKeyId'] != kms_key or not usable(ec2, copy, region):
+        return None
+    return copy
+
+
+def record(stage: str, account_id: str, volume_id: str, source_snapshot_id: str, snapshot_id: str,
+           kms_key: str, region: str) -> None:
+    """
+    Records the copy, once completed, as the last copy of the volume at this stage.
+    """
+    if not enabled():
+        return
+    clients.client('dynamodb').put_item(TableName=os.environ['COPY_LINEAGE_TABLE'], Item={
+        'Lineage': {'S': lineage_key(account_id, volume_id)},
+        'Stage': {'S': stage},
+        'SourceSnapshotId': {'S': source_snapshot_id},
+        'SnapshotId': {'S': snapshot_id},
+        'KmsKeyId': {'S': kms_key},
+        'Region': {'S': region},
+        'CopiedAt': {'S': datetime.datetime.now(datetime.timezone.utc).isoformat()},
+    })
@@ -0,0 +1,187 @@
+"""
+Structured, leveled logging for the Lambda handlers.
+
+Every log line is one JSON object with the level, the stage and the message, plus any
+fields passed by the handler.  Lines below LOG_LEVEL (INFO by default) are dropped.
+
+The check functions are retried every 30 seconds for as long as a snapshot is pending,
+so their logs are mostly the same line repeated.  Poll lines are sampled: per stage and
+key, such as a snapshot ID, the first poll is logged and then one poll in every
+POLL_LOG_EVERY (10 by default).  The poll counts of the MAX_POLL_KEYS keys polled last
+are kept, so a warm container does not hold a count for every resource it ever polled.
+
+forensic_handler samples the stage metrics and API latency of the pending invocations the
+same way, per stage and volume.  A RuntimeError, which only means the work is still in
+progress, is logged at DEBUG.  The first pending invocation and then one in every
+POLL_LOG_EVERY emit their metrics, with StagePending counting the invocations held back
+since, and those held back after the last one are added to the line of the completed or
+failed invocation.
+Events and API responses are logged as a summary of their identifiers, capped to
+MAX_FIELD_CHARS, unless LOG_LEVEL is DEBUG.
+"""
+import json
+import os
+import sys
+import threading
+
+LEVELS = {'DEBUG': 10, 'INFO': 20, 'WARNING': 30, 'ERROR': 40}
+
+DEFAULT_LEVEL = 'INFO'
+DEFAULT_POLL_LOG_EVERY = 10
+
+# Most poll counts kept per stage
+MAX_POLL_KEYS = 1000
+
+# Longest summary written for one field, in characters
+MAX_FIELD_CHARS = 512
+
+# Keys kept when an event is summarized
+SUMMARY_KEYS = (
+    'IncidentID', 'FindingID', 'FindingId', 'AccountID', 'AwsAccountId', 'Region', 'InstanceID',
+    'SourceVolumeID', 'SourceDeviceName', 'VolumeSize', 'SourceSnapshotID', 'CopiedSnapshotID',
+    'FinalCopiedSnapshotID', 'ForensicVolumeID', 'VolumeAZ', 'ForensicInstances', 'Stage',
+    'SnapshotId', 'VolumeId', 'InstanceId', 'State', 'Progress',
+)
+
+_loggers = {}
+_lock = threading.Lock()
+
+
+def _truncate(text: str, max_chars: int) -> str:
+    if len(text) <= max_chars:
+        return text
+    return "{}...({} more chars)".format(text[:max_chars], len(text) - max_chars)
+
+
+def summarize(value, max_chars: int = MAX_FIELD_CHARS):
+    """
+    Returns a short form of an event or API response.  Dictionaries keep their identifiers
+    only, with lists of snapshots replaced by their size, and anything else is dumped to
+    JSON and cut at max_chars.
+    :param value: The event, response or value to summarize
+    :param max_chars: The longest summary returned
+    """
+    if isinstance(value, dict):
+        summary = {key: value[key] for key in SUMMARY_KEYS if key in value}
+        if isinstance(value.get('Resource'), dict) and 'Id' in value['Resource']:
+            summary['ResourceId'] = value['Resource']['Id']
+        for key in ('CapturedSnapshots', 'Snapshots', 'Reservations', 'Instances', 'Subnets'):
+            if isinstance(value.get(key), list):
+                summary[key + 'Count'] = len(value[key])
+        if summary:
+            text = json.dumps(summary, default=str)
+            return summary if len(text) <= max_chars else _truncate(text, max_chars)
+    if isinstance(value, (int, float, bool)) or value is None:
+        return value
+    return _truncate(value if isinstance(value, str) else json.dumps(value, default=str), max_chars)
+
+
+class Logger:
+    def __init__(self, stage: str, stream=None) -> None:
+        """
+        Logger of one stage.  The level and poll sampling are read from the environment on
+        first use, and read again after reset().
+        :param stage: The name of the stage written on every line, such as "checkSnapshot"
+        :param stream: Where the lines are written.  Defaults to standard output.
+        """
+        self.stage = stage
+        self._stream = stream
+        self._level = None
+        self._poll_every = None
+        self._polls = {}
+
+    @property
+    def level(self) -> int:
+        if self._level is None:
+            self._level = LEVELS.get(os.environ.get('LOG_LEVEL', DEFAULT_LEVEL).upper(), LEVELS[DEFAULT_LEVEL])
+        return self._level
+
+    @property
+    def poll_every(self) -> int:
+        if self._poll_every is None:
+            self._poll_every = max(1, int(os.environ.get('POLL_LOG_EVERY', DEFAULT_POLL_LOG_EVERY)))
+        return self._poll_every
+
+    def enabled(self, level: str) -> bool:
+        return LEVELS[level] >= self.level
+
+    def log(self, level: str, message: str, **fields) -> None:
+        if not self.enabled(level):
+            return
+        line = {'Level': level, 'Stage': self.stage, 'Message': message}
+        if self.level > LEVELS['DEBUG']:
+            fields = {key: summarize(value) for key, value in fields.items()}
+        line.update(fields)
+        print(json.dumps(line, default=str), file=self._stream or sys.stdout)
+
+    def debug(self, message: str, **fields) -> None:
+        self.log('DEBUG', message, **fields)
+
+    def info(self, message: str, **fields) -> None:
+        self.log('INFO', message, **fields)
+
+    def warning(self, message: str, **fields) -> None:
+        self.log('WARNING', message, **fields)
+
+    def error(self, message: str, **fields) -> None:
+        self.log('ERROR', message, **fields)
+
+    def poll(self, key: str, message: str, **fields) -> None:
+        """
+        Logs a line that repeats on every poll of the same resource.  At INFO only the first
+        poll of the key and then one in every poll_every are written, with the poll number.
+        At DEBUG every poll is written.
+        :param key: What is being polled, such as the snapshot ID
+        """
+        count = self.count(key)
+        if self.enabled('DEBUG') or self.sampled(count):
+            self.info(message, Poll=count, **fields)
+
+    def count(self, key: str) -> int:
+        """
+        Counts one more poll of the key.  Past MAX_POLL_KEYS, the key polled least recently is forgotten.
+        :return: The number of polls of the key
+        """
+        count = self._polls.pop(key, 0) + 1
+        self._polls[key] = count
+        if len(self._polls) > MAX_POLL_KEYS:
+            del self._polls[next(iter(self._polls))]
+        return count
+
+    def sampled(self, count: int) -> bool:
+        """
+        Whether the poll with this number is one of the polls written at INFO.
+        """
+        return (count - 1) % self.poll_every == 0
+
+    def forget(self, key: str) -> int:
+        """
+        Forgets the key once it is no longer polled.
+        :return: The number of polls of the key
+        """
+        return self._polls.pop(key, 0)
+
+    def reset(self) -> None:
+        self._level = None
+        self._poll_every = None
+        self._polls.clear()
+
+
+def get_logger(stage: str) -> Logger:
+    """
+    Returns the logger of the stage, creating it on first use.
+    """
+    with _lock:
+        if stage not in _loggers:
+            _loggers[stage] = Logger(stage)
+        return _loggers[stage]
+
+
+def reset() -> None:
+    """
+    Makes every logger read the environment again and forget its poll counts.  Used by the
+    unit tests.
+    """
+    with _lock:
+        for logger in _loggers.values():
+            logger.reset()
@@ -0,0 +1,66 @@
+"""
+Reuse of the snapshots taken by GuardDuty Malware Protection.
+
+When GuardDuty scans an instance for malware, it snapshots the volumes of the instance in
+the member account and tags the snapshots with GuardDutyScanId.  If such a snapshot of a
+volume is recent enough it is adopted instead of taking a new one.  GuardDuty deletes the
+scan snapshots once the scan is done unless snapshot retention is turned on in the
+Malware Protection settings, so the reuse only finds anything with retention on.
+
+SCAN_SNAPSHOT_MAX_AGE  Oldest scan snapshot adopted, in seconds.  0, the default, turns the reuse off.
+"""
+import datetime
+import os
+
+from . import tagging
+
+SCAN_ID_TAG = 'GuardDutyScanId'
+
+# Scan snapshots in these states are not adopted
+UNUSABLE_STATES = ('error', 'recoverable', 'recovering')
+
+
+def max_age_from_environment() -> float:
+    return float(os.environ.get('SCAN_SNAPSHOT_MAX_AGE') or 0)
+
+
+def scan_id(finding: dict):
+    """
+    The ID of the malware scan reported by a GuardDuty Malware Protection finding, or None.
+    :param finding: The detail of the GuardDuty finding event
+    """
+    return finding.get('service', {}).get('ebsVolumeScanDetails', {}).get('scanId')
+
+
+def find(ec2, volume_ids: list, max_age: float, preferred_scan_id: str = None, now: datetime.datetime = None) -> dict:
+    """
+    Looks up the scan snapshots of the volumes started at most max_age seconds ago.  For each volume
+    the snapshot of the preferred scan is picked when there is one, otherwise the newest.
+    :param ec2: The EC2 client of the member account
+    :param volume_ids: The volumes to find scan snapshots of
+    :param max_age: Oldest snapshot adopted, in seconds
+    :param preferred_scan_id: The scan of the finding being captured, when it is a malware finding
+    :return: Volume ID to the snapshot, as returned by ec2:DescribeSnapshots
+    """
+    if not volume_ids or max_age <= 0:
+        return {}
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    oldest = now - datetime.timedelta(seconds=max_age)
+
+    found = {}
+    paginator = ec2.get_paginator('describe_snapshots')
+    for page in paginator.paginate(OwnerIds=['self'],
+                                   Filters=[{'Name': 'volume-id', 'Values': volume_ids},
+                                            {'Name': 'tag-key', 'Values': [SCAN_ID_TAG]}]):
+        for snapshot in page['Snapshots']:
+            if snapshot['State'] in UNUSABLE_STATES or snapshot['StartTime'] < oldest:
+                continue
+            current = found.get(snapshot['VolumeId'])
+            if current is None or _rank(snapshot, preferred_scan_id) > _rank(current, preferred_scan_id):
+                found[snapshot['VolumeId']] = snapshot
+    return found
+
+
+def _rank(snapshot: dict, preferred_scan_id: str) -> tuple:
+    scan_id = tagging.tag_value(snapshot, SCAN_ID_TAG)
+    return (preferred_scan_id is not None and scan_id == preferred_scan_id, snapshot['StartTime'])
@@ -0,0 +1,128 @@
+"""
+Pipeline metrics in CloudWatch Embedded Metric Format (EMF).
+
+Lambda sends every line a function prints to CloudWatch Logs, and CloudWatch extracts
+metrics from the lines that are EMF documents without any PutMetricData call.  Every
+metric is published under the Stage dimension alone and together with the volume size
+bucket, the account and region, and the incident, so captures can be compared per
+stage, per volume size and per member account.
+"""
+import datetime
+import json
+import os
+import time
+
+from . import events
+
+NAMESPACE = 'ForensicAutoCapture'
+
+# Upper bounds, in GiB, of the volume size buckets
+VOLUME_SIZE_BUCKETS_GIB = (8, 32, 128, 512, 2048, 16384)
+
+DIMENSION_SETS = (
+    ('Stage',),
+    ('Stage', 'VolumeSizeBucket'),
+    ('Stage', 'AccountId', 'Region'),
+    ('Stage', 'IncidentId'),
+)
+
+
+def volume_size_bucket(size_gib: int) -> str:
+    """
+    Returns the bucket of the volume size, such as "<=32GiB".
+    """
+    for bound in VOLUME_SIZE_BUCKETS_GIB:
+        if size_gib <= bound:
+            return "<={}GiB".format(bound)
+    return ">{}GiB".format(VOLUME_SIZE_BUCKETS_GIB[-1])
+
+
+def dimensions(stage: str, event: dict, volume_size: int = None) -> dict:
+    """
+    Reads the dimensions from either shape of event.  Dimensions missing from the event
+    are left out.
+    :param stage: The name of the stage, such as "createSnapshot"
+    :param event: The DiskProcess state of the stage
+    :param volume_size: The volume size in GiB.  Defaults to the VolumeSize of the event.
+    """
+    found = {'Stage': stage}
+    readers = {
+        'AccountId': events.account_id,
+        'Region': events.region,
+        'IncidentId': lambda e: e['IncidentID'] if 'IncidentID' in e else events.incident_id(events.finding_id(e)),
+    }
+    for name, reader in readers.items():
+        try:
+            found[name] = reader(event)
+        except (KeyError, IndexError, TypeError):
+            pass
+    if volume_size is None:
+        volume_size = event.get('VolumeSize')
+    if volume_size is not None:
+        found['VolumeSizeBucket'] = volume_size_bucket(volume_size)
+    return found
+
+
+def document(metrics: dict, dims: dict, properties: dict = None, timestamp: float = None) -> dict:
+    """
+    Builds the EMF document.
+    :param metrics: Metric name to (value, unit), such as {"CopyTime": (42.0, "Seconds")}
+    :param dims: Dimension name to value
+    :param properties: Extra fields logged with the metrics but not published as dimensions
+    :param timestamp: Epoch seconds of the measurement.  Defaults to now.
+    """
+    timestamp = time.time() if timestamp is None else timestamp
+    doc = {
+        '_aws': {
+            'Timestamp': int(timestamp * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': os.environ.get('METRICS_NAMESPACE', NAMESPACE),
+                'Dimensions': [list(dimension_set) for dimension_set in DIMENSION_SETS
+                               if all(name in dims for name in dimension_set)],
+                'Metrics': [{'Name': name, 'Unit': unit} for name, (value, unit) in metrics.items()],
+            }],
+        },
+    }
+    doc.update(properties or {})
+    doc.update(dims)
+    doc.update({name: value for name, (value, unit) in metrics.items()})
+    return doc
+
+
+def emit(stage: str, event: dict, metrics: dict, volume_size: int = None, **properties) -> None:
+    """
+    Prints the metrics as one EMF log line with the dimensions of the event.
+    :param stage: The name of the stage, such as "checkCopySnapshot"
+    :param event: The DiskProcess state of the stage
+    :param metrics: Metric name to (value, unit)
+    :param volume_size: The volume size in GiB, when it is not the VolumeSize of the event
+    """
+    print(json.dumps(document(metrics, dimensions(stage, event, volume_size), properties), default=str,
+                     separators=(',', ':')))
+
+
+def snapshot_time(snapshot: dict) -> float:
+    """
+    Seconds from the start of the snapshot, or the copy, to its completion.  Older EC2
+    responses have no CompletionTime, and then the time at which the check found the
+    snapshot completed is used, which overestimates by up to one polling interval.
+    :param snapshot: A completed snapshot as returned by ec2:DescribeSnapshots
+    """
+    completed = snapshot.get('CompletionTime') or datetime.datetime.now(datetime.timezone.utc)
+    return (completed - snapshot['StartTime']).total_seconds()
+
+
+def emit_snapshot_times(stage: str, event: dict, snapshots: list, metric: str, extra: dict = None) -> None:
+    """
+    Emits the time taken by each completed snapshot, in total and per GiB.
+    :param stage: The name of the stage
+    :param event: The DiskProcess state of the stage
+    :param snapshots: Completed snapshots as returned by ec2:DescribeSnapshots
+    :param metric: The metric name, such as "SnapshotCreationTime".  The per GiB metric gets a "PerGiB" suffix.
+    :param extra: More metrics of each snapshot, name to (value, unit)
+    """
+    for snapshot in snapshots:
+        seconds = snapshot_time(snapshot)
+        size = snapshot.get('VolumeSize') or event.get('VolumeSize') or 1
+        times = {metric: (seconds, 'Seconds'), metric + 'PerGiB': (seconds / size, 'Seconds')}
+        emit(stage, event, {**times, **(extra or {})}, volume_size=size, SnapshotId=snapshot['SnapshotId'])
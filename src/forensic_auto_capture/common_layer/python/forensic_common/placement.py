@@ -0,0 +1,184 @@
+"""
+Placement of the forensic volume, and of the forensic instance it is attached to, across the
+availability zones and subnets of the forensic VPC.
+
+The availability zone of the volume, which the instance has to share, is picked among
+SUPPORTED_AZS:
+
+* where INSTANCE_TYPE is offered
+* with a subnet that has free IP addresses
+* with the fewest forensic instances running, the captures in flight, at random among equals,
+  so the captures spread across the zones
+
+The instance then goes in the subnet of that zone with the most free IP addresses.
+
+The subnets come from SUBNET_TOPOLOGY, the JSON list of {"SubnetId", "AvailabilityZone"} of
+the VPC written at synth time, or else from the subnets of VPC_ID.  Their free IP addresses
+and the zones offering the instance type are cached by each container for
+TOPOLOGY_TTL_SECONDS.
+
+When RunInstances gets InsufficientInstanceCapacity, the container avoids the zone for
+CAPACITY_BACKOFF_SECONDS, and the volume is created again in the next zone picked, up to
+MAX_RELOCATIONS times.
+"""
+import json
+import os
+import random
+import time
+
+from . import tagging, volume_profile
+
+TOPOLOGY_TTL_SECONDS = 300
+CAPACITY_BACKOFF_SECONDS = 600
+MAX_RELOCATIONS = 2
+
+# Forensic instances in these states count as captures in flight
+IN_FLIGHT_STATES = ['pending', 'running']
+
+# Cache key to (expiry, value), and zone to the time it is avoided until
+_CACHE = {}
+_CONSTRAINED = {}
+
+
+def clear() -> None:
+    _CACHE.clear()
+    _CONSTRAINED.clear()
+
+
+def _cached(key: str, load, now: float = None):
+    now = time.time() if now is None else now
+    if key not in _CACHE or _CACHE[key][0] <= now:
+        _CACHE[key] = (now + TOPOLOGY_TTL_SECONDS, load())
+    return _CACHE[key][1]
+
+
+def supported_zones() -> list:
+    return json.loads(os.environ['SUPPORTED_AZS'])
+
+
+def topology():
+    """
+    The subnets of the VPC written at synth time, or None.
+    """
+    subnets = os.environ.get('SUBNET_TOPOLOGY')
+    return json.loads(subnets) if subnets else None
+
+
+def subnets(ec2) -> list:
+    """
+    The subnets of the VPC, with their AvailabilityZone and AvailableIpAddressCount.
+    """
+    def load():
+        known = topology()
+        if known:
+            response = ec2.describe_subnets(SubnetIds=[subnet['SubnetId'] for subnet in known])
+        else:
+            response = ec2.describe_subnets(Filters=[{'Name': 'vpc-id', 'Values': [os.environ['VPC_ID']]}])
+        return [{key: subnet[key] for key in ('SubnetId', 'AvailabilityZone', 'AvailableIpAddressCount')}
+                for subnet in response['Subnets']]
+    return _cached('subnets', load)
+
+
+def offered_zones(ec2, instance_type: str) -> set:
+    """
+    The availability zones offering the instance type.
+    """
+    def load():
+        response = ec2.describe_instance_type_offerings(
+            LocationType='availability-zone',
+            Filters=[{'Name': 'instance-type', 'Values': [instance_type]}])
+        return {offering['Location'] for offering in response['InstanceTypeOfferings']}
+    return _cached('offerings#' + instance_type, load)
+
+
+def in_flight(ec2) -> dict:
+    """
+    The number of forensic instances running per availability zone.
+    """
+    counts = {}
+    pages = ec2.get_paginator('describe_instances').paginate(Filters=[
+        {'Name': 'tag-key', 'Values': ['FindingID']},
+        {'Name': 'instance-state-name', 'Values': IN_FLIGHT_STATES},
+    ])
+    for page in pages:
+        for reservation in page['Reservations']:
+            for instance in reservation['Instances']:
+                zone = instance['Placement']['AvailabilityZone']
+                counts[zone] = counts.get(zone, 0) + 1
+    return counts
+
+
+def mark_constrained(zone: str, now: float = None) -> None:
+    """
+    Avoids the zone for CAPACITY_BACKOFF_SECONDS, after it had no capacity for the instance type.
+    """
+    _CONSTRAINED[zone] = (time.time() if now is None else now) + CAPACITY_BACKOFF_SECONDS
+
+
+def constrained(zone: str, now: float = None) -> bool:
+    return _CONSTRAINED.get(zone, 0) > (time.time() if now is None else now)
+
+
+def choose_zone(ec2, exclude=()) -> str:
+    """
+    Picks the availability zone of the forensic volume.  The zones avoided after a lack of capacity are only
+    picked when no other zone is left.
+    :param exclude: Zones never to pick, such as the ones the instance could not be started in
+    :raises Exception: No supported zone offers the instance type with free IP addresses
+    """
+    free = {subnet['AvailabilityZone'] for subnet in subnets(ec2) if subnet['AvailableIpAddressCount'] > 0}
+    zones = [zone for zone in supported_zones() if zone not in exclude and zone in free]
+    instance_type = os.environ.get('INSTANCE_TYPE')
+    if instance_type:
+        zones = [zone for zone in zones if zone in offered_zones(ec2, instance_type)]
+    if not zones:
+        raise Exception("No availability zone of {} offers {} with free IP addresses".format(
+            supported_zones(), instance_type))
+    zones = [zone for zone in zones if not constrained(zone)] or zones
+    counts = in_flight(ec2)
+    fewest = min(counts.get(zone, 0) for zone in zones)
+    return random.choice([zone for zone in zones if counts.get(zone, 0) == fewest])
+
+
+def choose_subnet(ec2, zone: str) -> str:
+    """
+    The subnet of the zone with the most free IP addresses.
+    :raises Exception: The zone has no subnet with a free IP address
+    """
+    candidates = [subnet for subnet in subnets(ec2)
+                  if subnet['AvailabilityZone'] == zone and subnet['AvailableIpAddressCount'] > 0]
+    if not candidates:
+        raise Exception("No subnet of {} has a free IP address".format(zone))
+    return max(candidates, key=lambda subnet: subnet['AvailableIpAddressCount'])['SubnetId']
+
+
+def create_volume(ec2, event: dict, zone: str, volume_parameters: dict) -> dict:
+    """
+    Creates the forensic volume from the final copy in the zone.
+    :param volume_parameters: The type, IOPS and throughput, see volume_profile.create_volume_parameters()
+    :return: The ec2.create_volume() response
+    """
+    return ec2.create_volume(
+        AvailabilityZone=zone,
+        SnapshotId=event['FinalCopiedSnapshotID'],
+        Encrypted=True,
+        KmsKeyId=os.environ['KMS_KEY'],
+        **volume_parameters,
+        TagSpecifications=tagging.volume_tag_specifications('volume', event['InstanceID'] + "-" + event['SourceVolumeID'],
+                                                            event)
+    )
+
+
+def relocate_volume(ec2, event: dict, zone: str) -> dict:
+    """
+    Creates the forensic volume again in the zone, with the same profile, and deletes the one created before,
+    which nothing is attached to yet.
+    :return: The event, with the new ForensicVolumeID and VolumeAZ
+    """
+    previous = event['ForensicVolumeID']
+    response = create_volume(ec2, event, zone, volume_profile.create_volume_parameters(event['VolumeProfile']))
+    ec2.get_waiter('volume_available').wait(VolumeIds=[previous], WaiterConfig={'Delay': 2, 'MaxAttempts': 10})
+    ec2.delete_volume(VolumeId=previous)
+    event['ForensicVolumeID'] = response['VolumeId']
+    event['VolumeAZ'] = response['AvailabilityZone']
+    return event
@@ -0,0 +1,89 @@
+"""
+Progress-aware polling of the snapshot check stages.
+
+By default a check stage raises RuntimeError while its snapshots are pending and the state
+machine retries it on a fixed backoff.  With ADAPTIVE_POLLING set to "true", the check
+returns instead, with SnapshotStatus "pending" and NextPollSeconds, the time the slowest
+pending snapshot is expected to still take.  The state machine waits that long before
+checking again.  The estimate comes from the progress rate since StartTime, or, while EC2
+reports no progress yet, from the EstimatedCopySeconds of the copy stage or the volume size.
+"""
+import datetime
+import os
+
+# Bounds of the delay before the next check
+MIN_POLL_SECONDS = 5
+MAX_POLL_SECONDS = 300
+
+# Assumed snapshot time per GiB while EC2 reports no progress
+DEFAULT_SECONDS_PER_GIB = 6.0
+
+# The progress rate is not trusted before this many seconds have passed
+MIN_ELAPSED_SECONDS = 10
+
+
+def adaptive() -> bool:
+    return os.environ.get('ADAPTIVE_POLLING', '').lower() == 'true'
+
+
+def progress(snapshot: dict) -> float:
+    """
+    The Progress of the snapshot as a percentage.  EC2 returns it as a string such as "45%", or empty.
+    """
+    try:
+        return float(snapshot.get('Progress', '').rstrip('%'))
+    except ValueError:
+        return 0.0
+
+
+def remaining_seconds(snapshot: dict, volume_size: int = None, now: datetime.datetime = None,
+                      estimate: float = None) -> float:
+    """
+    Estimates the seconds left before the snapshot completes.
+    :param snapshot: A pending snapshot as returned by ec2:DescribeSnapshots
+    :param volume_size: The volume size in GiB, when the snapshot has no VolumeSize
+    :param estimate: The estimated total seconds of the snapshot, used instead of the volume size
+    """
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    elapsed = (now - snapshot['StartTime']).total_seconds() if 'StartTime' in snapshot else 0.0
+    done = progress(snapshot)
+    if done > 0 and elapsed >= MIN_ELAPSED_SECONDS:
+        return elapsed * (100.0 - done) / done
+    if not estimate:
+        estimate = (snapshot.get('VolumeSize') or volume_size or 1) * DEFAULT_SECONDS_PER_GIB
+    return max(estimate - elapsed, 0.0)
+
+
+def next_poll_seconds(snapshots: list, volume_size: int = None, now: datetime.datetime = None,
+                      estimate: float = None) -> int:
+    """
+    The delay before checking again: the estimated remaining time of the slowest pending snapshot,
+    bounded by MIN_POLL_SECONDS and MAX_POLL_SECONDS.
+    """
+    remaining = max([remaining_seconds(snapshot, volume_size, now, estimate) for snapshot in snapshots] or [0.0])
+    return int(min(max(remaining, MIN_POLL_SECONDS), MAX_POLL_SECONDS))
+
+
+def pending(state: dict, snapshots: list) -> dict:
+    """
+    Reports that the snapshots are still pending: raises RuntimeError for the state machine to retry,
+    or, with adaptive polling, returns the state with SnapshotStatus and NextPollSeconds.
+    :param state: The DiskProcess state of the check stage
+    :param snapshots: The pending snapshots as returned by ec2:DescribeSnapshots
+    """
+    if not adaptive():
+        raise RuntimeError("Snapshots not finished")
+    state['SnapshotStatus'] = 'pending'
+    state['NextPollSeconds'] = next_poll_seconds(snapshots, state.get('VolumeSize'),
+                                                 estimate=state.get('EstimatedCopySeconds'))
+    return state
+
+
+def completed(state: dict) -> dict:
+    """
+    Marks the snapshots of the check stage completed, with adaptive polling.
+    """
+    if adaptive():
+        state['SnapshotStatus'] = 'completed'
+        state.pop('NextPollSeconds', None)
+    return state
@@ -0,0 +1,56 @@
+"""
+Multi-region capture into one forensic region.
+
+By default the copy of the snapshot in the member account stays in the region of the
+instance.  With FORENSIC_REGION set, CopySnapshot copies it from the region of the instance
+straight into the forensic region, under the evidence key of that region.  The share, the
+final copy and the forensic volume and instance then all stay in the forensic region, which
+is the region of the pipeline.  The findings of the other regions have to be forwarded to
+the event bus of the forensic region.
+
+The region of the copy is kept in the CopyRegion of the state, for the stages after the copy.
+
+FORENSIC_REGION          The region the copies go to.  Unset keeps every copy in its own region.
+SECONDS_PER_GIB          Estimated copy time per GiB within a region
+CROSS_REGION_SECONDS_PER_GIB  Estimated copy time per GiB across regions, as a JSON object of source
+                         region to seconds, with "*" for the regions not listed
+"""
+import json
+import os
+
+from . import polling
+
+DEFAULT_CROSS_REGION_SECONDS_PER_GIB = 15.0
+
+
+def forensic_region():
+    return os.environ.get('FORENSIC_REGION') or None
+
+
+def copy_region(source_region: str) -> str:
+    """
+    The region the snapshot of an instance in the source region is copied to.
+    """
+    return forensic_region() or source_region
+
+
+def snapshot_copy_region(state: dict) -> str:
+    """
+    The region of the copy of a ProcessSnaps Map iteration.
+    """
+    return state.get('CopyRegion') or state['Region']
+
+
+def seconds_per_gib(source_region: str, dest_region: str) -> float:
+    if source_region == dest_region:
+        return float(os.environ.get('SECONDS_PER_GIB') or polling.DEFAULT_SECONDS_PER_GIB)
+    estimates = json.loads(os.environ.get('CROSS_REGION_SECONDS_PER_GIB') or '{}')
+    return float(estimates.get(source_region, estimates.get('*', DEFAULT_CROSS_REGION_SECONDS_PER_GIB)))
+
+
+def transfer_seconds(volume_size: int, source_region: str, dest_region: str) -> float:
+    """
+    Estimates the time a copy of a snapshot of the volume takes, until EC2 reports its progress.
+    :param volume_size: The volume size in GiB
+    """
+    return (volume_size or 1) * seconds_per_gib(source_region, dest_region)
@@ -0,0 +1,221 @@
+"""
+Cleanup of the snapshots and volumes left behind by the captures.
+
+Every captured volume leaves behind its source snapshot and its copy in the member account,
+and its final copy and forensic volume in the security account.  Once the image of the
+volume is verified in the evidence bucket, the Cleanup function deletes them, apart from
+what the retention policy keeps:
+
+* the final copy, for RETENTION_DAYS days after it was taken, to image the volume again
+* the latest copy of each lineage and the snapshot it was copied from (see lineage), which
+  the next capture of the volume is copied incrementally from
+* the forensic volume, while it is still attached
+* anything without the FindingID tag of the capture, such as an adopted malware scan snapshot
+
+The image is verified when the collection log, uploaded after the image, is in the bucket
+and the image has the size of the volume.  The resources of a capture are read from its
+processedResources.json, written by the MountVolume stage.
+
+RETENTION_DAYS  Days the final copy is kept.  Defaults to DEFAULT_RETENTION_DAYS.
+
+Each run returns a report with one entry per resource:
+
+{"ResourceType": "snapshot" or "volume", "Role", "Id", "AccountId", "Region",
+ "IncidentId", "Action": "delete", "keep", "gone" or "failed", "Reason", "DryRun"}
+"""
+import datetime
+import json
+import os
+
+from botocore.exceptions import ClientError
+
+from . import callbacks, clients, events, lineage, regions, sessions, tagging
+
+DEFAULT_RETENTION_DAYS = 30
+
+GIB = 1024 ** 3
+
+EVIDENCE_PREFIX = 'disk_evidence/'
+COLLECTION_LOG_SUFFIX = '.collection.log'
+REPORT_PREFIX = 'cleanup-reports/'
+
+
+def retention_days() -> float:
+    return float(os.environ.get('RETENTION_DAYS') or DEFAULT_RETENTION_DAYS)
+
+
+def evidence_key(incident_id: str, volume_id: str, suffix: str) -> str:
+    return '{}/{}{}{}'.format(incident_id, EVIDENCE_PREFIX, volume_id, suffix)
+
+
+def capture_of_key(key: str):
+    """
+    The (incident ID, source volume ID) of the collection log at the key, or None for any other key.
+    """
+    incident_id, _, name = key.partition('/' + EVIDENCE_PREFIX)
+    if not name.endswith(COLLECTION_LOG_SUFFIX) or '/' in name:
+        return None
+    return incident_id, name[:-len(COLLECTION_LOG_SUFFIX)]
+
+
+def image_verified(s3, bucket: str, incident_id: str, volume_id: str, volume_size: int = None) -> bool:
+    """
+    Whether the image of the volume was fully written: the collection log, uploaded after the image, is there
+    and the image has the size of the volume.
+    :param volume_size: The volume size in GiB
+    """
+    try:
+        s3.head_object(Bucket=bucket, Key=evidence_key(incident_id, volume_id, COLLECTION_LOG_SUFFIX))
+        image = s3.head_object(Bucket=bucket, Key=evidence_key(incident_id, volume_id, '.image.dd'))
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+    return not volume_size or image['ContentLength'] == volume_size * GIB
+
+
+def processed_resources(s3, bucket: str, incident_id: str, volume_id: str):
+    """
+    The state of the capture of the volume as written by MountVolume, or None before it was mounted.
+    """
+    try:
+        response = s3.get_object(Bucket=bucket, Key=evidence_key(incident_id, volume_id, '.processedResources.json'))
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            return None
+        raise
+    return json.loads(response['Body'].read())
+
+
+def candidates(state: dict) -> list:
+    """
+    The resources left behind by the capture of one volume.
+    :param state: The processedResources.json of the volume
+    """
+    own_region = os.environ.get('AWS_REGION', '')
+    found = []
+    if 'GuardDutyScanId' not in state:
+        found.append(('snapshot', 'SourceSnapshot', state['SourceSnapshotID'], state['AccountID'], state['Region']))
+    if state.get('CopiedSnapshotID') and state['CopiedSnapshotID'] != state.get('FinalCopiedSnapshotID'):
+        found.append(('snapshot', 'Copy', state['CopiedSnapshotID'], state['AccountID'],
+                      regions.snapshot_copy_region(state)))
+    if state.get('FinalCopiedSnapshotID'):
+        found.append(('snapshot', 'FinalCopy', state['FinalCopiedSnapshotID'], callbacks.SELF_ACCOUNT, own_region))
+    if state.get('ForensicVolumeID'):
+        found.append(('volume', 'ForensicVolume', state['ForensicVolumeID'], callbacks.SELF_ACCOUNT, own_region))
+    return [dict(zip(('ResourceType', 'Role', 'Id', 'AccountId', 'Region'), candidate)) for candidate in found]
+
+
+def describe(ec2, candidate: dict):
+    """
+    The snapshot or volume as returned by EC2, or None once it is gone.
+    """
+    if candidate['ResourceType'] == 'snapshot':
+        found = ec2.describe_snapshots(Filters=[{'Name': 'snapshot-id', 'Values': [candidate['Id']]}])['Snapshots']
+    else:
+        found = ec2.describe_volumes(Filters=[{'Name': 'volume-id', 'Values': [candidate['Id']]}])['Volumes']
+    return found[0] if found else None
+
+
+def decide(candidate: dict, resource, finding_id: str, verified: bool, lineage_ids: set,
+           now: datetime.datetime = None) -> tuple:
+    """
+    Applies the retention policy to one resource.
+    :param resource: The resource as returned by describe()
+    :param finding_id: The finding of the capture, which the resource has to be tagged with
+    :param verified: Whether the image of the volume is verified
+    :param lineage_ids: The snapshots that are the latest copy of their lineage
+    :return: (action, reason)
+    """
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    if resource is None:
+        return 'gone', "Already deleted"
+    if tagging.tag_value(resource, 'FindingID') != finding_id:
+        return 'keep', "Not tagged with the finding of the capture"
+    if not verified:
+        return 'keep', "Image not verified"
+    if candidate['Id'] in lineage_ids:
+        return 'keep', "Base of the next copy of the volume"
+    if candidate['Role'] == 'FinalCopy' and now - resource['StartTime'] < datetime.timedelta(days=retention_days()):
+        return 'keep', "Within the retention period"
+    if candidate['ResourceType'] == 'volume' and resource['State'] != 'available':
+        return 'keep', "Volume is {}".format(resource['State'])
+    return 'delete', "Image verified"
+
+
+def lineage_ids(state: dict) -> set:
+    ids = set()
+    for stage in (lineage.COPY, lineage.FINAL_COPY):
+        copy = lineage.previous(stage, state['AccountID'], state['SourceVolumeID'])
+        if copy:
+            # EBS copies incrementally only while both the previous copy and its source exist
+            ids.update((copy['SnapshotId'], copy['SourceSnapshotId']))
+    return ids
+
+
+def ec2_client(candidate: dict, role_name: str):
+    if candidate['AccountId'] == callbacks.SELF_ACCOUNT:
+        return clients.client('ec2', region_name=candidate['Region'] or None)
+    return sessions.member_ec2_client(candidate['AccountId'], role_name, candidate['Region'],
+                                      session_name="forensic-cleanup")
+
+
+def clean(s3, bucket: str, incident_id: str, volume_id: str, role_name: str, dry_run: bool = False) -> list:
+    """
+    Deletes what the retention policy does not keep of the capture of one volume.
+    :param dry_run: Only report what would be deleted
+    :return: The report entries of the resources of the capture
+    """
+    state = processed_resources(s3, bucket, incident_id, volume_id)
+    if state is None:
+        return []
+    verified = image_verified(s3, bucket, incident_id, volume_id, state.get('VolumeSize'))
+    keep_ids = lineage_ids(state)
+    report = []
+    for candidate in candidates(state):
+        ec2 = ec2_client(candidate, role_name)
+        action, reason = decide(candidate, describe(ec2, candidate), state['FindingID'], verified, keep_ids)
+        if action == 'delete' and not dry_run:
+            try:
+                if candidate['ResourceType'] == 'snapshot':
+                    ec2.delete_snapshot(SnapshotId=candidate['Id'])
+                else:
+                    ec2.delete_volume(VolumeId=candidate['Id'])
+            except ClientError as e:
+                action, reason = 'failed', e.response['Error']['Code']
+        report.append(dict(candidate, IncidentId=incident_id, Action=action, Reason=reason, DryRun=dry_run))
+    return report
+
+
+def swept_captures(ec2) -> set:
+    """
+    The captures with resources left in the security account, found by their FindingID and InstanceID tags,
+    which everything the pipeline creates has.  The source volume comes from the VolumeID tag or, for the
+    snapshots started by CreateSnapshots for the whole instance, which are tagged per instance only, from the
+    volume of the snapshot.
+    :return: {(incident ID, source volume ID)}
+    """
+    found = set()
+    tagged = [{'Name': 'tag-key', 'Values': ['FindingID']}, {'Name': 'tag-key', 'Values': ['InstanceID']}]
+    pages = [page['Snapshots'] for page in ec2.get_paginator('describe_snapshots').paginate(OwnerIds=['self'],
+                                                                                            Filters=tagged)]
+    pages += [page['Volumes'] for page in ec2.get_paginator('describe_volumes').paginate(Filters=tagged)]
+    for resources in pages:
+        for resource in resources:
+            finding_id = tagging.tag_value(resource, 'FindingID')
+            volume_id = tagging.tag_value(resource, 'VolumeID') or \
+                (resource.get('VolumeId') if 'SnapshotId' in resource else None)
+            if finding_id and 'finding/' in finding_id and volume_id:
+                found.add((events.incident_id(finding_id), volume_id))
+    return found
+
+
+def write_report(s3, bucket: str, report: list, dry_run: bool, now: datetime.datetime = None) -> str:
+    """
+    Writes the report to the evidence bucket.
+    :return: The key of the report
+    """
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    key = '{}{}{}.json'.format(REPORT_PREFIX, now.strftime('%Y-%m-%dT%H-%M-%SZ'), '-dry-run' if dry_run else '')
+    s3.put_object(Bucket=bucket, Key=key, Body=json.dumps(report, default=str))
+    return key
@@ -0,0 +1,127 @@
+"""
+Cache of cross account sessions for the member automation role.
+
+Lambda keeps module level objects alive between warm invocations, so the credentials
+returned by sts:AssumeRole are kept here and reused until they get close to expiring.
+The check functions are retried many times per snapshot, and without the cache every
+retry paid for an AssumeRole call and a new boto3 Session.  The member clients are
+created from the shared botocore session in clients, so the EC2 service model is not
+loaded a second time for the member account.
+"""
+import datetime
+import os
+import threading
+
+from . import clients
+
+# Credentials are refreshed when they are closer than this to their expiration
+REFRESH_MARGIN = datetime.timedelta(minutes=5)
+
+
+class SessionCache:
+    def __init__(self, refresh_margin: datetime.timedelta = REFRESH_MARGIN, sts_client=None) -> None:
+        """
+        Holds one set of assumed role credentials per (partition, account, role name, region), along
+        with the clients that have been created from it.
+        :param refresh_margin: How long before the credentials expire they are refreshed
+        :param sts_client: The STS client used to assume the role.  Created on first use if not given.
+
+        :ivar hits: Number of lookups answered from the cache
+        :ivar misses: Number of lookups that had to call sts:AssumeRole
+        :ivar refreshes: Number of misses caused by credentials that were about to expire
+        """
+        self.refresh_margin = refresh_margin
+        self._sts_client = sts_client
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+
+    @property
+    def sts_client(self):
+        if self._sts_client is None:
+            self._sts_client = clients.client('sts')
+        return self._sts_client
+
+    def _expired(self, entry: dict) -> bool:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        return entry['Expiration'] - self.refresh_margin <= now
+
+    def _assume_role(self, key: tuple, session_name: str) -> dict:
+        partition, account_id, role_name, region = key
+        response = self.sts_client.assume_role(
+            RoleArn='arn:{}:iam::{}:role/{}'.format(partition, account_id, role_name),
+            RoleSessionName=session_name[:64]
+        )
+        credentials = response['Credentials']
+        return {'Credentials': credentials, 'Expiration': credentials['Expiration'], 'Clients': {}}
+
+    def _entry(self, account_id: str, role_name: str, region: str, partition: str, session_name: str) -> dict:
+        key = (partition, account_id, role_name, region)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and not self._expired(entry):
+                self.hits += 1
+                return entry
+            self.misses += 1
+            if entry is not None:
+                self.refreshes += 1
+            entry = self._assume_role(key, session_name)
+            self._entries[key] = entry
+            return entry
+
+    def credentials(self, account_id: str, role_name: str, region: str,
+                    partition: str = None, session_name: str = "forensic-automation") -> dict:
+        """
+        Returns the Credentials of the role in the member account, assuming the role only
+        when there are no cached credentials or they are about to expire.
+        :param account_id: The account that owns the role
+        :param role_name: The name of the role to assume
+        :param region: The region the clients using the credentials are created in
+        :param partition: The AWS partition.  Defaults to the Partition environment variable, then "aws"
+        :param session_name: RoleSessionName used when the role has to be assumed
+        """
+        partition = partition or os.environ.get("Partition", 'aws')
+        return self._entry(account_id, role_name, region, partition, session_name)['Credentials']
+
+    def client(self, service: str, account_id: str, role_name: str, region: str,
+               partition: str = None, session_name: str = "forensic-automation"):
+        """
+        Returns a client for the service, created with the cached member credentials.  The client
+        is cached with the credentials, so it is replaced when they are refreshed.
+        """
+        partition = partition or os.environ.get("Partition", 'aws')
+        entry = self._entry(account_id, role_name, region, partition, session_name)
+        with self._lock:
+            if service not in entry['Clients']:
+                entry['Clients'][service] = clients.create_client(service, region_name=region,
+                                                                  credentials=entry['Credentials'])
+            return entry['Clients'][service]
+
+    def stats(self) -> dict:
+        return {'Hits': self.hits, 'Misses': self.misses, 'Refreshes': self.refreshes,
+                'Sessions': len(self._entries)}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.refreshes = 0
+
+
+# Module level cache, kept between warm invocations of the same container
+CACHE = SessionCache()
+
+
+def member_ec2_client(account_id: str, role_name: str, region: str, session_name: str = "forensic-automation"):
+    """
+    Returns an EC2 client for the member account from the module level cache.
+    """
+    return CACHE.client('ec2', account_id=account_id, role_name=role_name, region=region,
+                        session_name=session_name)
+
+
+def cache_stats() -> dict:
+    return CACHE.stats()
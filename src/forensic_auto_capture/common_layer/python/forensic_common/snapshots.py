@@ -0,0 +1,208 @@
+"""
+Starting the snapshots of the volumes of the instance under investigation.
+
+Used by the CreateSnapshot function and, in fast path mode, by the invoke functions through
+pre_capture(), which starts the snapshots before the step function execution and passes them
+to CreateSnapshot under PRE_CAPTURED.  Both read the same settings from their environment:
+
+SNAPSHOT_MODE          "Volume" for one CreateSnapshot call per volume, or "Instance" for one
+                       crash-consistent CreateSnapshots call for all the volumes of the instance
+SNAPSHOT_CONCURRENCY   Most CreateSnapshot calls started at once in Volume mode
+
+along with the volume exclusions read by volumes.VolumeFilter and the reuse of the
+GuardDuty Malware Protection snapshots configured in malware_scan.
+
+The started snapshots are returned as a JSON serializable dict, so it can be passed in the
+execution input:
+
+{"Snapshots": [{"SnapshotId", "VolumeId", "VolumeSize", "DeviceName", "StartTime", "GuardDutyScanId"}],
+ "FailedSnapshots": [{"SourceVolumeID", "SourceDeviceName", "Error"}],
+ "ExcludedVolumes": [{"VolumeId", "DeviceName"}],
+ "SnapshotStartSkew": seconds between the first and the last start of the started snapshots,
+ "AdoptedSnapshotAge": seconds since the start of the oldest adopted snapshot, 0 without one}
+"""
+import concurrent.futures
+import datetime
+import os
+
+from botocore.exceptions import ClientError
+
+from . import malware_scan, sessions, tagging, volumes
+
+PRE_CAPTURED = 'PreCapturedSnapshots'
+
+SNAPSHOT_NAME = 'Forensic Automated Snapshot creation'
+
+# Most CreateSnapshot calls started at once, within the connection pool of the shared client
+DEFAULT_CONCURRENCY = 16
+
+
+def start_skew(snaps: list) -> float:
+    """
+    Seconds between the first and the last snapshot start time.
+    :param snaps: Snapshots as returned by ec2:CreateSnapshot
+    """
+    start_times = [snap['StartTime'] for snap in snaps if 'StartTime' in snap]
+    if len(start_times) < 2:
+        return 0.0
+    return (max(start_times) - min(start_times)).total_seconds()
+
+
+def snapshot_age(snaps: list, now: datetime.datetime = None) -> float:
+    """
+    Seconds since the start of the oldest snapshot, or 0.0 without one.
+    :param snaps: Snapshots as returned by ec2:DescribeSnapshots
+    """
+    start_times = [snap['StartTime'] for snap in snaps if 'StartTime' in snap]
+    if not start_times:
+        return 0.0
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    return (now - min(start_times)).total_seconds()
+
+
+def start_instance_snapshots(ec2, instance: dict, captured: list, excluded: list, finding_id: str) -> tuple:
+    """
+    Snapshots all the captured volumes of the instance with one ec2:CreateSnapshots call.  The
+    snapshots are crash-consistent across the volumes: they are taken at the same point in time.
+    The call succeeds or fails for all the volumes at once.
+    :return: ([(snapshot, device name)], [])
+    """
+    if not captured:
+        return [], []
+    root_device_name = instance.get('RootDeviceName')
+    response = ec2.create_snapshots(
+        Description="Automated Snapshot creation: {}".format(finding_id),
+        InstanceSpecification={
+            'InstanceId': instance['InstanceId'],
+            'ExcludeBootVolume': any(vol['DeviceName'] == root_device_name for vol in excluded),
+            'ExcludeDataVolumeIds': [vol['Ebs']['VolumeId'] for vol in excluded
+                                     if vol['DeviceName'] != root_device_name]
+        },
+        TagSpecifications=tagging.instance_tag_specifications('snapshot', SNAPSHOT_NAME,
+                                                              instance_id=instance['InstanceId'],
+                                                              finding_id=finding_id)
+    )
+    device_names = {vol['Ebs']['VolumeId']: vol['DeviceName'] for vol in instance['BlockDeviceMappings']
+                    if 'Ebs' in vol}
+    return [(snap, device_names[snap['VolumeId']]) for snap in response['Snapshots']], []
+
+
+def start_volume_snapshot(ec2, instance_id: str, vol: dict, finding_id: str) -> dict:
+    return ec2.create_snapshot(
+        Description="Automated Snapshot creation: {}".format(finding_id),
+        VolumeId=vol['Ebs']['VolumeId'],
+        TagSpecifications=tagging.tag_specifications('snapshot', SNAPSHOT_NAME,
+                                                     instance_id=instance_id,
+                                                     volume_id=vol['Ebs']['VolumeId'],
+                                                     finding_id=finding_id,
+                                                     device_name=vol['DeviceName'])
+    )
+
+
+def start_volume_snapshots(ec2, instance_id: str, captured: list, finding_id: str,
+                           concurrency: int = DEFAULT_CONCURRENCY) -> tuple:
+    """
+    Starts one ec2:CreateSnapshot call per captured volume, all at once on a bounded thread pool
+    sharing the member account client, so the snapshots start within about one API round-trip of
+    each other.  A volume whose call fails is reported in the failures without stopping the others, and the
+    step function publishes the failures to its error topic.
+    :return: ([(snapshot, device name)], [failure])
+    """
+    if not captured:
+        return [], []
+    started, failed = [], []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(concurrency, len(captured))) as executor:
+        futures = [executor.submit(start_volume_snapshot, ec2, instance_id, vol, finding_id) for vol in captured]
+        for vol, future in zip(captured, futures):
+            try:
+                started.append((future.result(), vol['DeviceName']))
+            except ClientError as e:
+                failed.append({'SourceVolumeID': vol['Ebs']['VolumeId'], 'SourceDeviceName': vol['DeviceName'],
+                               'Error': e.response['Error']['Code']})
+    return started, failed
+
+
+def start(ec2, instance_id: str, finding_id: str, volume_filter: volumes.VolumeFilter,
+          mode: str = 'Volume', concurrency: int = DEFAULT_CONCURRENCY,
+          scan_snapshot_max_age: float = 0, scan_id: str = None) -> dict:
+    """
+    Starts the snapshots of the attached volumes of the instance that pass the filter.  Volumes with
+    a recent GuardDuty Malware Protection snapshot adopt it instead, and get its GuardDutyScanId.
+    The start skew covers the started snapshots only, and the age of the adopted ones is returned apart.
+    :param ec2: The EC2 client of the member account
+    :param instance_id: The ID of the instance under investigation
+    :param finding_id: The GuardDuty finding that triggered the capture
+    :param volume_filter: The volume exclusions
+    :param mode: "Volume" or "Instance", see SNAPSHOT_MODE
+    :param concurrency: Most CreateSnapshot calls started at once in Volume mode
+    :param scan_snapshot_max_age: Oldest malware scan snapshot adopted, in seconds.  0 never adopts one.
+    :param scan_id: The malware scan of the finding, whose snapshots are preferred
+    :return: The started snapshots, in the shape described at the top of this module
+    """
+    response = ec2.describe_instances(InstanceIds=[instance_id])
+    result = {'Snapshots': [], 'FailedSnapshots': [], 'ExcludedVolumes': []}
+    started_snaps, adopted_snaps = [], []
+    for reservation in response['Reservations']:
+        for instance in reservation['Instances']:
+            captured, excluded = volumes.select(ec2, instance, volume_filter)
+            reused = malware_scan.find(ec2, [vol['Ebs']['VolumeId'] for vol in captured],
+                                       scan_snapshot_max_age, preferred_scan_id=scan_id)
+            adopted = [(reused[vol['Ebs']['VolumeId']], vol['DeviceName']) for vol in captured
+                       if vol['Ebs']['VolumeId'] in reused]
+            captured = [vol for vol in captured if vol['Ebs']['VolumeId'] not in reused]
+            if mode == 'Instance':
+                # The adopted volumes are left out of the CreateSnapshots call like the excluded ones
+                skipped = [vol for vol in volumes.attached_volumes(instance) if vol not in captured]
+                started, failed = start_instance_snapshots(ec2, instance, captured, skipped, finding_id)
+            else:
+                started, failed = start_volume_snapshots(ec2, instance_id, captured, finding_id, concurrency)
+            started_snaps.extend(snap for snap, _ in started)
+            adopted_snaps.extend(snap for snap, _ in adopted)
+            for snap, device_name in adopted + started:
+                result['Snapshots'].append({'SnapshotId': snap['SnapshotId'], 'VolumeId': snap['VolumeId'],
+                                            'VolumeSize': snap['VolumeSize'], 'DeviceName': device_name,
+                                            'StartTime': snap['StartTime'].isoformat() if 'StartTime' in snap else None,
+                                            'GuardDutyScanId': tagging.tag_value(snap, malware_scan.SCAN_ID_TAG)})
+            result['FailedSnapshots'].extend(failed)
+            result['ExcludedVolumes'].extend({'VolumeId': vol['Ebs']['VolumeId'], 'DeviceName': vol['DeviceName']}
+                                             for vol in excluded)
+    result['SnapshotStartSkew'] = start_skew(started_snaps)
+    result['AdoptedSnapshotAge'] = snapshot_age(adopted_snaps)
+    return result
+
+
+def start_from_environment(ec2, instance_id: str, finding_id: str, scan_id: str = None) -> dict:
+    """
+    Starts the snapshots with the settings read from the environment of the function.
+    """
+    return start(ec2, instance_id, finding_id,
+                 volume_filter=volumes.VolumeFilter.from_environment(),
+                 mode=os.environ.get('SNAPSHOT_MODE', 'Volume'),
+                 concurrency=int(os.environ.get('SNAPSHOT_CONCURRENCY', DEFAULT_CONCURRENCY)),
+                 scan_snapshot_max_age=malware_scan.max_age_from_environment(),
+                 scan_id=scan_id)
+
+
+def pre_capture(event: dict, logger) -> None:
+    """
+    Fast path: starts the snapshots of the instance before the step function execution, and passes them to
+    CreateSnapshot in the execution input under PRE_CAPTURED.  When this fails, CreateSnapshot starts them instead.
+    :param event: The execution input built by the invoke function
+    :param logger: The logger of the invoke function
+    """
+    instance_id = event['Resource']['Id']
+    try:
+        ec2 = sessions.member_ec2_client(event['AwsAccountId'], os.environ['ROLE_NAME'], event['Resource']['Region'],
+                                         session_name="{}-snapshot-creation".format(instance_id))
+        started = start_from_environment(ec2, instance_id, event['FindingId'], scan_id=event.get('MalwareScanId'))
+    except Exception as e:
+        logger.warning("Fast path snapshot creation failed, leaving it to the step function", InstanceID=instance_id,
+                       Error=str(e))
+        return
+    if not started['Snapshots']:
+        logger.warning("Fast path started no snapshot, leaving it to the step function", InstanceID=instance_id,
+                       FailedSnapshots=started['FailedSnapshots'])
+        return
+    event[PRE_CAPTURED] = started
+    logger.info("Fast path snapshots started", InstanceID=instance_id,
+                SnapshotIds=[snap['SnapshotId'] for snap in started['Snapshots']])
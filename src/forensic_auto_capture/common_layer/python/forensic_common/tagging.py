@@ -0,0 +1,60 @@
+"""
+Tags put on every snapshot, volume and instance created by the pipeline.
+"""
+
+
+def tag_value(resource: dict, key: str):
+    """
+    The value of the tag of an EC2 resource as described by EC2, or None when it is not tagged with it.
+    """
+    for item in resource.get('Tags', []):
+        if item['Key'] == key:
+            return item['Value']
+    return None
+
+
+def forensic_tags(name: str, instance_id: str, volume_id: str, finding_id: str, device_name: str) -> list:
+    return [
+        {'Key': 'Name', 'Value': name},
+        {'Key': 'InstanceID', 'Value': instance_id},
+        {'Key': 'VolumeID', 'Value': volume_id},
+        {'Key': 'FindingID', 'Value': finding_id},
+        {'Key': 'SourceDeviceName', 'Value': device_name}
+    ]
+
+
+def tag_specifications(resource_type: str, name: str, instance_id: str, volume_id: str,
+                       finding_id: str, device_name: str) -> list:
+    """
+    Builds the TagSpecifications parameter of the EC2 create calls.
+    :param resource_type: The EC2 resource type being created, such as "snapshot" or "volume"
+    :param name: Value of the Name tag
+    :param instance_id: The ID of the instance under investigation
+    :param volume_id: The ID of the source volume
+    :param finding_id: The GuardDuty finding that triggered the capture
+    :param device_name: The device name the source volume was attached as
+    """
+    return [{'ResourceType': resource_type,
+             'Tags': forensic_tags(name, instance_id, volume_id, finding_id, device_name)}]
+
+
+def volume_tag_specifications(resource_type: str, name: str, event: dict) -> list:
+    """
+    Builds the TagSpecifications parameter from a ProcessSnaps Map iteration event.
+    """
+    return tag_specifications(resource_type, name,
+                              instance_id=event['InstanceID'],
+                              volume_id=event['SourceVolumeID'],
+                              finding_id=event['FindingID'],
+                              device_name=event['SourceDeviceName'])
+
+
+def instance_tag_specifications(resource_type: str, name: str, instance_id: str, finding_id: str) -> list:
+    """
+    Builds the TagSpecifications parameter of ec2:CreateSnapshots, which applies the same tags to
+    the snapshot of every volume, so the per volume VolumeID and SourceDeviceName tags are left out.
+    """
+    return [{'ResourceType': resource_type,
+             'Tags': [{'Key': 'Name', 'Value': name},
+                      {'Key': 'InstanceID', 'Value': instance_id},
+                      {'Key': 'FindingID', 'Value': finding_id}]}]
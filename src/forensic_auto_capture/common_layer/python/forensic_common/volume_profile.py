@@ -0,0 +1,134 @@
+"""
+Type, IOPS and throughput of the forensic volume, sized for imaging.
+
+dc3dd reads the forensic volume sequentially, so the imaging time is the volume size over
+the throughput of the volume.  A gp3 volume is provisioned with the throughput of
+TARGET_IMAGING_MIBPS, and the IOPS needed to reach it with reads of 256 KiB.  Above
+IO2_MIN_VOLUME_GIB, and only when the target is more than gp3 can deliver, an io2 volume is
+provisioned instead, with the IOPS reaching the target.  Both are bounded by the limits of
+the volume type and of the volume size.
+
+With MAX_VOLUME_MONTHLY_COST set, the provisioned throughput is lowered until the monthly
+price of the volume is within it.  An io2 volume over the ceiling falls back to gp3.  The
+baseline gp3 volume is never lowered further, so a volume whose storage alone is over the
+ceiling is still created, at the baseline, with CostCapped set.
+
+TARGET_IMAGING_MIBPS     The throughput the imaging instance can read at, in MiB/s
+IO2_MIN_VOLUME_GIB       The smallest volume io2 is considered for
+MAX_VOLUME_MONTHLY_COST  The highest monthly price of the volume in USD.  Unset has no ceiling.
+
+The prices are the us-east-1 list prices, which only serve to compare the profiles.
+"""
+import math
+import os
+
+GP3 = 'gp3'
+IO2 = 'io2'
+
+DEFAULT_TARGET_MIBPS = 250
+DEFAULT_IO2_MIN_VOLUME_GIB = 4096
+
+GP3_BASELINE_IOPS = 3000
+GP3_BASELINE_THROUGHPUT = 125
+GP3_MAX_IOPS = 16000
+GP3_MAX_THROUGHPUT = 1000
+# gp3 throughput is at most 0.25 MiB/s per provisioned IOPS
+GP3_MIB_PER_IOPS = 0.25
+
+IO2_MAX_IOPS = 64000
+IO2_MAX_THROUGHPUT = 4000
+# io2 delivers 256 KiB per IOPS
+IO2_MIB_PER_IOPS = 0.256
+
+MAX_IOPS_PER_GIB = 500
+
+# USD per month
+GP3_GIB_PRICE = 0.08
+GP3_IOPS_PRICE = 0.005
+GP3_THROUGHPUT_PRICE = 0.04
+IO2_GIB_PRICE = 0.125
+# io2 IOPS are priced in tiers: (IOPS up to, price per IOPS)
+IO2_IOPS_TIERS = ((32000, 0.065), (64000, 0.0455))
+
+# Step, in MiB/s, by which the throughput is lowered to meet the cost ceiling
+THROUGHPUT_STEP = 5
+
+
+def target_throughput() -> int:
+    return int(os.environ.get('TARGET_IMAGING_MIBPS') or DEFAULT_TARGET_MIBPS)
+
+
+def io2_min_volume_size() -> int:
+    return int(os.environ.get('IO2_MIN_VOLUME_GIB') or DEFAULT_IO2_MIN_VOLUME_GIB)
+
+
+def cost_ceiling():
+    ceiling = os.environ.get('MAX_VOLUME_MONTHLY_COST')
+    return float(ceiling) if ceiling else None
+
+
+def gp3(volume_size: int, throughput: int) -> dict:
+    """
+    The gp3 volume reading at the throughput, or as close to it as gp3 and the volume size allow.
+    :param volume_size: The volume size in GiB
+    :param throughput: The throughput in MiB/s
+    """
+    throughput = min(max(throughput, GP3_BASELINE_THROUGHPUT), GP3_MAX_THROUGHPUT)
+    max_iops = min(GP3_MAX_IOPS, max(GP3_BASELINE_IOPS, MAX_IOPS_PER_GIB * volume_size))
+    iops = min(max(GP3_BASELINE_IOPS, math.ceil(throughput / GP3_MIB_PER_IOPS)), max_iops)
+    throughput = min(throughput, int(iops * GP3_MIB_PER_IOPS))
+    cost = volume_size * GP3_GIB_PRICE + (iops - GP3_BASELINE_IOPS) * GP3_IOPS_PRICE + \
+        (throughput - GP3_BASELINE_THROUGHPUT) * GP3_THROUGHPUT_PRICE
+    return _profile(GP3, volume_size, iops, throughput, cost)
+
+
+def io2(volume_size: int, throughput: int) -> dict:
+    """
+    The io2 volume reading at the throughput, or as close to it as io2 and the volume size allow.
+    """
+    iops = min(math.ceil(min(throughput, IO2_MAX_THROUGHPUT) / IO2_MIB_PER_IOPS), IO2_MAX_IOPS,
+               MAX_IOPS_PER_GIB * volume_size)
+    cost, tier_start = volume_size * IO2_GIB_PRICE, 0
+    for tier_end, price in IO2_IOPS_TIERS:
+        cost += max(0, min(iops, tier_end) - tier_start) * price
+        tier_start = tier_end
+    return _profile(IO2, volume_size, iops, int(iops * IO2_MIB_PER_IOPS), cost)
+
+
+def select(volume_size: int) -> dict:
+    """
+    Picks the profile of the forensic volume.
+    :param volume_size: The volume size in GiB
+    :return: {"VolumeType", "Iops", "Throughput", "MonthlyCost", "ImagingSeconds", "CostCapped"}
+    """
+    target, ceiling = target_throughput(), cost_ceiling()
+    if volume_size >= io2_min_volume_size() and target > GP3_MAX_THROUGHPUT:
+        profile = io2(volume_size, target)
+        if ceiling is None or profile['MonthlyCost'] <= ceiling:
+            return profile
+    profile = gp3(volume_size, target)
+    while ceiling is not None and profile['MonthlyCost'] > ceiling and \
+            profile['Throughput'] > GP3_BASELINE_THROUGHPUT:
+        profile = gp3(volume_size, profile['Throughput'] - THROUGHPUT_STEP)
+    profile['CostCapped'] = ceiling is not None and (profile['MonthlyCost'] > ceiling or
+                                                     profile['Throughput'] < min(target, GP3_MAX_THROUGHPUT))
+    return profile
+
+
+def create_volume_parameters(profile: dict) -> dict:
+    """
+    The parameters of ec2.create_volume() provisioning the profile.
+    """
+    parameters = {'VolumeType': profile['VolumeType'], 'Iops': profile['Iops']}
+    if profile['VolumeType'] == GP3:
+        parameters['Throughput'] = profile['Throughput']
+    return parameters
+
+
+def _profile(volume_type: str, volume_size: int, iops: int, throughput: int, cost: float) -> dict:
+    return {'VolumeType': volume_type,
+            'Iops': iops,
+            'Throughput': throughput,
+            'MonthlyCost': round(cost, 2),
+            'ImagingSeconds': math.ceil(volume_size * 1024 / throughput),
+            'CostCapped': False}
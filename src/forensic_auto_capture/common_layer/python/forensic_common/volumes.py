@@ -0,0 +1,102 @@
+"""
+Selection of the volumes of the instance under investigation to capture.
+
+Every attached EBS volume is captured unless an exclusion matches it: the boot volume,
+a device name, or a volume tag.  The exclusions are read from the environment of the
+CreateSnapshot function:
+
+EXCLUDE_BOOT_VOLUME   "true" to leave out the volume attached as the root device
+EXCLUDE_DEVICE_NAMES  Comma separated device names, such as "/dev/sdf,/dev/sdg"
+EXCLUDE_VOLUME_TAGS   Comma separated tags, either "Key" to match any value or "Key=Value"
+"""
+import os
+
+TRUE_VALUES = ('1', 'true', 'yes')
+
+
+def _split(value: str) -> tuple:
+    return tuple(item.strip() for item in (value or '').split(',') if item.strip())
+
+
+class VolumeFilter:
+    def __init__(self, exclude_boot_volume: bool = False, exclude_device_names: tuple = (),
+                 exclude_volume_tags: tuple = ()) -> None:
+        """
+        :param exclude_boot_volume: Leave out the volume attached as the root device of the instance
+        :param exclude_device_names: Device names of the volumes to leave out
+        :param exclude_volume_tags: Tags of the volumes to leave out, as "Key" or "Key=Value"
+        """
+        self.exclude_boot_volume = exclude_boot_volume
+        self.exclude_device_names = frozenset(exclude_device_names)
+        self.exclude_volume_tags = tuple(tag.split('=', 1) for tag in exclude_volume_tags)
+
+    @classmethod
+    def from_environment(cls) -> 'VolumeFilter':
+        return cls(exclude_boot_volume=os.environ.get('EXCLUDE_BOOT_VOLUME', '').lower() in TRUE_VALUES,
+                   exclude_device_names=_split(os.environ.get('EXCLUDE_DEVICE_NAMES')),
+                   exclude_volume_tags=_split(os.environ.get('EXCLUDE_VOLUME_TAGS')))
+
+    @property
+    def needs_volume_tags(self) -> bool:
+        """
+        True when the volume tags must be looked up.  DescribeInstances does not return them.
+        """
+        return bool(self.exclude_volume_tags)
+
+    def excluded(self, mapping: dict, root_device_name: str, tags: list = None) -> bool:
+        """
+        :param mapping: A BlockDeviceMappings element of ec2:DescribeInstances
+        :param root_device_name: The RootDeviceName of the instance
+        :param tags: The tags of the volume, as returned by ec2:DescribeVolumes
+        """
+        if self.exclude_boot_volume and mapping['DeviceName'] == root_device_name:
+            return True
+        if mapping['DeviceName'] in self.exclude_device_names:
+            return True
+        for tag in tags or []:
+            for excluded_tag in self.exclude_volume_tags:
+                if tag['Key'] == excluded_tag[0] and (len(excluded_tag) == 1 or tag['Value'] == excluded_tag[1]):
+                    return True
+        return False
+
+
+def attached_volumes(instance: dict) -> list:
+    """
+    The BlockDeviceMappings of the instance that are attached EBS volumes.
+    :param instance: An instance as returned by ec2:DescribeInstances
+    """
+    return [mapping for mapping in instance['BlockDeviceMappings']
+            if 'Ebs' in mapping and mapping['Ebs']['Status'] == 'attached']
+
+
+def volume_tags(ec2, volume_ids: list) -> dict:
+    """
+    Looks up the tags of the volumes in one call.
+    :param ec2: The EC2 client of the member account
+    :return: Volume ID to its list of tags
+    """
+    if not volume_ids:
+        return {}
+    response = ec2.describe_volumes(VolumeIds=volume_ids)
+    return {volume['VolumeId']: volume.get('Tags', []) for volume in response['Volumes']}
+
+
+def select(ec2, instance: dict, volume_filter: VolumeFilter) -> tuple:
+    """
+    Splits the attached volumes of the instance into the ones to capture and the excluded ones.
+    :param ec2: The EC2 client of the member account, used only when tags are filtered on
+    :param instance: An instance as returned by ec2:DescribeInstances
+    :param volume_filter: The exclusions
+    :return: (captured mappings, excluded mappings)
+    """
+    mappings = attached_volumes(instance)
+    tags = {}
+    if volume_filter.needs_volume_tags:
+        tags = volume_tags(ec2, [mapping['Ebs']['VolumeId'] for mapping in mappings])
+    captured, excluded = [], []
+    for mapping in mappings:
+        if volume_filter.excluded(mapping, instance.get('RootDeviceName'), tags.get(mapping['Ebs']['VolumeId'])):
+            excluded.append(mapping)
+        else:
+            captured.append(mapping)
+    return captured, excluded
@@ -16,66 +16,50 @@
  * SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 '''
 
-import boto3
-import os
-import uuid
-
-roleName = os.environ['ROLE_NAME']
 
-def lambda_handler(event, context):
-    try:
-        
-        event = event['DiskProcess']
-        
-        region = event['Region']
-        findingID = event['FindingID']
-        instanceID = event['InstanceID']
-        snap = event['CopiedSnapshotID']
+import os
+from forensic_common import copy_quota, lineage, log, metrics, polling, regions, sessions
+from forensic_common.handler import forensic_handler
 
-        client = boto3.client('sts')
+LOG = log.get_logger("checkCopySnapshot")
 
-        response = client.assume_role(
-            RoleArn='arn:{}:iam::{}:role/{}'.format(
-                os.environ.get("Partition", 'aws'),
-                event['AccountID'],
-                roleName
-            ),
-            RoleSessionName="{}-snapshot-status-check".format(
-                instanceID
-            )
-        )
 
-        session = boto3.Session(
-            aws_access_key_id=response['Credentials']['AccessKeyId'],
-            aws_secret_access_key=response['Credentials']['SecretAccessKey'],
-            aws_session_token=response['Credentials']['SessionToken']
-        )
+@forensic_handler("checkCopySnapshot")
+def lambda_handler(event, context):
+    roleName = os.environ['ROLE_NAME']
+    region = regions.snapshot_copy_region(event)
+    instanceID = event['InstanceID']
+    snap = event['CopiedSnapshotID']
 
-        ec2 = session.client('ec2', region_name=region)
+    ec2 = sessions.member_ec2_client(event['AccountID'], roleName, region,
+                                     session_name="{}-snapshot-status-check".format(instanceID))
+    LOG.debug("Session cache", **sessions.cache_stats())
 
-        print("Checking Status for snapshots {} in region {}".format(
-            snap,
-            region
-        ))
+    LOG.poll(snap, "Checking status of snapshot copy", SnapshotId=snap, Region=region)
 
-        response = ec2.describe_snapshots(
-            SnapshotIds=[snap]
-        )
+    response = ec2.describe_snapshots(
+        SnapshotIds=[snap]
+    )
 
-        for item in response['Snapshots']:
-            if item['State'] == 'pending':
-                raise RuntimeError("Snapshots not finished")
-            elif item['State'] == 'error':
-                raise Exception("Snapshot {} errored".format(
-                    item['SnapshotId']
-                ))
+    for item in response['Snapshots']:
+        if item['State'] == 'error':
+            copy_quota.finish(copy_quota.destination(event['AccountID'], region, event['Region']),
+                              event.pop('CopyLease', None))
+            raise Exception("Snapshot {} errored".format(
+                item['SnapshotId']
+            ))
 
-        print("Snaps have completed")
+    pendingSnapshots = [item for item in response['Snapshots'] if item['State'] == 'pending']
+    if pendingSnapshots:
+        return polling.pending(event, pendingSnapshots)
 
-        return event
+    LOG.info("Snapshot copy has completed", SnapshotId=snap)
+    copy_quota.finish(copy_quota.destination(event['AccountID'], region, event['Region']),
+                      event.pop('CopyLease', None))
+    metrics.emit_snapshot_times("checkCopySnapshot", event, response['Snapshots'], 'CopyTime',
+                                {'CopiesWithLineageBase': (1 if event.get('LineageBase') else 0, 'Count')})
+    # Only a completed copy can be reused by a later capture
+    lineage.record(lineage.COPY, event['AccountID'], event['SourceVolumeID'], event['SourceSnapshotID'], snap,
+                   os.environ['KMS_KEY'], region)
 
-    except Exception as e:
-        print("Received error while processing createSnapshot request.  {}".format(
-            repr(e)
-        ))
-        raise
+    return polling.completed(event)
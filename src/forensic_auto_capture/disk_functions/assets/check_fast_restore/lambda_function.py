@@ -0,0 +1,48 @@
+'''
+ * Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+ * SPDX-License-Identifier: MIT-0
+ *
+ * Permission is hereby granted, free of charge, to any person obtaining a copy of this
+ * software and associated documentation files (the "Software"), to deal in the Software
+ * without restriction, including without limitation the rights to use, copy, modify,
+ * merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+ * permit persons to whom the Software is furnished to do so.
+ *
+ * THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+ * INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+ * PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+ * HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+ * OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+ * SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+'''
+from forensic_common import clients, fast_restore, log, metrics
+from forensic_common.handler import forensic_handler
+
+LOG = log.get_logger("checkFastRestore")
+
+
+@forensic_handler("checkFastRestore")
+def lambda_handler(event, context):
+    fastRestore = event.get('FastRestore')
+    if not fastRestore or fastRestore['State'] != fast_restore.ENABLING:
+        return event
+    snap = event['FinalCopiedSnapshotID']
+    ec2 = clients.client('ec2')
+
+    state = fast_restore.ec2_state(ec2, snap, fastRestore['AvailabilityZone'])
+    waited = fast_restore.waited_seconds(fastRestore)
+    if state == 'enabled':
+        LOG.info("Fast snapshot restore enabled", SnapshotId=snap, WaitedSeconds=waited)
+        event['FastRestore'] = dict(fastRestore, State=fast_restore.ENABLED)
+        metrics.emit("checkFastRestore", event, {'FastRestoreWaitTime': (waited, 'Seconds')})
+        return event
+    if state in fast_restore.EC2_PENDING_STATES and waited < fast_restore.max_wait_seconds():
+        LOG.poll(event['IncidentID'], "Fast snapshot restore pending", SnapshotId=snap, State=state)
+        raise RuntimeError("Fast snapshot restore of {} is {}".format(snap, state))
+
+    # Not worth waiting for any longer, the volume is created without it
+    LOG.warning("Creating the volume without fast snapshot restore", SnapshotId=snap, State=state,
+                WaitedSeconds=waited)
+    fastRestore = fast_restore.disable(ec2, snap, fastRestore)
+    event['FastRestore'] = dict(fastRestore, State=fast_restore.SKIPPED, Reason="Was {}".format(state))
+    return event
@@ -16,77 +16,49 @@
  * SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 '''
 
-import boto3
-import os
-import uuid
+
 import json
+import os
+from forensic_common import claim_check, clients, log, metrics, polling, sessions
+from forensic_common.handler import forensic_handler
 
-roleName = os.environ['ROLE_NAME']
+LOG = log.get_logger("checkSnapshot")
 
+
+@forensic_handler("checkSnapshot")
 def lambda_handler(event, context):
-    try:
-        
-        event = event['DiskProcess']
-        
-        instanceID = event['Resource']['Id']
-        region = event['Resource']['Region']
-        findingID = event['FindingId']
-        snaps = []
-        
-        for snapshotID in event['CapturedSnapshots']:
-            snaps.append(snapshotID['SourceSnapshotID'])
+    roleName = os.environ['ROLE_NAME']
+    instanceID = event['Resource']['Id']
+    region = event['Resource']['Region']
+    snaps = [snapshot['SourceSnapshotID'] for snapshot in event['CapturedSnapshots']]
+
+    ec2 = sessions.member_ec2_client(event['AwsAccountId'], roleName, region,
+                                     session_name="{}-snapshot-status-check".format(instanceID))
+    LOG.debug("Session cache", **sessions.cache_stats())
 
-        client = boto3.client('sts')
-        s3 = boto3.client('s3')
+    LOG.poll(event['IncidentID'], "Checking status of snapshots", SnapshotIds=snaps, Region=region)
 
-        response = client.assume_role(
-            RoleArn='arn:{}:iam::{}:role/{}'.format(
-                os.environ.get("Partition", 'aws'),
-                event['AwsAccountId'],
-                roleName
-            ),
-            RoleSessionName="{}-snapshot-status-check".format(
-                instanceID
-            )
-        )
+    response = ec2.describe_snapshots(
+        SnapshotIds=snaps
+    )
 
-        session = boto3.Session(
-            aws_access_key_id=response['Credentials']['AccessKeyId'],
-            aws_secret_access_key=response['Credentials']['SecretAccessKey'],
-            aws_session_token=response['Credentials']['SessionToken']
-        )
+    for item in response['Snapshots']:
+        if item['State'] == 'error':
+            raise Exception("Snapshot {} errored".format(
+                item['SnapshotId']
+            ))
 
-        ec2 = session.client('ec2', region_name=region)
+    pendingSnapshots = [item for item in response['Snapshots'] if item['State'] == 'pending']
+    if pendingSnapshots:
+        return polling.pending(event, pendingSnapshots)
 
-        print("Checking Status for snapshots {} in region {}".format(
-            snaps,
-            region
-        ))
+    LOG.info("Snapshots have completed", SnapshotIds=snaps)
+    metrics.emit_snapshot_times("checkSnapshot", event, response['Snapshots'], 'SnapshotCreationTime')
 
-        response = ec2.describe_snapshots(
-            SnapshotIds=snaps
-        )
-        
-        for item in response['Snapshots']:
-            if item['State'] == 'pending':
-                raise RuntimeError("Snapshots not finished")
-            elif item['State'] == 'error':
-                raise Exception("Snapshot {} errored".format(
-                    item['SnapshotId']
-                ))
-        
-        print("Snaps have completed")
-        
-        obj = s3.put_object(
-            Body=json.dumps(event),
-            Bucket=event['EvidenceBucket'],
-            Key=event['IncidentID']+'/'+'ParentEvent.json',
-        )
-        
-        return event
+    clients.client('s3').put_object(
+        Body=json.dumps(claim_check.expand(event)),
+        Bucket=event['EvidenceBucket'],
+        Key=event['IncidentID'] + '/' + 'ParentEvent.json',
+    )
 
-    except Exception as e:
-        print("Received error while processing createSnapshot request.  {}".format(
-            repr(e)
-        ))
-        raise
\ No newline at end of file
+    return polling.completed(event)
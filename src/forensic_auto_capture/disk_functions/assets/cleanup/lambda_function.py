@@ -0,0 +1,61 @@
+'''
+ * Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+ * SPDX-License-Identifier: MIT-0
+ *
+ * Permission is hereby granted, free of charge, to any person obtaining a copy of this
+ * software and associated documentation files (the "Software"), to deal in the Software
+ * without restriction, including without limitation the rights to use, copy, modify,
+ * merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+ * permit persons to whom the Software is furnished to do so.
+ *
+ * THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+ * INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+ * PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+ * HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+ * OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+ * SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+'''
+import os
+from forensic_common import clients, instrumentation, log, metrics, retention
+
+LOG = log.get_logger("cleanup")
+
+
+@instrumentation.instrumented("cleanup")
+def lambda_handler(event, context):
+    """
+    Deletes the snapshots and volumes of the captures whose image is verified, apart from what the retention
+    policy keeps.  Invoked by the S3 notification of a collection log, for that one volume, or on a schedule,
+    for every capture with resources left in this account.  With DryRun in the event, or DRY_RUN set to
+    "true", nothing is deleted and the report only tells what would be.
+    """
+    roleName = os.environ['ROLE_NAME']
+    bucket = os.environ['EVIDENCE_BUCKET']
+    dryRun = event.get('DryRun', os.environ.get('DRY_RUN', '').lower() == 'true')
+    s3 = clients.client('s3')
+
+    if 'Records' in event:
+        captures = {retention.capture_of_key(record['s3']['object']['key']) for record in event['Records']}
+        captures.discard(None)
+    else:
+        captures = retention.swept_captures(clients.client('ec2'))
+    LOG.info("Cleaning up captures", Captures=len(captures), DryRun=dryRun)
+
+    report = []
+    for incidentID, volumeID in sorted(captures):
+        try:
+            report.extend(retention.clean(s3, bucket, incidentID, volumeID, roleName, dryRun))
+        except Exception as e:
+            # One capture that cannot be read should not hold up the others
+            LOG.error("Could not clean up capture", IncidentId=incidentID, VolumeId=volumeID, Error=repr(e))
+
+    actions = [entry['Action'] for entry in report]
+    key = retention.write_report(s3, bucket, report, dryRun)
+    LOG.info("Cleanup report written", Bucket=bucket, Key=key, DryRun=dryRun,
+             **{action.capitalize(): actions.count(action) for action in ('delete', 'keep', 'gone', 'failed')})
+    metrics.emit("cleanup", {}, {
+        'ResourcesDeleted': (0 if dryRun else actions.count('delete'), 'Count'),
+        'ResourcesKept': (actions.count('keep'), 'Count'),
+        'ResourcesFailed': (actions.count('failed'), 'Count'),
+    }, DryRun=dryRun)
+    return {'Report': key, 'DryRun': dryRun}
@@ -16,96 +16,58 @@
  * SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 '''
 
-import boto3
+
 import os
-import uuid
+from forensic_common import copy_quota, lineage, log, metrics, regions, sessions, tagging
+from forensic_common.handler import forensic_handler
+
+LOG = log.get_logger("copySnapshot")
 
-roleName = os.environ['ROLE_NAME']
-encryptionKey = os.environ['KMS_KEY']
 
+@forensic_handler("copySnapshot")
 def lambda_handler(event, context):
-    try:
+    roleName = os.environ['ROLE_NAME']
+    encryptionKey = os.environ['KMS_KEY']
+    region = event['Region']
+    findingID = event['FindingID']
+    instanceID = event['InstanceID']
+    snap = event['SourceSnapshotID']
+    copyRegion = regions.copy_region(region)
 
-        event = event['DiskProcess']
-        
-        region = event['Region']
-        findingID = event['FindingID']
-        instanceID = event['InstanceID']
-        snap = event['SourceSnapshotID']
-        updatedEvent = event
+    ec2 = sessions.member_ec2_client(event['AccountID'], roleName, copyRegion,
+                                     session_name="{}-{}-snapshot-copy".format(instanceID, snap))
+    LOG.debug("Session cache", **sessions.cache_stats())
 
-        client = boto3.client('sts')
+    base = lineage.base(ec2, lineage.COPY, event['AccountID'], event['SourceVolumeID'], copyRegion, encryptionKey)
+    event['EncryptionKey'] = encryptionKey
+    event['CopyRegion'] = copyRegion
+    if base and base['SourceSnapshotId'] == snap:
+        LOG.info("Reusing the copy of the snapshot", SnapshotId=snap, CopiedSnapshotId=base['SnapshotId'])
+        metrics.emit("copySnapshot", event, {'CopiesReused': (1, 'Count')})
+        event['CopiedSnapshotID'] = base['SnapshotId']
+        return event
 
-        response = client.assume_role(
-            RoleArn='arn:{}:iam::{}:role/{}'.format(
-                os.environ.get("Partition", 'aws'),
-                event['AccountID'],
-                roleName
-            ),
-            RoleSessionName="{}-{}-snapshot-copy".format(
-                instanceID,
-                snap
-            )
-        )
-        print("assume role")
-        print(response)
-        session = boto3.Session(
-            aws_access_key_id=response['Credentials']['AccessKeyId'],
-            aws_secret_access_key=response['Credentials']['SecretAccessKey'],
-            aws_session_token=response['Credentials']['SessionToken']
-        )
-
-        ec2 = session.client('ec2', region_name=region)
-
-        print("Copying snapshot {} in region {}".format(
-            snap,
-            region
-        ))
+    event['LineageBase'] = base['SnapshotId'] if base else None
+    event['EstimatedCopySeconds'] = regions.transfer_seconds(event.get('VolumeSize'), region, copyRegion)
+    LOG.info("Copying snapshot", SnapshotId=snap, Region=region, CopyRegion=copyRegion,
+             LineageBase=event['LineageBase'], EstimatedCopySeconds=event['EstimatedCopySeconds'])
 
+    with copy_quota.admitted(copy_quota.destination(event['AccountID'], copyRegion, region), snap,
+                             source_region=region) as lease:
         response = ec2.copy_snapshot(
             Description="Forensic Copy Automated Snapshot creation: {}".format(findingID),
             Encrypted=True,
             KmsKeyId=encryptionKey,
             SourceRegion=region,
             SourceSnapshotId=snap,
-            TagSpecifications=[
-                {
-                    'ResourceType': 'snapshot',
-                    'Tags': [
-                        {
-                            'Key': 'Name',
-                            'Value': 'Forensic Copy Automated Snapshot creation'
-                        },
-                        {
-                            'Key': 'InstanceID',
-                            'Value': event['InstanceID']
-                        },
-                        {
-                            'Key': 'VolumeID',
-                            'Value': event['SourceVolumeID']
-                        },
-                        {
-                            'Key': 'FindingID',
-                            'Value': event['FindingID']
-                        },
-                        {
-                            'Key': 'SourceDeviceName',
-                            'Value': event['SourceDeviceName']
-                        }
-                    ]
-                }
-            ]
+            TagSpecifications=tagging.volume_tag_specifications('snapshot',
+                                                                'Forensic Copy Automated Snapshot creation', event)
         )
-        
-        print(response)
-        
-        updatedEvent['CopiedSnapshotID'] = response['SnapshotId']
-        updatedEvent['EncryptionKey'] = encryptionKey
 
-        return updatedEvent
+    LOG.debug("CopySnapshot response", Response=response)
+
+    event['CopiedSnapshotID'] = response['SnapshotId']
+    if lease:
+        event['CopyLease'] = lease
 
-    except Exception as e:
-        print("Received error while processing createSnapshot request.  {}".format(
-            repr(e)
-        ))
-        raise
+    return event
@@ -16,162 +16,93 @@
  * SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 '''
 
-import boto3
-import os
-import uuid
-import time
-import json
-
-roleName = os.environ['ROLE_NAME']
-evidenceBucket = os.environ['EVIDENCE_BUCKET']
-logGroup = os.environ['LOG_GROUP']
-
-def lambda_handler(event, context):
-    try:
-        event = event['DiskProcess']
-
-        instanceID = event['Resource']['Id']
-        region = event['Resource']['Region']
-        findingID = event['FindingId']
-        incidentID = event['FindingId'].split('finding/')[1]
-        event['EvidenceBucket'] = evidenceBucket
-        event['IncidentID'] = incidentID
-
-        client = boto3.client('sts')
-
-        response = client.assume_role(
-            RoleArn='arn:{}:iam::{}:role/{}'.format(
-                os.environ.get("Partition", 'aws'),
-                event['AwsAccountId'],
-                roleName
-            ),
-            RoleSessionName="{}-snapshot-creation".format(
-                instanceID
-            )
-        )
-
-        session = boto3.Session(
-            aws_access_key_id=response['Credentials']['AccessKeyId'],
-            aws_secret_access_key=response['Credentials']['SecretAccessKey'],
-            aws_session_token=response['Credentials']['SessionToken']
-        )
-
-        ec2 = session.client('ec2', region_name=region)
-
-        print("Received request to create snapshots for instance {} in region {}".format(
-            instanceID,
-            region
-        ))
-
-        response = ec2.describe_instances(
-            InstanceIds=[instanceID]
-        )
 
-        Output = event
-        Output['CapturedSnapshots'] = []
-
-        ######## If looking for simplicity and the least amount of API calls, consider using createSnapshots API. If additional filtering is required, use the iterative approach below ########
-        #snaps = ec2.create_snapshots(
-        #    Description="Automated Snapshot creation: {}".format(findingID),
-        #    InstanceSpecification={
-        #        'InstanceId': instanceID,
-        #        'ExcludeBootVolume': False
-        #    }
-        #)
-
-        #for snap in snaps['Snapshots']:
-        #    Output['CapturedSnapshots'].append({'SourceSnapshotID': snap['SnapshotId'], 'SourceVolumeID': snap['VolumeId'], 'VolumeSize': snap['VolumeSize'], 'InstanceID': instanceID, 'FindingID': findingID, 'AccountID': event['AwsAccountId'], 'Region': region})
-
-
-        for res in response['Reservations']:
-            for item in res['Instances']:
-                for vol in item['BlockDeviceMappings']:
-                    if vol['Ebs']['Status'] == 'attached':
-                        # create snapshot
-                        print("Initiating snapshot creation for volume {} on instance {} in region {}".format(
-                            vol['Ebs']['VolumeId'],
-                            instanceID,
-                            region
-                        ))
-
-                        snap = ec2.create_snapshot(
-                            Description="Automated Snapshot creation: {}".format(findingID),
-                            VolumeId=vol['Ebs']['VolumeId'],
-                            TagSpecifications=[
-                                {
-                                    'ResourceType': 'snapshot',
-                                    'Tags': [
-                                        {
-                                            'Key': 'Name',
-                                            'Value': 'Forensic Automated Snapshot creation'
-                                        },
-                                        {
-                                            'Key': 'InstanceID',
-                                            'Value': instanceID
-                                        },
-                                        {
-                                            'Key': 'VolumeID',
-                                            'Value': vol['Ebs']['VolumeId']
-                                        },
-                                        {
-                                            'Key': 'FindingID',
-                                            'Value': findingID
-                                        },
-                                        {
-                                            'Key': 'SourceDeviceName',
-                                            'Value': vol['DeviceName']
-                                        }
-                                    ]
-                                }
-                            ]
-                        )
-
-                        Output['CapturedSnapshots'].append({'SourceSnapshotID': snap['SnapshotId'], 'SourceVolumeID': snap['VolumeId'], 'SourceDeviceName': vol['DeviceName'], 'VolumeSize': snap['VolumeSize'], 'InstanceID': instanceID, 'FindingID': findingID, 'IncidentID': incidentID, 'AccountID': event['AwsAccountId'], 'Region': region, 'EvidenceBucket': evidenceBucket})
-
-        writeToCW(Output)
-
-        return Output
-
-    except Exception as e:
-        print("Received error while processing createSnapshot request.  {}".format(
-            repr(e)
-        ))
-        raise
+import os
+from forensic_common import audit, claim_check, events, log, metrics, sessions, snapshots
+from forensic_common.handler import forensic_handler
 
-def writeToCW(logEvent):
+LOG = log.get_logger("createSnapshot")
 
-    logs = boto3.client('logs')
 
-    try:
-       logs.create_log_stream(logGroupName=logGroup, logStreamName=logEvent['IncidentID'])
-    except logs.exceptions.ResourceAlreadyExistsException:
-       pass
+def capturedSnapshot(event, snap):
+    """
+    Builds the CapturedSnapshots element, the input of one ProcessSnaps Map iteration, of a started snapshot.
+    """
+    captured = {'SourceSnapshotID': snap['SnapshotId'], 'SourceVolumeID': snap['VolumeId'], 'SourceDeviceName': snap['DeviceName'], 'VolumeSize': snap['VolumeSize'], 'InstanceID': event['Resource']['Id'], 'FindingID': event['FindingId'], 'IncidentID': event['IncidentID'], 'AccountID': event['AwsAccountId'], 'Region': event['Resource']['Region'], 'EvidenceBucket': event['EvidenceBucket']}
+    if snap.get('GuardDutyScanId'):
+        captured['GuardDutyScanId'] = snap['GuardDutyScanId']
+    if claim_check.CONTEXT_REF in event:
+        captured[claim_check.CONTEXT_REF] = event[claim_check.CONTEXT_REF]
+    return captured
 
-    tokenresponse = logs.describe_log_streams(
-        logGroupName=logGroup,
-        logStreamNamePrefix=logEvent['IncidentID'],
-    )
 
-    if 'uploadSequenceToken' in tokenresponse['logStreams'][0]:
-        response = logs.put_log_events(
-            logGroupName=logGroup,
-            logStreamName=logEvent['IncidentID'],
-            logEvents=[
-                {
-                    'timestamp': int(round(time.time() * 1000)),
-                    'message': json.dumps(logEvent)
-                },
-            ],
-            sequenceToken=tokenresponse['logStreams'][0]['uploadSequenceToken']
-        )
+@forensic_handler("createSnapshot")
+def lambda_handler(event, context):
+    roleName = os.environ['ROLE_NAME']
+    evidenceBucket = os.environ['EVIDENCE_BUCKET']
+    logGroup = os.environ['LOG_GROUP']
+    instanceID = event['Resource']['Id']
+    region = event['Resource']['Region']
+    findingID = event['FindingId']
+    incidentID = events.incident_id(findingID)
+    event['EvidenceBucket'] = evidenceBucket
+    event['IncidentID'] = incidentID
+    # Executions started without an evidence bucket in the invoke function still carry the details
+    claim_check.offload(event, evidenceBucket)
+
+    LOG.info("Received request to create snapshots", InstanceID=instanceID, Region=region,
+             IncidentID=incidentID)
+
+    fastPath = snapshots.PRE_CAPTURED in event
+    if fastPath:
+        # The invoke function already started the snapshots (fast path)
+        started = event.pop(snapshots.PRE_CAPTURED)
+        LOG.info("Adopting snapshots started by the invoke function", InstanceID=instanceID,
+                 SnapshotIds=[snap['SnapshotId'] for snap in started['Snapshots']])
     else:
-        response = logs.put_log_events(
-            logGroupName=logGroup,
-            logStreamName=logEvent['IncidentID'],
-            logEvents=[
-                {
-                    'timestamp': int(round(time.time() * 1000)),
-                    'message': json.dumps(logEvent)
-                },
-            ]
-        )
+        ec2 = sessions.member_ec2_client(event['AwsAccountId'], roleName, region,
+                                         session_name="{}-snapshot-creation".format(instanceID))
+        LOG.debug("Session cache", **sessions.cache_stats())
+        started = snapshots.start_from_environment(ec2, instanceID, findingID, scan_id=event.get('MalwareScanId'))
+
+    for vol in started['ExcludedVolumes']:
+        LOG.info("Excluded volume from capture", VolumeId=vol['VolumeId'], DeviceName=vol['DeviceName'],
+                 InstanceID=instanceID)
+    for snap in started['Snapshots']:
+        if snap.get('GuardDutyScanId'):
+            LOG.info("Reusing GuardDuty Malware Protection snapshot", SnapshotId=snap['SnapshotId'],
+                     VolumeId=snap['VolumeId'], GuardDutyScanId=snap['GuardDutyScanId'])
+    for failure in started['FailedSnapshots']:
+        LOG.error("Snapshot creation failed", VolumeId=failure['SourceVolumeID'],
+                  DeviceName=failure['SourceDeviceName'], Error=failure['Error'])
+
+    Output = event
+    # Largest volumes first: the Map and the copy budget admit them first, which shortens the longest copy chain
+    Output['CapturedSnapshots'] = sorted([capturedSnapshot(event, snap) for snap in started['Snapshots']],
+                                         key=lambda captured: captured['VolumeSize'], reverse=True)
+    Output['FailedSnapshots'] = started['FailedSnapshots']
+    Output['SnapshotStartSkew'] = started['SnapshotStartSkew']
+    Output['AdoptedSnapshotAge'] = started['AdoptedSnapshotAge']
+    LOG.info("Snapshots started", SnapshotIds=[snap['SnapshotId'] for snap in started['Snapshots']],
+             Failed=len(Output['FailedSnapshots']), SnapshotStartSkew=Output['SnapshotStartSkew'],
+             AdoptedSnapshotAge=Output['AdoptedSnapshotAge'])
+
+    reusedSnapshots = sum(1 for snap in started['Snapshots'] if snap.get('GuardDutyScanId'))
+    snapshotMetrics = {
+        'SnapshotsStarted': (len(Output['CapturedSnapshots']), 'Count'),
+        'SnapshotsFailed': (len(Output['FailedSnapshots']), 'Count'),
+        'SnapshotsReused': (reusedSnapshots, 'Count'),
+        'SnapshotStartSkew': (Output['SnapshotStartSkew'], 'Seconds'),
+        'CapturedVolumeSize': (sum(snapshot['VolumeSize'] for snapshot in Output['CapturedSnapshots']), 'Gigabytes'),
+    }
+    if reusedSnapshots:
+        # Only the captures that adopted a malware scan snapshot have an age to report
+        snapshotMetrics['AdoptedSnapshotAge'] = (Output['AdoptedSnapshotAge'], 'Seconds')
+    metrics.emit("createSnapshot", Output, snapshotMetrics, FastPath=fastPath)
+
+    if Output['FailedSnapshots'] and not Output['CapturedSnapshots']:
+        raise Exception("No snapshot could be started for instance {}: {}".format(instanceID, Output['FailedSnapshots']))
+
+    audit.record(claim_check.expand(Output), log_group=logGroup)
+
+    return Output
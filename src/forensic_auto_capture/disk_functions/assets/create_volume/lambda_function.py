@@ -16,81 +16,38 @@
  * SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 '''
 
-import boto3
-import os
-import uuid
-import random
-import json
 
-encryptionKey = os.environ['KMS_KEY']
-availabilityZonesSuppported = os.environ['SUPPORTED_AZS']
+from forensic_common import clients, log, metrics, placement, volume_profile
+from forensic_common.handler import forensic_handler
 
+LOG = log.get_logger("createVolume")
+
+
+@forensic_handler("createVolume")
 def lambda_handler(event, context):
-    print(event)
-    try:
-        
-        event = event['DiskProcess']
-        
-        snap = event['FinalCopiedSnapshotID']
-        region = event['Region']
-        azList = json.loads(availabilityZonesSuppported)
-        
-        if event['VolumeSize'] >= 500:
-            volumeType = 'st1'
-        else:
-            volumeType = 'standard'
-        
-        updatedEvent = event
-        
-        ec2 = boto3.client('ec2')
-        
-        print("Creating forensic volume from snapshot {} in region {}".format(
-            snap,
-            region
-        ))
-        
-        response = ec2.create_volume(
-            AvailabilityZone=random.choice(azList),
-            SnapshotId=snap,
-            Encrypted=True,
-            KmsKeyId=encryptionKey,
-            VolumeType=volumeType,
-            TagSpecifications=[
-                {
-                    "ResourceType": "volume",
-                    "Tags": [
-                        {
-                            'Key': 'Name',
-                            'Value': event['InstanceID'] + "-" + event['SourceVolumeID']
-                        },
-                        {
-                            'Key': 'InstanceID',
-                            'Value': event['InstanceID']
-                        },
-                        {
-                            'Key': 'VolumeID',
-                            'Value': event['SourceVolumeID']
-                        },
-                        {
-                            'Key': 'FindingID',
-                            'Value': event['FindingID']
-                        },
-                        {
-                            'Key': 'SourceDeviceName',
-                            'Value': event['SourceDeviceName']
-                        }
-                    ]
-                }
-            ]
-        )
-        
-        updatedEvent['ForensicVolumeID'] = response['VolumeId']
-        updatedEvent['VolumeAZ'] = response['AvailabilityZone']
+    LOG.debug("Received event", Event=event)
+    snap = event['FinalCopiedSnapshotID']
+    region = event['Region']
+
+    profile = volume_profile.select(event['VolumeSize'])
+    if profile['CostCapped']:
+        LOG.warning("Forensic volume throughput lowered to the cost ceiling", VolumeSize=event['VolumeSize'],
+                    **profile)
+
+    ec2 = clients.client('ec2')
+
+    LOG.info("Creating forensic volume", SnapshotId=snap, Region=region, **profile)
+
+    # EnableFastRestore already picked the zone it enabled fast restore in
+    availabilityZone = event.get('VolumeAZ') or placement.choose_zone(ec2)
+    response = placement.create_volume(ec2, event, availabilityZone, volume_profile.create_volume_parameters(profile))
 
-        return updatedEvent
+    event['ForensicVolumeID'] = response['VolumeId']
+    event['VolumeAZ'] = response['AvailabilityZone']
+    event['VolumeProfile'] = profile
+    metrics.emit("createVolume", event, {
+        'ProvisionedThroughput': (profile['Throughput'], 'Megabytes/Second'),
+        'EstimatedImagingSeconds': (profile['ImagingSeconds'], 'Seconds'),
+    }, VolumeType=profile['VolumeType'])
 
-    except Exception as e:
-        print("Received error while processing createVolume request.  {}".format(
-            repr(e)
-        ))
-        raise
+    return event
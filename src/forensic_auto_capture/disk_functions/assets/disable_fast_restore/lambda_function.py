@@ -0,0 +1,34 @@
+'''
+ * Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+ * SPDX-License-Identifier: MIT-0
+ *
+ * Permission is hereby granted, free of charge, to any person obtaining a copy of this
+ * software and associated documentation files (the "Software"), to deal in the Software
+ * without restriction, including without limitation the rights to use, copy, modify,
+ * merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+ * permit persons to whom the Software is furnished to do so.
+ *
+ * THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+ * INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+ * PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+ * HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+ * OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+ * SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+'''
+from forensic_common import clients, fast_restore, log
+from forensic_common.handler import forensic_handler
+
+LOG = log.get_logger("disableFastRestore")
+
+
+@forensic_handler("disableFastRestore")
+def lambda_handler(event, context):
+    fastRestore = event.get('FastRestore')
+    if not fastRestore:
+        return event
+    snap = event['FinalCopiedSnapshotID']
+
+    event['FastRestore'] = fast_restore.disable(clients.client('ec2'), snap, fastRestore)
+    LOG.info("Fast snapshot restore disabled", SnapshotId=snap, **event['FastRestore'])
+
+    return event
@@ -0,0 +1,45 @@
+'''
+ * Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+ * SPDX-License-Identifier: MIT-0
+ *
+ * Permission is hereby granted, free of charge, to any person obtaining a copy of this
+ * software and associated documentation files (the "Software"), to deal in the Software
+ * without restriction, including without limitation the rights to use, copy, modify,
+ * merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+ * permit persons to whom the Software is furnished to do so.
+ *
+ * THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+ * INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+ * PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+ * HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+ * OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+ * SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+'''
+from forensic_common import clients, fast_restore, log, placement
+from forensic_common.handler import forensic_handler
+
+LOG = log.get_logger("enableFastRestore")
+
+
+@forensic_handler("enableFastRestore")
+def lambda_handler(event, context):
+    snap = event['FinalCopiedSnapshotID']
+    if not fast_restore.wanted(event['VolumeSize']):
+        LOG.debug("Volume below the fast restore size", SnapshotId=snap, VolumeSize=event['VolumeSize'])
+        return event
+    if not fast_restore.applies(event['VolumeSize']):
+        # Would not be ready before CheckFastRestore gives up on it
+        event['FastRestore'] = fast_restore.skip(event['VolumeSize'])
+        LOG.info("Skipping fast snapshot restore", SnapshotId=snap, VolumeSize=event['VolumeSize'],
+                 **event['FastRestore'])
+        return event
+
+    # CreateVolume creates the volume in the zone fast restore is enabled in
+    ec2 = clients.client('ec2')
+    availabilityZone = placement.choose_zone(ec2)
+    event['VolumeAZ'] = availabilityZone
+    event['FastRestore'] = fast_restore.enable(ec2, snap, availabilityZone)
+    LOG.info("Enabling fast snapshot restore", SnapshotId=snap, VolumeSize=event['VolumeSize'],
+             **event['FastRestore'])
+
+    return event
@@ -0,0 +1,34 @@
+'''
+ * Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+ * SPDX-License-Identifier: MIT-0
+ *
+ * Permission is hereby granted, free of charge, to any person obtaining a copy of this
+ * software and associated documentation files (the "Software"), to deal in the Software
+ * without restriction, including without limitation the rights to use, copy, modify,
+ * merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+ * permit persons to whom the Software is furnished to do so.
+ *
+ * THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+ * INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+ * PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+ * HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+ * OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+ * SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+'''
+from forensic_common import callbacks, copy_quota, log
+from forensic_common.handler import forensic_handler
+
+LOG = log.get_logger("failureCleanup")
+
+
+@forensic_handler("failureCleanup")
+def lambda_handler(event, context):
+    """
+    Gives back what a failed capture still holds, before the error alert: the leases of its copies, which
+    the check stages would have released, and the task tokens registered on its snapshots.
+    """
+    released = copy_quota.release_held(event)
+    removed = callbacks.forget(event)
+    LOG.info("Cleaned up the failed capture", Leases=released, Registrations=removed,
+             IncidentID=event.get('IncidentID'), SourceVolumeID=event.get('SourceVolumeID'))
+    return event
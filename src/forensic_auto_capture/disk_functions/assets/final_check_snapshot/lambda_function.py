@@ -16,45 +16,44 @@
  * SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 '''
 
-import boto3
+
 import os
-import uuid
+from forensic_common import clients, copy_quota, lineage, log, metrics, polling
+from forensic_common.handler import forensic_handler
+
+LOG = log.get_logger("finalCheckSnapshot")
+
 
+@forensic_handler("finalCheckSnapshot")
 def lambda_handler(event, context):
-    try:
-        
-        event = event['DiskProcess']
-        
-        region = event['Region']
-        findingID = event['FindingID']
-        instanceID = event['InstanceID']
-        snap = event['FinalCopiedSnapshotID']
-
-        ec2 = boto3.client('ec2')
-
-        print("Checking Status for snapshot {} in region {}".format(
-            snap,
-            region
-        ))
-
-        response = ec2.describe_snapshots(
-            SnapshotIds=[snap]
-        )
-
-        for item in response['Snapshots']:
-            if item['State'] == 'pending':
-                raise RuntimeError("Snapshots not finished")
-            elif item['State'] == 'error':
-                raise Exception("Snapshot {} errored".format(
-                    item['SnapshotId']
-                ))
-
-        print("Snaps have completed")
-
-        return event
-
-    except Exception as e:
-        print("Received error while processing createSnapshot request.  {}".format(
-            repr(e)
-        ))
-        raise
+    region = event['Region']
+    snap = event['FinalCopiedSnapshotID']
+
+    ec2 = clients.client('ec2')
+
+    LOG.poll(snap, "Checking status of final snapshot copy", SnapshotId=snap, Region=region)
+
+    response = ec2.describe_snapshots(
+        SnapshotIds=[snap]
+    )
+
+    for item in response['Snapshots']:
+        if item['State'] == 'error':
+            copy_quota.finish(copy_quota.own_destination(ec2.meta.region_name), event.pop('FinalCopyLease', None))
+            raise Exception("Snapshot {} errored".format(
+                item['SnapshotId']
+            ))
+
+    pendingSnapshots = [item for item in response['Snapshots'] if item['State'] == 'pending']
+    if pendingSnapshots:
+        return polling.pending(event, pendingSnapshots)
+
+    LOG.info("Final snapshot copy has completed", SnapshotId=snap)
+    copy_quota.finish(copy_quota.own_destination(ec2.meta.region_name), event.pop('FinalCopyLease', None))
+    metrics.emit_snapshot_times("finalCheckSnapshot", event, response['Snapshots'], 'FinalCopyTime',
+                                {'CopiesWithLineageBase': (1 if event.get('LineageBase') else 0, 'Count')})
+    # Only a completed copy can be reused by a later capture
+    lineage.record(lineage.FINAL_COPY, event['AccountID'], event['SourceVolumeID'], event['CopiedSnapshotID'], snap,
+                   os.environ['KMS_KEY'], ec2.meta.region_name)
+
+    return polling.completed(event)
@@ -16,71 +16,49 @@
  * SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 '''
 
-import boto3
+
 import os
-import uuid
+from forensic_common import clients, copy_quota, lineage, log, metrics, regions, tagging
+from forensic_common.handler import forensic_handler
+
+LOG = log.get_logger("finalCopySnapshot")
 
-encryptionKey = os.environ['KMS_KEY']
 
+@forensic_handler("finalCopySnapshot")
 def lambda_handler(event, context):
-    try:
-        
-        event = event['DiskProcess']
-        
-        region = event['Region']
-        findingID = event['FindingID']
-        instanceID = event['InstanceID']
-        snap = event['CopiedSnapshotID']
-        updatedEvent = event
+    encryptionKey = os.environ['KMS_KEY']
+    region = regions.snapshot_copy_region(event)
+    findingID = event['FindingID']
+    snap = event['CopiedSnapshotID']
 
-        ec2 = boto3.client('ec2')
+    ec2 = clients.client('ec2')
 
-        print("Copying snapshot {} in region {}".format(
-            snap,
-            region
-        ))
+    base = lineage.base(ec2, lineage.FINAL_COPY, event['AccountID'], event['SourceVolumeID'], ec2.meta.region_name,
+                        encryptionKey)
+    if base and base['SourceSnapshotId'] == snap:
+        LOG.info("Reusing the final copy of the snapshot", SnapshotId=snap, FinalCopiedSnapshotId=base['SnapshotId'])
+        metrics.emit("finalCopySnapshot", event, {'CopiesReused': (1, 'Count')})
+        event['FinalCopiedSnapshotID'] = base['SnapshotId']
+        return event
 
+    event['LineageBase'] = base['SnapshotId'] if base else None
+    event['EstimatedCopySeconds'] = regions.transfer_seconds(event.get('VolumeSize'), region, ec2.meta.region_name)
+    LOG.info("Copying snapshot", SnapshotId=snap, Region=region, LineageBase=event['LineageBase'],
+             EstimatedCopySeconds=event['EstimatedCopySeconds'])
+
+    with copy_quota.admitted(copy_quota.own_destination(ec2.meta.region_name), snap) as lease:
         response = ec2.copy_snapshot(
             Description="Final Forensic Copy creation: {}".format(findingID),
             Encrypted=True,
             KmsKeyId=encryptionKey,
             SourceRegion=region,
             SourceSnapshotId=snap,
-            TagSpecifications=[
-                {
-                    'ResourceType': 'snapshot',
-                    'Tags': [
-                        {
-                            'Key': 'Name',
-                            'Value': 'Forensic Copy Automated Snapshot creation'
-                        },
-                        {
-                            'Key': 'InstanceID',
-                            'Value': event['InstanceID']
-                        },
-                        {
-                            'Key': 'VolumeID',
-                            'Value': event['SourceVolumeID']
-                        },
-                        {
-                            'Key': 'FindingID',
-                            'Value': event['FindingID']
-                        },
-                        {
-                            'Key': 'SourceDeviceName',
-                            'Value': event['SourceDeviceName']
-                        }
-                    ]
-                }
-            ]
+            TagSpecifications=tagging.volume_tag_specifications('snapshot',
+                                                                'Forensic Copy Automated Snapshot creation', event)
         )
 
-        updatedEvent['FinalCopiedSnapshotID'] = response['SnapshotId']
-
-        return updatedEvent
+    event['FinalCopiedSnapshotID'] = response['SnapshotId']
+    if lease:
+        event['FinalCopyLease'] = lease
 
-    except Exception as e:
-        print("Received error while processing createSnapshot request.  {}".format(
-            repr(e)
-        ))
-        raise
\ No newline at end of file
+    return event
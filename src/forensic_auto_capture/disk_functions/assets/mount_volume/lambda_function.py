@@ -16,115 +16,63 @@
  * SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 '''
 
-import boto3
+
+import json
 import os
-import uuid
 import time
-import json
-from datetime import datetime, timedelta
-import logging
+from forensic_common import audit, clients, log, metrics
+from forensic_common.handler import forensic_handler
 
-LOGGER = logging.getLogger(__name__)
-LOGGER.setLevel(logging.DEBUG)
+LOG = log.get_logger("mountVolume")
 
 
+@forensic_handler("mountVolume")
 def lambda_handler(event, context):
-    LOGGER.info(event)
     logGroup = os.environ['LOG_GROUP']
     readiness_log_group = os.environ['READINESS_LOG_GROUP']
-    print(event)
-    try:
-
-        event = event['DiskProcess']
-
-        updatedEvent = event
-
-        logs = boto3.client('logs')
-        ec2 = boto3.client('ec2')
-        s3 = boto3.client('s3')
-
-        LOGGER.info(
-            f"Checking to see if instance {event['ForensicInstances'][0]} is ready to mount volume {event['ForensicVolumeID']}")
-        LOGGER.info(
-            f"Fetching Logs from log group {readiness_log_group} and log stream {event['ForensicInstances'][0]}")
-
-        # TODO - I had to switch startFromHead to True so that this would find the log
-        incronStatus = logs.get_log_events(
-            logGroupName=readiness_log_group,
-            logStreamName=event['ForensicInstances'][0],
-            startFromHead=True
-        )
+    LOG.debug("Received event", Event=event)
 
-        if incronStatus['events'][0]['message'] == 'incron is running':
-            LOGGER.info(f"Mounting volume {event['ForensicVolumeID']} on  instance {event['ForensicInstances'][0]}")
+    logs = clients.client('logs')
+    ec2 = clients.client('ec2')
+    s3 = clients.client('s3')
 
-            vol = ec2.attach_volume(
-                Device='/dev/sdf',
-                InstanceId=event['ForensicInstances'][0],
-                VolumeId=event['ForensicVolumeID']
-            )
-            LOGGER.info(f"Volume Mounted")
-            key = event['IncidentID'] + '/' + 'disk_evidence/' + event['SourceVolumeID'] + '.processedResources.json'
-            LOGGER.info(f"Writing the event to bucket {event['EvidenceBucket']} with key {key}")
-            obj = s3.put_object(
-                Body=json.dumps(event),
-                Bucket=event['EvidenceBucket'],
-                Key=key,
-            )
+    LOG.poll(event['ForensicInstances'][0], "Checking if the instance is ready to mount the volume",
+             InstanceId=event['ForensicInstances'][0], ForensicVolumeID=event['ForensicVolumeID'],
+             LogGroup=readiness_log_group)
 
-            writeToCW(updatedEvent, logGroup=logGroup)
-
-        else:
-            raise RuntimeError("incron is not ready on instance {}.".format(
-                event['ForensicInstances'][0]
-            ))
-
-        return updatedEvent
+    # TODO - I had to switch startFromHead to True so that this would find the log
+    incronStatus = logs.get_log_events(
+        logGroupName=readiness_log_group,
+        logStreamName=event['ForensicInstances'][0],
+        startFromHead=True
+    )
 
-    except Exception as e:
-        print("Received error while processing runInstances request.  {}".format(
-            repr(e)
+    if incronStatus['events'][0]['message'] != 'incron is running':
+        raise RuntimeError("incron is not ready on instance {}.".format(
+            event['ForensicInstances'][0]
         ))
-        raise
-
 
-def writeToCW(logEvent, logGroup):
-    logs = boto3.client('logs')
-
-    try:
-        LOGGER.info(f"For log group {logGroup}, creating log stream  {logEvent['IncidentID']}")
-        logs.create_log_stream(logGroupName=logGroup, logStreamName=logEvent['IncidentID'])
-    except logs.exceptions.ResourceAlreadyExistsException:
-        LOGGER.info("The log already existed, so can move on.")
-        pass
-
-    tokenresponse = logs.describe_log_streams(
-        logGroupName=logGroup,
-        logStreamNamePrefix=logEvent['IncidentID'],
+    LOG.info("Mounting volume", ForensicVolumeID=event['ForensicVolumeID'], InstanceId=event['ForensicInstances'][0])
+    ec2.attach_volume(
+        Device='/dev/sdf',
+        InstanceId=event['ForensicInstances'][0],
+        VolumeId=event['ForensicVolumeID']
     )
-    LOGGER.info(f"Writing to log Group {logGroup} and log stream {logEvent['IncidentID']}")
-    if 'uploadSequenceToken' in tokenresponse['logStreams'][0]:
-        LOGGER.info("uploadSequenceToken was found, so writing with sequenceToken")
-        response = logs.put_log_events(
-            logGroupName=logGroup,
-            logStreamName=logEvent['IncidentID'],
-            logEvents=[
-                {
-                    'timestamp': int(round(time.time() * 1000)),
-                    'message': json.dumps(logEvent)
-                },
-            ],
-            sequenceToken=tokenresponse['logStreams'][0]['uploadSequenceToken']
-        )
-    else:
+    LOG.info("Volume mounted", ForensicVolumeID=event['ForensicVolumeID'])
+    if 'RunInstanceTime' in event:
+        metrics.emit("mountVolume", event, {
+            'RunInstanceToMountTime': (time.time() - event['RunInstanceTime'], 'Seconds')
+        })
+
+    key = event['IncidentID'] + '/' + 'disk_evidence/' + event['SourceVolumeID'] + '.processedResources.json'
+    LOG.info("Writing the event to the evidence bucket", Bucket=event['EvidenceBucket'], Key=key)
+    s3.put_object(
+        Body=json.dumps(event),
+        Bucket=event['EvidenceBucket'],
+        Key=key,
+    )
+
+    LOG.debug("Recording the event in the audit log", LogGroup=logGroup, LogStream=event['IncidentID'])
+    audit.record(event, log_group=logGroup)
 
-        response = logs.put_log_events(
-            logGroupName=logGroup,
-            logStreamName=logEvent['IncidentID'],
-            logEvents=[
-                {
-                    'timestamp': int(round(time.time() * 1000)),
-                    'message': json.dumps(logEvent)
-                },
-            ]
-        )
+    return event
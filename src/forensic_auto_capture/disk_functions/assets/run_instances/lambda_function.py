@@ -16,16 +16,17 @@
  * SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 '''
 
-import boto3
+
 import os
-import uuid
-import random
-import json
-import logging
+import time
+from botocore.exceptions import ClientError
+from forensic_common import clients, log, metrics, placement, tagging
+from forensic_common.handler import forensic_handler
+
+LOG = log.get_logger("runInstances")
 
-LOGGER = logging.getLogger(__name__)
-LOGGER.setLevel(logging.DEBUG)
 
+@forensic_handler("runInstances")
 def lambda_handler(event, context):
     amiID = os.environ['AMI_ID']
     instanceProfile = os.environ['INSTANCE_PROFILE_NAME']
@@ -33,102 +34,60 @@ def lambda_handler(event, context):
     securityGroup = os.environ['SECURITY_GROUP']
     instance_type = os.environ['INSTANCE_TYPE']
 
-    try:
-        print(event)
-        event = event['DiskProcess']
-        
-        updatedEvent = event
+    LOG.debug("Received event", Event=event)
+    ec2 = clients.client('ec2')
 
-        ec2 = boto3.client('ec2')
-        
-        userData = '#!/bin/bash\necho DESTINATION_BUCKET='+event['EvidenceBucket']+' >> /etc/environment\necho IMAGE_NAME='+event['SourceVolumeID']+' >> /etc/environment\necho INCIDENT_ID='+event['IncidentID']+' >> /etc/environment'
-        AZS=event['VolumeAZ']
-        print(AZS)
-        subnets = ec2.describe_subnets(
-            Filters=[
-                {
-                    'Name': 'vpc-id',
-                    'Values': [
-                        targetVPC,
-                    ]
-                },
-                {
-                    'Name': 'availability-zone',
-                    'Values': [
-                        event['VolumeAZ'],
-                    ]
-                }
+    userData = '#!/bin/bash\necho DESTINATION_BUCKET='+event['EvidenceBucket']+' >> /etc/environment\necho IMAGE_NAME='+event['SourceVolumeID']+' >> /etc/environment\necho INCIDENT_ID='+event['IncidentID']+' >> /etc/environment'
+    # Dimensions of the imaging metrics reported by the collector
+    userData += '\necho SOURCE_ACCOUNT_ID='+event['AccountID']+' >> /etc/environment\necho SOURCE_REGION='+event['Region']+' >> /etc/environment\necho \'VOLUME_SIZE_BUCKET="'+metrics.volume_size_bucket(event['VolumeSize'])+'"\' >> /etc/environment'
 
-            ]
-        )
-        print(subnets)
-        supportedSubnets = []
-        
-        for sub in subnets['Subnets']:
-            supportedSubnets.append(sub['SubnetId'])
-        print(supportedSubnets)
-        targetSubnet = random.choice(supportedSubnets)
-        
-        print("Creating forensic instance for volume {} in subnet {} in AZ {}".format(
-            event['ForensicVolumeID'],
-            targetSubnet,
-            event['VolumeAZ']
-        ))
-        print(f"Running Instances with amiID={amiID}, instancetype={instance_type} securitygroup={securityGroup}, subnet={targetSubnet}, role={instanceProfile}")
-        response = ec2.run_instances(
-            ImageId=amiID,
-            InstanceType=instance_type,
-            MaxCount=1,
-            MinCount=1,
-            SecurityGroupIds=[
-                securityGroup,
-            ],
-            SubnetId=targetSubnet,
-            UserData=userData,
-            EbsOptimized=True,
-            IamInstanceProfile={
-                'Name': instanceProfile
-            },
-            InstanceInitiatedShutdownBehavior='terminate',
-            TagSpecifications=[
-                {
-                    'ResourceType': 'instance',
-                    'Tags': [
-                        {
-                            'Key': 'Name',
-                            'Value': event['InstanceID'] + "-" + event['SourceVolumeID']
-                        },
-                        {
-                            'Key': 'InstanceID',
-                            'Value': event['InstanceID']
-                        },
-                        {
-                            'Key': 'VolumeID',
-                            'Value': event['SourceVolumeID']
-                        },
-                        {
-                            'Key': 'FindingID',
-                            'Value': event['FindingID']
-                        },
-                        {
-                            'Key': 'SourceDeviceName',
-                            'Value': event['SourceDeviceName']
-                        },
-                    ]
-                },
-            ],
-        )
+    triedZones = []
+    while True:
+        targetSubnet = placement.choose_subnet(ec2, event['VolumeAZ'])
+        LOG.info("Creating forensic instance", ForensicVolumeID=event['ForensicVolumeID'], SubnetId=targetSubnet,
+                 VpcId=targetVPC, VolumeAZ=event['VolumeAZ'], ImageId=amiID,
+                 InstanceType=instance_type, SecurityGroup=securityGroup, InstanceProfile=instanceProfile)
+        try:
+            response = _run_instance(ec2, event, amiID, instance_type, securityGroup, targetSubnet, userData,
+                                     instanceProfile)
+            break
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'InsufficientInstanceCapacity' or \
+                    len(triedZones) >= placement.MAX_RELOCATIONS:
+                raise
+            # The volume moves to another zone, since the instance has to be in the zone of the volume
+            triedZones.append(event['VolumeAZ'])
+            placement.mark_constrained(event['VolumeAZ'])
+            zone = placement.choose_zone(ec2, exclude=triedZones)
+            LOG.warning("No capacity for the forensic instance, moving the volume", FromAZ=event['VolumeAZ'],
+                        ToAZ=zone, InstanceType=instance_type)
+            event = placement.relocate_volume(ec2, event, zone)
 
-        updatedEvent['ForensicInstances'] = []
-        updatedEvent['DiskImageLocation'] = "s3://"+event['EvidenceBucket']+"/"+event['IncidentID']+"/disk_evidence/"+event['SourceVolumeID']+".image.dd"
+    if triedZones:
+        event['RelocatedFromAZs'] = triedZones
+    event['ForensicInstances'] = [item['InstanceId'] for item in response['Instances']]
+    event['RunInstanceTime'] = time.time()
+    event['DiskImageLocation'] = "s3://"+event['EvidenceBucket']+"/"+event['IncidentID']+"/disk_evidence/"+event['SourceVolumeID']+".image.dd"
 
-        for item in response['Instances']:
-            updatedEvent['ForensicInstances'].append(item['InstanceId'])
+    return event
 
-        return updatedEvent
 
-    except Exception as e:
-        print("Received error while processing runInstances request.  {}".format(
-            repr(e)
-        ))
-        raise
+def _run_instance(ec2, event, amiID, instance_type, securityGroup, targetSubnet, userData, instanceProfile):
+    return ec2.run_instances(
+        ImageId=amiID,
+        InstanceType=instance_type,
+        MaxCount=1,
+        MinCount=1,
+        SecurityGroupIds=[
+            securityGroup,
+        ],
+        SubnetId=targetSubnet,
+        UserData=userData,
+        EbsOptimized=True,
+        IamInstanceProfile={
+            'Name': instanceProfile
+        },
+        InstanceInitiatedShutdownBehavior='terminate',
+        TagSpecifications=tagging.volume_tag_specifications('instance', event['InstanceID'] + "-" + event['SourceVolumeID'],
+                                                            event),
+    )
@@ -16,71 +16,40 @@
  * SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 '''
 
-import boto3
-import os
-import uuid
-
-roleName = os.environ['ROLE_NAME']
-accountNum = os.environ['SECURITY_ACCOUNT']
-
-def lambda_handler(event, context):
-    try:
-        
-        event = event['DiskProcess']
-        
-        region = event['Region']
-        findingID = event['FindingID']
-        instanceID = event['InstanceID']
-        snap = event['CopiedSnapshotID']
-        updatedEvent = event
-
-        client = boto3.client('sts')
 
-        response = client.assume_role(
-            RoleArn='arn:{}:iam::{}:role/{}'.format(
-                os.environ.get("Partition", 'aws'),
-                event['AccountID'],
-                roleName
-            ),
-            RoleSessionName="{}-{}-snapshot-copy-share".format(
-                instanceID,
-                snap
-            )
-        )
-
-        session = boto3.Session(
-            aws_access_key_id=response['Credentials']['AccessKeyId'],
-            aws_secret_access_key=response['Credentials']['SecretAccessKey'],
-            aws_session_token=response['Credentials']['SessionToken']
-        )
-
-        ec2 = session.client('ec2', region_name=region)
-
-        print("Sharing snapshot {} in region {} with central security account".format(
-            snap,
-            region
-        ))
-        
-        response = ec2.modify_snapshot_attribute(
-            Attribute='createVolumePermission',
-            CreateVolumePermission={
-                'Add': [
-                    {
-                        'UserId': accountNum
-                    }
-                ]
-            },
-            SnapshotId=snap,
-        )
+import os
+from forensic_common import log, regions, sessions
+from forensic_common.handler import forensic_handler
 
-        print("Snapshot {} has been shared with the security account".format(
-            snap
-        ))
+LOG = log.get_logger("shareSnapshot")
 
-        return updatedEvent
 
-    except Exception as e:
-        print("Received error while processing createSnapshot request.  {}".format(
-            repr(e)
-        ))
-        raise
+@forensic_handler("shareSnapshot")
+def lambda_handler(event, context):
+    roleName = os.environ['ROLE_NAME']
+    accountNum = os.environ['SECURITY_ACCOUNT']
+    region = regions.snapshot_copy_region(event)
+    instanceID = event['InstanceID']
+    snap = event['CopiedSnapshotID']
+
+    ec2 = sessions.member_ec2_client(event['AccountID'], roleName, region,
+                                     session_name="{}-{}-snapshot-copy-share".format(instanceID, snap))
+    LOG.debug("Session cache", **sessions.cache_stats())
+
+    LOG.info("Sharing snapshot with the security account", SnapshotId=snap, Region=region)
+
+    ec2.modify_snapshot_attribute(
+        Attribute='createVolumePermission',
+        CreateVolumePermission={
+            'Add': [
+                {
+                    'UserId': accountNum
+                }
+            ]
+        },
+        SnapshotId=snap,
+    )
+
+    LOG.info("Snapshot has been shared with the security account", SnapshotId=snap)
+
+    return event
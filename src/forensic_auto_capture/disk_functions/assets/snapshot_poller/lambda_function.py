@@ -0,0 +1,52 @@
+'''
+ * Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+ * SPDX-License-Identifier: MIT-0
+ *
+ * Permission is hereby granted, free of charge, to any person obtaining a copy of this
+ * software and associated documentation files (the "Software"), to deal in the Software
+ * without restriction, including without limitation the rights to use, copy, modify,
+ * merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+ * permit persons to whom the Software is furnished to do so.
+ *
+ * THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+ * INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+ * PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+ * HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+ * OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+ * SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+'''
+import os
+from forensic_common import batch_polling, callbacks, instrumentation, log, metrics
+
+LOG = log.get_logger("snapshotPoller")
+
+
+@instrumentation.instrumented("snapshotPoller")
+def lambda_handler(event, context):
+    """
+    Runs on a schedule.  Checks every snapshot the check stages of all the executions wait on, in
+    batches per account and region, and invokes the checks of the finished ones again.
+    """
+    roleName = os.environ['ROLE_NAME']
+    waited = callbacks.waited_snapshots()
+    describeCalls = 0
+    resumed = 0
+    for (accountID, region), snapshotIDs in waited.items():
+        try:
+            ec2 = batch_polling.ec2_client(accountID, region, roleName)
+            done, calls = batch_polling.finished(ec2, snapshotIDs)
+        except Exception as e:
+            # One unreachable account should not hold up the others
+            LOG.error("Could not check snapshots", AccountId=accountID, Region=region, Error=repr(e))
+            continue
+        describeCalls += calls
+        for snapshotID in done:
+            resumed += callbacks.resume(snapshotID)
+        LOG.info("Checked snapshots", AccountId=accountID, Region=region, Waiting=len(snapshotIDs),
+                 Finished=len(done), DescribeCalls=calls)
+
+    metrics.emit("snapshotPoller", {}, {
+        'WaitingSnapshots': (sum(len(ids) for ids in waited.values()), 'Count'),
+        'DescribeSnapshotsCalls': (describeCalls, 'Count'),
+        'ResumedChecks': (resumed, 'Count'),
+    })
@@ -0,0 +1,59 @@
+'''
+ * Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+ * SPDX-License-Identifier: MIT-0
+ *
+ * Permission is hereby granted, free of charge, to any person obtaining a copy of this
+ * software and associated documentation files (the "Software"), to deal in the Software
+ * without restriction, including without limitation the rights to use, copy, modify,
+ * merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+ * permit persons to whom the Software is furnished to do so.
+ *
+ * THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+ * INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+ * PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+ * HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+ * OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+ * SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+'''
+
+# Single Lambda function that runs every stage of the step function.
+#
+# When DiskFunctions is built with stage_dispatcher=True, every task of the state machine
+# invokes this function with the name of its stage in the Stage key of the payload.  All
+# stages then share one pool of warm containers and one set of cached clients and sessions.
+import importlib
+
+# Stage name, as sent by the step function, to the module holding the stage's handler
+STAGE_HANDLERS = {
+    "CreateSnapshot": "create_snapshot.lambda_function",
+    "CheckSnapshot": "check_snapshot.lambda_function",
+    "CopySnapshot": "copy_snapshot.lambda_function",
+    "CheckCopySnapshot": "check_copy_snapshot.lambda_function",
+    "ShareSnapshot": "share_snapshot.lambda_function",
+    "FinalCopySnapshot": "final_copy_snapshot.lambda_function",
+    "FinalCheckSnapshot": "final_check_snapshot.lambda_function",
+    "EnableFastRestore": "enable_fast_restore.lambda_function",
+    "CheckFastRestore": "check_fast_restore.lambda_function",
+    "CreateVolume": "create_volume.lambda_function",
+    "RunInstances": "run_instances.lambda_function",
+    "MountVolume": "mount_volume.lambda_function",
+    "FailureCleanup": "failure_cleanup.lambda_function",
+    "DisableFastRestore": "disable_fast_restore.lambda_function",
+}
+
+_handlers = {}
+
+
+def get_handler(stage: str):
+    """
+    Imports the stage's handler on first use, so a container only loads the stages it runs.
+    """
+    if stage not in _handlers:
+        if stage not in STAGE_HANDLERS:
+            raise ValueError("Unknown stage {}".format(stage))
+        _handlers[stage] = importlib.import_module(STAGE_HANDLERS[stage]).lambda_handler
+    return _handlers[stage]
+
+
+def lambda_handler(event, context):
+    return get_handler(event['Stage'])(event, context)
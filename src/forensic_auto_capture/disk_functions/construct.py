@@ -5,11 +5,20 @@ from aws_cdk import (
     aws_s3 as s3,
     aws_iam as iam,
     aws_kms as kms,
-    aws_lambda as _lambda
+    aws_lambda as _lambda,
+    aws_dynamodb as dynamodb,
+    aws_events as events,
+    aws_events_targets as events_targets,
+    aws_s3_notifications as s3_notifications
 )
+import json
 import pathlib
-from typing import Union, List
+from typing import Dict, Union, List
 
+FORENSIC_INSTANCE_TYPE = "m5a.large"
+
+# Long enough for Fast Snapshot Restore to be enabled on a snapshot of about a TiB
+DEFAULT_FAST_RESTORE_MAX_WAIT = cdk.Duration.hours(1)
 
 class DiskFunctions(cdk.Construct):
     def __init__(self, scope: cdk.Construct, id: str,
@@ -23,7 +32,26 @@ class DiskFunctions(cdk.Construct):
                  ec2_forensic_profile: iam.CfnInstanceProfile,
                  ec2_forensic_role: iam.Role,
                  forensic_security_group: ec2.SecurityGroup,
-                 vpc: ec2.Vpc) -> None:
+                 vpc: ec2.Vpc,
+                 stage_dispatcher: bool = False,
+                 multi_volume_snapshots: bool = False,
+                 exclude_boot_volume: bool = False,
+                 exclude_device_names: List[str] = None,
+                 exclude_volume_tags: List[str] = None,
+                 scan_snapshot_max_age: cdk.Duration = None,
+                 snapshot_callbacks: bool = False,
+                 adaptive_polling: bool = False,
+                 batched_polling: cdk.Duration = None,
+                 copy_lineage: bool = False,
+                 copy_concurrency: int = None,
+                 multi_region: bool = False,
+                 regional_copy_budgets: Dict[str, int] = None,
+                 retention_days: int = None,
+                 cleanup_dry_run: bool = False,
+                 imaging_throughput: int = None,
+                 volume_cost_ceiling: float = None,
+                 fast_restore_min_size: int = None,
+                 fast_restore_max_wait: cdk.Duration = None) -> None:
         """
         Builds the Lambda functions used for this ".  Each Lambda function is a separate
         method of this construct class.
@@ -32,9 +60,77 @@ class DiskFunctions(cdk.Construct):
         :param evidence_key: KMS Key to encrypt/decrypt the data stored in the evidence bucket
         :param security_account_id: The ID of the security account. NOTE: Only tested with everything
         in a single account
+        :param stage_dispatcher: When True, a single StageDispatcher function runs every stage, so all the
+        stages share warm containers.  When False, each stage gets its own function.
+        :param multi_volume_snapshots: When True, all the volumes of the instance are snapshotted with one
+        CreateSnapshots call, crash-consistent across the volumes.  When False, each volume gets its own
+        CreateSnapshot call.
+        :param exclude_boot_volume: Do not capture the boot volume of the instance
+        :param exclude_device_names: Device names of the volumes not to capture, such as "/dev/sdf"
+        :param exclude_volume_tags: Tags of the volumes not to capture, as "Key" or "Key=Value"
+        :param scan_snapshot_max_age: Adopt the snapshots taken by a GuardDuty Malware Protection scan of
+        the instance, when they are at most this old, instead of taking new ones.  Needs snapshot retention
+        turned on in Malware Protection.  None never adopts them.
+        :param snapshot_callbacks: When True, the snapshot check stages wait for a task token that the
+        SnapshotEvent function resumes on the EBS snapshot completion events, instead of polling.
+        :param adaptive_polling: When True, the snapshot check stages return the delay before the next check,
+        estimated from the snapshot progress, and the state machine waits that long instead of retrying on a
+        fixed backoff.  Ignored with snapshot_callbacks or batched_polling.
+        :param batched_polling: When set, the snapshot check stages wait for a task token like with
+        snapshot_callbacks, and the SnapshotPoller function checks every waited snapshot of every execution
+        on this schedule, in batches per account and region.  Can be combined with snapshot_callbacks.
+        :param copy_lineage: When True, the check stages record the last completed copy of each source volume, which
+        the next copy of the volume is copied incrementally from, or reuses when it is of the same snapshot.
+        :param copy_concurrency: The most snapshot copies in flight per destination account and region, across
+        every execution.  The copies over the budget are queued and retried instead of failing.  None leaves the
+        copies unbounded.
+        :param multi_region: When True, the snapshots of the instances of every region are copied into the region
+        of this stack, where the forensic volumes and instances are created.  The findings of the other regions
+        need to be forwarded to the event bus of this region.
+        :param regional_copy_budgets: The most copies in flight from each source region, overriding
+        copy_concurrency, so every region copies into this one at once.
+        :param retention_days: When set, the Cleanup function deletes the snapshots and volumes of a capture once
+        its image is verified in the evidence bucket, and keeps the final copy this many days.  It runs for each
+        collection log written to the bucket, and daily for what was left behind.  None keeps everything.
+        :param cleanup_dry_run: The Cleanup function only writes the report of what it would delete
+        :param imaging_throughput: The throughput in MiB/s provisioned on the forensic volumes, which should be what
+        the forensic instance can read at.  The volumes are gp3, or io2 when they are large and the throughput is
+        over what gp3 delivers.  None uses the default of forensic_common.volume_profile.
+        :param volume_cost_ceiling: The highest monthly price in USD of a forensic volume.  The provisioned
+        throughput is lowered to stay within it.  None has no ceiling.
+        :param fast_restore_min_size: When set, Fast Snapshot Restore is enabled on the final copy of the volumes of
+        at least this many GiB, in the availability zone of their forensic volume, so the volume is created fully
+        loaded instead of loading from S3 as dc3dd reads it.  It is disabled once the volume is attached.
+        :param fast_restore_max_wait: How long to wait for Fast Snapshot Restore to be enabled before creating the
+        volume without it.  The volumes expected to take longer than this to be enabled are created without it
+        up front.  None waits DEFAULT_FAST_RESTORE_MAX_WAIT.
 
         :ivar automation_role: The IAM role that assigned to the image forensics
         :ivar member_role: The IAM role used for cross account access
+        :ivar common_layer: The Lambda layer with the shared forensic_common runtime package
+        :ivar stage_dispatcher_lambda: The function running every stage, or None when each stage has its own
+        function.  In dispatcher mode every *_lambda attribute refers to this function.
+        :ivar snapshot_environment: The environment variables selecting how the snapshots are started, shared
+        by every function that starts them
+        :ivar snapshot_wait_table: The table of the task tokens waiting on snapshots, or None without callbacks
+        or batched polling
+        :ivar snapshot_event_lambda: The function resuming the check stages on snapshot events, or None without
+        callbacks
+        :ivar snapshot_poller_lambda: The function checking the waited snapshots in batches, or None without
+        batched polling
+        :ivar copy_lineage_table: The table of the last copy of each source volume, or None without copy lineage
+        :ivar copy_concurrency: The budget of the copies in flight per destination, or None
+        :ivar copy_lease_table: The table of the copies in flight per destination, or None without a budget
+        :ivar multi_region: Whether the snapshots of every region are copied into the region of this stack
+        :ivar volume_profile_environment: The environment variables sizing the forensic volumes
+        :ivar enable_fast_restore_lambda: The function enabling Fast Snapshot Restore before the volume is
+        created, or None without fast restore.  Same for check_fast_restore_lambda and disable_fast_restore_lambda.
+        :ivar fast_restore_max_wait: How long a capture waits for Fast Snapshot Restore, or None without it
+        :ivar failure_cleanup_lambda: The function releasing the copy leases and the snapshot wait registrations of
+        a failed capture, or None without a copy budget or callbacks
+        :ivar cleanup_lambda: The function deleting the resources of the verified captures, or None without
+        retention
+        :ivar adaptive_polling: Whether the snapshot check stages return the delay before the next check
         """
         super().__init__(scope, id=id)
 
@@ -50,6 +146,17 @@ class DiskFunctions(cdk.Construct):
         self.ec2_forensic_profile = ec2_forensic_profile
         self.ec2_forensic_role = ec2_forensic_role
         self.vpc = vpc
+        self.multi_volume_snapshots = multi_volume_snapshots
+        self.exclude_boot_volume = exclude_boot_volume
+        self.exclude_device_names = exclude_device_names or []
+        self.exclude_volume_tags = exclude_volume_tags or []
+        self.snapshot_environment = {
+            "SNAPSHOT_MODE": "Instance" if multi_volume_snapshots else "Volume",
+            "EXCLUDE_BOOT_VOLUME": str(exclude_boot_volume).lower(),
+            "EXCLUDE_DEVICE_NAMES": ",".join(self.exclude_device_names),
+            "EXCLUDE_VOLUME_TAGS": ",".join(self.exclude_volume_tags),
+            "SCAN_SNAPSHOT_MAX_AGE": str(int(scan_snapshot_max_age.to_seconds())) if scan_snapshot_max_age else "0"
+        }
 
         self.automation_role = self._disk_forensics_automation_role()
         self.member_role = self._disk_member_role()
@@ -62,6 +169,23 @@ class DiskFunctions(cdk.Construct):
             effect=iam.Effect.ALLOW
         ))
 
+        self.common_layer = self._build_common_layer()
+        self.stage_dispatcher_lambda = self._build_stage_dispatcher() if stage_dispatcher else None
+        self.snapshot_wait_table = self._build_snapshot_wait_table() \
+            if snapshot_callbacks or batched_polling else None
+        self.adaptive_polling = adaptive_polling and self.snapshot_wait_table is None
+        self.copy_lineage_table = self._build_copy_lineage_table() if copy_lineage else None
+        self.copy_concurrency = copy_concurrency
+        self.regional_copy_budgets = regional_copy_budgets or {}
+        self.copy_lease_table = self._build_copy_lease_table() \
+            if copy_concurrency or self.regional_copy_budgets else None
+        self.multi_region = multi_region
+        self.volume_profile_environment = {}
+        if imaging_throughput:
+            self.volume_profile_environment["TARGET_IMAGING_MIBPS"] = str(imaging_throughput)
+        if volume_cost_ceiling is not None:
+            self.volume_profile_environment["MAX_VOLUME_MONTHLY_COST"] = str(volume_cost_ceiling)
+
         self.check_copy_snapshot_lambda = self._build_check_copy_snapshot()
         self.check_snapshot_lambda = self._build_check_snapshot()
         self.create_snapshot_lambda = self._build_create_snapshot()
@@ -72,6 +196,24 @@ class DiskFunctions(cdk.Construct):
         self.create_volume_lambda = self._build_create_volume()
         self.run_instance_lambda = self._build_run_instance()
         self.mount_volume_lambda = self._build_mount_volume()
+        self.failure_cleanup_lambda = self._build_failure_cleanup() \
+            if self.copy_lease_table is not None or self.snapshot_wait_table is not None else None
+        if fast_restore_min_size:
+            self.fast_restore_max_wait = fast_restore_max_wait or DEFAULT_FAST_RESTORE_MAX_WAIT
+            self._build_fast_restore(fast_restore_min_size, self.fast_restore_max_wait)
+        else:
+            self.fast_restore_max_wait = None
+            self.enable_fast_restore_lambda = None
+            self.check_fast_restore_lambda = None
+            self.disable_fast_restore_lambda = None
+        if self.snapshot_wait_table is not None:
+            for function in self._check_functions():
+                # A check invoked again sends its own task failure, so Lambda should not retry it
+                function.configure_async_invoke(retry_attempts=0)
+        self.snapshot_event_lambda = self._build_snapshot_event() if snapshot_callbacks else None
+        self.snapshot_poller_lambda = self._build_snapshot_poller(batched_polling) if batched_polling else None
+        self.cleanup_lambda = self._build_cleanup(retention_days, cleanup_dry_run) \
+            if retention_days is not None else None
 
 
 
@@ -93,13 +235,24 @@ class DiskFunctions(cdk.Construct):
                      'ec2:CopySnapshot',
                      'ec2:CreateTags',
                      'ec2:CreateVolume',
+                     'ec2:DescribeInstances',
+                     'ec2:DescribeInstanceTypeOfferings',
                      'ec2:DescribeSnapshots',
                      'ec2:DescribeSubnets',
+                     'ec2:DescribeVolumes',
                      'ec2:RunInstances'
                      ],
             effect=iam.Effect.ALLOW,
             resources=["*"]
         ))
+        # A forensic volume is created again in another zone when its zone has no capacity for the instance
+        role.add_to_policy(iam.PolicyStatement(
+            sid='RelocateVolumePermissions',
+            actions=['ec2:DeleteVolume'],
+            conditions={"Null": {"aws:ResourceTag/FindingID": "false"}},
+            effect=iam.Effect.ALLOW,
+            resources=["*"]
+        ))
         role.add_to_policy(iam.PolicyStatement(
             sid='KMSPermissions',
             actions=['kms:CreateGrant',
@@ -126,7 +279,7 @@ class DiskFunctions(cdk.Construct):
         ))
         role.add_to_policy(iam.PolicyStatement(
             sid='S3Permissions',
-            actions=['s3:PutObject'],
+            actions=['s3:GetObject', 's3:PutObject'],
             resources=[self.evidence_bucket.bucket_arn, f"{self.evidence_bucket.bucket_arn}/*"],
             effect=iam.Effect.ALLOW
         ))
@@ -150,6 +303,7 @@ class DiskFunctions(cdk.Construct):
                      'ec2:DescribeInstances',
                      'ec2:CreateTags',
                      'ec2:DescribeSnapshots',
+                     'ec2:DescribeVolumes',
                      'ec2:ModifySnapshotAttribute',
                      'ec2:CreateSnapshots',
                      'ec2:CreateSnapshot'
@@ -175,62 +329,110 @@ class DiskFunctions(cdk.Construct):
         # role.add_managed_policy(iam.ManagedPolicy.from_managed_policy_name("IR-Automation-Member-Policy"))
         return role
 
-    def _build_create_snapshot(self):
+    def _build_common_layer(self) -> _lambda.LayerVersion:
         """
-        diskFunctions.yaml -  line 91 - DiskForensicsCreateSnapshot
-        :return: 
+        Builds the Lambda layer holding the forensic_common package, the runtime code that is shared
+        between the Lambda functions.
+        :return: The layer version
+        """
+        layer = _lambda.LayerVersion(self, "ForensicCommonLayer",
+                                     code=_lambda.Code.from_asset(
+                                         str(pathlib.Path(__file__).parents[1] / 'common_layer/')),
+                                     compatible_runtimes=[_lambda.Runtime.PYTHON_3_8],
+                                     description="Runtime code shared by the disk forensic functions")
+        return layer
+
+    def _build_function(self, id: str, asset: str, description: str, timeout: int,
+                        environment: dict = None, memory_size: int = 128) -> _lambda.Function:
         """
-        lambda_function = _lambda.Function(self, f"CreateSnapshot",
+        Builds one of the step function's Lambda functions.  Every function shares the automation
+        role and the forensic_common layer, so its own asset only holds the thin handler.
+        :param id: The construct ID of the function
+        :param asset: The folder under assets/ holding the function's lambda_function.py
+        :param description: The description of the function
+        :param timeout: The timeout, in seconds
+        :param environment: The environment variables of the function
+        :param memory_size: The memory of the function, in MB
+        :return: The lambda function created, or the stage dispatcher function in dispatcher mode.
+        """
+        if self.stage_dispatcher_lambda is not None:
+            for key, value in (environment or {}).items():
+                self.stage_dispatcher_lambda.add_environment(key, value)
+            return self.stage_dispatcher_lambda
+
+        lambda_function = _lambda.Function(self, id,
                                            runtime=_lambda.Runtime.PYTHON_3_8,
-                                           description="Create Snapshot Function",
+                                           description=description,
                                            handler="lambda_function.lambda_handler",
                                            code=_lambda.Code.from_asset(
-                                               str(pathlib.Path(__file__).parents[0] / 'assets/create_snapshot/')),
-                                           timeout=cdk.Duration.seconds(180),
+                                               str(pathlib.Path(__file__).parents[0] / 'assets' / asset)),
+                                           layers=[self.common_layer],
+                                           timeout=cdk.Duration.seconds(timeout),
+                                           memory_size=memory_size,
                                            role=self.automation_role,
-                                           environment={"EVIDENCE_BUCKET": self.evidence_bucket.bucket_name,
-                                                        "LOG_GROUP": self.audit_log_group.log_group_name,
-                                                        "ROLE_NAME": self.member_role.role_name}
+                                           environment=environment
                                            )
         return lambda_function
 
-    def _build_copy_snapshot(self):
+    def _build_stage_dispatcher(self) -> _lambda.Function:
         """
-        diskFunctions.yaml -  line 130 - DiskForensicsCopySnapshot
-        :return:
+        Builds the single function that runs every stage, routing on the Stage key of the task payload.
+        Its asset holds all of the stage folders, and the environment variables of every stage are added
+        to it as the stages are built.  The timeout is the longest of the stage timeouts.
+        :return: The lambda function created.
         """
-        lambda_function = _lambda.Function(self, f"CopySnapshot",
+        lambda_function = _lambda.Function(self, "StageDispatcher",
                                            runtime=_lambda.Runtime.PYTHON_3_8,
-                                           handler="lambda_function.lambda_handler",
-                                           description="Copy Snapshot Function",
+                                           description="Disk Forensics Stage Dispatcher Function",
+                                           handler="stage_dispatcher.lambda_handler",
                                            code=_lambda.Code.from_asset(
-                                               str(pathlib.Path(__file__).parents[0] / 'assets/copy_snapshot/')),
+                                               str(pathlib.Path(__file__).parents[0] / 'assets')),
+                                           layers=[self.common_layer],
                                            timeout=cdk.Duration.seconds(180),
                                            memory_size=128,
-                                           role=self.automation_role,
-                                           environment={"ROLE_NAME": self.member_role.role_name,
-                                                        "KMS_KEY": self.evidence_key.key_arn}
+                                           role=self.automation_role
                                            )
         return lambda_function
 
+    def _build_create_snapshot(self):
+        """
+        diskFunctions.yaml -  line 91 - DiskForensicsCreateSnapshot
+        :return: 
+        """
+        return self._build_function("CreateSnapshot", "create_snapshot",
+                                    description="Create Snapshot Function",
+                                    timeout=180,
+                                    environment=dict({"EVIDENCE_BUCKET": self.evidence_bucket.bucket_name,
+                                                      "LOG_GROUP": self.audit_log_group.log_group_name,
+                                                      "ROLE_NAME": self.member_role.role_name},
+                                                     **self.snapshot_environment))
+
+    def _build_copy_snapshot(self):
+        """
+        diskFunctions.yaml -  line 130 - DiskForensicsCopySnapshot
+        :return:
+        """
+        return self._build_function("CopySnapshot", "copy_snapshot",
+                                    description="Copy Snapshot Function",
+                                    timeout=180,
+                                    environment=dict({"ROLE_NAME": self.member_role.role_name,
+                                                      "KMS_KEY": self.evidence_key.key_arn,
+                                                      "FORENSIC_REGION": cdk.Stack.of(self).region
+                                                      if self.multi_region else ""},
+                                                     **self._lineage_environment(),
+                                                     **self._copy_quota_environment()))
+
     def _build_check_snapshot(self) -> _lambda.Function:
         """
         Creates the Lambd function that checks to see if the snapshot has been created.
         Taken from the diskFunctions.yaml(111) CloudFormation template, lambda DiskForensicsCheckSnapshot
         :return:
         """
-        lambda_function = _lambda.Function(self, f"CheckSnapshot",
-                                           runtime=_lambda.Runtime.PYTHON_3_8,
-                                           handler="lambda_function.lambda_handler",
-                                           description="Check Snapshot Function",
-                                           code=_lambda.Code.from_asset(
-                                               str(pathlib.Path(__file__).parents[0] / 'assets/check_snapshot/')),
-                                           timeout=cdk.Duration.seconds(15),
-                                           memory_size=128,
-                                           role=self.automation_role,
-                                           environment={"ROLE_NAME": self.member_role.role_name}
-                                           )
-        return lambda_function
+        return self._build_function("CheckSnapshot", "check_snapshot",
+                                    description="Check Snapshot Function",
+                                    timeout=15,
+                                    environment=dict({"ROLE_NAME": self.member_role.role_name},
+                                                     **self._callback_environment()))
 
     def _build_check_copy_snapshot(self) -> _lambda.Function:
         """
@@ -238,19 +440,14 @@ class DiskFunctions(cdk.Construct):
         Taken from the diskFunctions.yaml CloudFormation template - DiskForensicsCheckCopySnapshot
         :return: The lambda function created.
         """
-        lambda_function = _lambda.Function(self, f"CheckCopySnapshot",
-                                           runtime=_lambda.Runtime.PYTHON_3_8,
-                                           description="Check Copy Snapshot Function",
-                                           handler="lambda_function.lambda_handler",
-                                           code=_lambda.Code.from_asset(
-                                               str(pathlib.Path(__file__).parents[0] / 'assets/check_copy_snapshot/')),
-                                           timeout=cdk.Duration.seconds(15),
-                                           memory_size=128,
-                                           role=self.automation_role,
-                                           environment={"ROLE_NAME": self.member_role.role_name,
-                                                        "KMS_KEY": self.evidence_key.key_arn}
-                                           )
-        return lambda_function
+        return self._build_function("CheckCopySnapshot", "check_copy_snapshot",
+                                    description="Check Copy Snapshot Function",
+                                    timeout=15,
+                                    environment=dict({"ROLE_NAME": self.member_role.role_name,
+                                                      "KMS_KEY": self.evidence_key.key_arn},
+                                                     **self._callback_environment(),
+                                                     **self._lineage_environment(),
+                                                     **self._copy_quota_environment()))
 
     def _build_share_snapshot(self):
         """
@@ -258,114 +455,391 @@ class DiskFunctions(cdk.Construct):
 
         :return:
         """
-        lambda_function = _lambda.Function(self, f"ShareSnapshot",
-                                           runtime=_lambda.Runtime.PYTHON_3_8,
-                                           handler="lambda_function.lambda_handler",
-                                           description="Share Snapshot Function",
-                                           code=_lambda.Code.from_asset(
-                                               str(pathlib.Path(__file__).parents[0] / 'assets/share_snapshot/')),
-                                           timeout=cdk.Duration.seconds(15),
-                                           memory_size=128,
-                                           role=self.automation_role,
-                                           environment={"ROLE_NAME": self.member_role.role_name,
-                                                        "SECURITY_ACCOUNT": self.security_account}
-                                           )
-        return lambda_function
+        return self._build_function("ShareSnapshot", "share_snapshot",
+                                    description="Share Snapshot Function",
+                                    timeout=15,
+                                    environment={"ROLE_NAME": self.member_role.role_name,
+                                                 "SECURITY_ACCOUNT": self.security_account})
 
     def _build_final_copy_snapshot(self):
         """
         diskFunctions.yaml -  line 185 - DiskForensicsFinalCopySnapshot
         :return:
         """
-        lambda_function = _lambda.Function(self, f"FinalCopySnapshot",
-                                           runtime=_lambda.Runtime.PYTHON_3_8,
-                                           handler="lambda_function.lambda_handler",
-                                           description="Final Copy Snapshot Function",
-                                           code=_lambda.Code.from_asset(
-                                               str(pathlib.Path(__file__).parents[0] / 'assets/final_copy_snapshot/')),
-                                           timeout=cdk.Duration.seconds(15),
-                                           memory_size=128,
-                                           role=self.automation_role,
-                                           environment={"KMS_KEY": self.evidence_key.key_arn}
-                                           )
-        return lambda_function
+        return self._build_function("FinalCopySnapshot", "final_copy_snapshot",
+                                    description="Final Copy Snapshot Function",
+                                    timeout=15,
+                                    environment=dict({"KMS_KEY": self.evidence_key.key_arn},
+                                                     **self._lineage_environment(),
+                                                     **self._copy_quota_environment()))
 
     def _build_final_check_snapshot(self):
         """
         diskFunctions.yaml -  line 204 - DiskForensicsFinalCheckSnapshot
         :return:
         """
-        lambda_function = _lambda.Function(self, f"FinalCheckSnapshot",
-                                           runtime=_lambda.Runtime.PYTHON_3_8,
-                                           handler="lambda_function.lambda_handler",
-                                           description="Final Check Snapshot Function",
-                                           code=_lambda.Code.from_asset(
-                                               str(pathlib.Path(__file__).parents[0] / 'assets/final_check_snapshot/')),
-                                           timeout=cdk.Duration.seconds(15),
-                                           memory_size=128,
-                                           role=self.automation_role
-                                           )
-        return lambda_function
+        return self._build_function("FinalCheckSnapshot", "final_check_snapshot",
+                                    description="Final Check Snapshot Function",
+                                    timeout=15,
+                                    environment=dict({"KMS_KEY": self.evidence_key.key_arn},
+                                                     **self._callback_environment(),
+                                                     **self._lineage_environment(),
+                                                     **self._copy_quota_environment()))
 
     def _build_create_volume(self):
         """
         diskFunctions.yaml -  line 218 - DiskForensicsCreateVolume
         :return:
         """
-        lambda_function = _lambda.Function(self, f"CreateVolume",
-                                           runtime=_lambda.Runtime.PYTHON_3_8,
-                                           handler="lambda_function.lambda_handler",
-                                           description="Create Volume",
-                                           code=_lambda.Code.from_asset(
-                                               str(pathlib.Path(__file__).parents[0] / 'assets/create_volume/')),
-                                           timeout=cdk.Duration.seconds(15),
-                                           memory_size=128,
-                                           role=self.automation_role,
-                                           environment={"KMS_KEY": self.evidence_key.key_arn,
-                                                        "SUPPORTED_AZS": f'["{self.supported_azs[0]}","{self.supported_azs[1]}"]'}
-                                           )
-        return lambda_function
+        return self._build_function("CreateVolume", "create_volume",
+                                    description="Create Volume",
+                                    timeout=15,
+                                    environment=dict({"KMS_KEY": self.evidence_key.key_arn},
+                                                     **self.volume_profile_environment,
+                                                     **self._placement_environment()))
 
     def _build_run_instance(self):
         """
         diskFunctions.yaml -  line 240 - DiskForensicsRunInstances
         :return:
         """
-        lambda_function = _lambda.Function(self, f"RunInstances",
+        return self._build_function("RunInstances", "run_instances",
+                                    description="Run Instances",
+                                    timeout=120,
+                                    environment=dict({"AMI_ID": self.forensic_image.get_image(self).image_id,
+                                                      "INSTANCE_PROFILE_NAME": self.ec2_forensic_profile.instance_profile_name,
+                                                      "SECURITY_GROUP": self.forensic_security_group.security_group_id,
+                                                      "KMS_KEY": self.evidence_key.key_arn},
+                                                     **self._placement_environment()))
+
+    def _build_mount_volume(self):
+        """
+        diskFunctions.yaml -  line 261 - DiskForensicsMountVolume
+        :return:
+        """
+        return self._build_function("MountVolume", "mount_volume",
+                                    description="Mount Volume Function",
+                                    timeout=60,
+                                    environment={"LOG_GROUP": self.audit_log_group.log_group_name,
+                                                 "READINESS_LOG_GROUP": self.readiness_log_group.log_group_name})
+
+    def _build_failure_cleanup(self):
+        return self._build_function("FailureCleanup", "failure_cleanup",
+                                    description="Failure Cleanup Function",
+                                    timeout=15,
+                                    environment=dict(self._copy_quota_environment(),
+                                                     **self._callback_environment()))
+
+    def bound_to_execution(self, execution_timeout: cdk.Duration) -> None:
+        """
+        Expires the copy leases and the snapshot wait registrations after the timeout of the execution, past
+        which the copy or the check holding one can no longer be running.
+        :param execution_timeout: The timeout of the state machine
+        """
+        seconds = str(int(execution_timeout.to_seconds()))
+        if self.copy_lease_table is not None:
+            for function in (self.copy_snapshot_lambda, self.final_copy_snapshot_lambda):
+                function.add_environment("COPY_LEASE_SECONDS", seconds)
+        if self.snapshot_wait_table is not None:
+            for function in self._check_functions():
+                function.add_environment("REGISTRATION_TTL_SECONDS", seconds)
+
+    def _build_fast_restore(self, min_size: int, max_wait: cdk.Duration) -> None:
+        """
+        Builds the functions enabling, checking and disabling Fast Snapshot Restore on the final copies, and lets
+        the automation role manage it.
+        :param min_size: The smallest volume, in GiB, it is enabled for
+        :param max_wait: How long to wait for it to be enabled.  The enable stage skips the volumes expected to
+        take longer.
+        """
+        self.automation_role.add_to_policy(iam.PolicyStatement(
+            sid='FastRestorePermissions',
+            actions=['ec2:DescribeFastSnapshotRestores',
+                     'ec2:DisableFastSnapshotRestores',
+                     'ec2:EnableFastSnapshotRestores'],
+            effect=iam.Effect.ALLOW,
+            resources=["*"]
+        ))
+        environment = {"FAST_RESTORE_MAX_WAIT_SECONDS": str(int(max_wait.to_seconds()))}
+        self.enable_fast_restore_lambda = self._build_function(
+            "EnableFastRestore", "enable_fast_restore",
+            description="Enable Fast Snapshot Restore Function",
+            timeout=15,
+            environment=dict({"FAST_RESTORE_MIN_GIB": str(min_size)}, **environment, **self._placement_environment()))
+        self.check_fast_restore_lambda = self._build_function("CheckFastRestore", "check_fast_restore",
+                                                              description="Check Fast Snapshot Restore Function",
+                                                              timeout=15,
+                                                              environment=environment)
+        self.disable_fast_restore_lambda = self._build_function("DisableFastRestore", "disable_fast_restore",
+                                                                description="Disable Fast Snapshot Restore Function",
+                                                                timeout=15)
+
+    def _placement_environment(self) -> dict:
+        """
+        The environment variables placing the forensic volumes and instances, with the subnets of the VPC as
+        known at synth time, so the functions do not look the VPC up.
+        """
+        stack = cdk.Stack.of(self)
+        subnets = self.vpc.public_subnets + self.vpc.private_subnets + self.vpc.isolated_subnets
+        return {"SUPPORTED_AZS": stack.to_json_string(self.supported_azs),
+                "SUBNET_TOPOLOGY": stack.to_json_string([{"SubnetId": subnet.subnet_id,
+                                                          "AvailabilityZone": subnet.availability_zone}
+                                                         for subnet in subnets]),
+                "VPC_ID": self.vpc.vpc_id,
+                "INSTANCE_TYPE": FORENSIC_INSTANCE_TYPE}
+
+    def _callback_environment(self) -> dict:
+        """
+        The environment variables of the snapshot check stages selecting how they wait on the snapshots.
+        """
+        if self.snapshot_wait_table is not None:
+            return {"SNAPSHOT_WAIT_TABLE": self.snapshot_wait_table.table_name}
+        if self.adaptive_polling:
+            return {"ADAPTIVE_POLLING": "true"}
+        return {}
+
+    def _lineage_environment(self) -> dict:
+        if self.copy_lineage_table is not None:
+            return {"COPY_LINEAGE_TABLE": self.copy_lineage_table.table_name}
+        return {}
+
+    def _copy_quota_environment(self) -> dict:
+        if self.copy_lease_table is not None:
+            return {"COPY_LEASE_TABLE": self.copy_lease_table.table_name,
+                    "COPY_CONCURRENCY_BUDGET": str(self.copy_concurrency or 0),
+                    "REGIONAL_COPY_BUDGETS": json.dumps(self.regional_copy_budgets)}
+        return {}
+
+    def _build_copy_lease_table(self) -> dynamodb.Table:
+        """
+        Builds the table of the snapshot copies in flight, one item per destination account and region, and
+        lets the copy functions take and release their leases.
+        :return: The table
+        """
+        table = dynamodb.Table(self, "CopyLeaseTable",
+                               partition_key=dynamodb.Attribute(name="Destination",
+                                                                type=dynamodb.AttributeType.STRING),
+                               billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+                               removal_policy=cdk.RemovalPolicy.DESTROY)
+        table.grant_read_write_data(self.automation_role)
+        return table
+
+    def _build_copy_lineage_table(self) -> dynamodb.Table:
+        """
+        Builds the table of the last copy made of each source volume, keyed by "<account>#<volume>" and the
+        copy stage, and lets the copy and check functions read and record it.
+        :return: The table
+        """
+        table = dynamodb.Table(self, "CopyLineageTable",
+                               partition_key=dynamodb.Attribute(name="Lineage",
+                                                                type=dynamodb.AttributeType.STRING),
+                               sort_key=dynamodb.Attribute(name="Stage",
+                                                           type=dynamodb.AttributeType.STRING),
+                               billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+                               removal_policy=cdk.RemovalPolicy.DESTROY)
+        table.grant_read_write_data(self.automation_role)
+        return table
+
+    def _build_snapshot_wait_table(self) -> dynamodb.Table:
+        """
+        Builds the table of the task tokens of the check stages, keyed by the snapshot they wait on, and
+        lets the stage functions register their tokens and send the task results.
+        :return: The table
+        """
+        table = dynamodb.Table(self, "SnapshotWaitTable",
+                               partition_key=dynamodb.Attribute(name="SnapshotId",
+                                                                type=dynamodb.AttributeType.STRING),
+                               sort_key=dynamodb.Attribute(name="TokenHash",
+                                                           type=dynamodb.AttributeType.STRING),
+                               billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+                               time_to_live_attribute="ExpiresAt",
+                               removal_policy=cdk.RemovalPolicy.DESTROY)
+        table.grant_read_write_data(self.automation_role)
+        self.automation_role.add_to_policy(iam.PolicyStatement(
+            sid='SFNCallbackPermissions',
+            actions=['states:SendTaskFailure',
+                     'states:SendTaskSuccess'],
+            resources=["*"],  # The state machine is built after the functions
+            effect=iam.Effect.ALLOW
+        ))
+        return table
+
+    def _check_functions(self) -> List[_lambda.Function]:
+        """
+        The functions of the snapshot check stages, once each since they are all the same in dispatcher mode.
+        """
+        check_functions = [self.check_snapshot_lambda, self.check_copy_snapshot_lambda,
+                           self.final_check_copy_snapshot_lambda]
+        return list({function.node.path: function for function in check_functions}.values())
+
+    def _build_snapshot_event(self) -> _lambda.Function:
+        """
+        Builds the function invoking the check stages again when EventBridge reports a snapshot, or a
+        snapshot copy, completed or failed in this account and region.  Its own role, so that granting
+        it the invocation of the check functions does not make the automation role depend on them.
+        :return: The lambda function created.
+        """
+        role = iam.Role(self, "SnapshotEventRole",
+                        assumed_by=iam.ServicePrincipal("lambda.amazonaws.com"),
+                        managed_policies=[iam.ManagedPolicy.from_aws_managed_policy_name(
+                            "service-role/AWSLambdaBasicExecutionRole")],
+                        description="Role of the function resuming the disk forensic checks on snapshot events")
+        self.snapshot_wait_table.grant_read_write_data(role)
+        for function in self._check_functions():
+            function.grant_invoke(role)
+
+        lambda_function = _lambda.Function(self, "SnapshotEvent",
                                            runtime=_lambda.Runtime.PYTHON_3_8,
+                                           description="Snapshot Event Function",
                                            handler="lambda_function.lambda_handler",
-                                           description="Run Instances",
                                            code=_lambda.Code.from_asset(
-                                               str(pathlib.Path(__file__).parents[0] / 'assets/run_instances/')),
-                                           timeout=cdk.Duration.seconds(60),
-                                           memory_size=128,
-                                           role=self.automation_role,
-                                           environment={"AMI_ID": self.forensic_image.get_image(self).image_id,
-                                                        "VPC_ID": self.vpc.vpc_id,
-                                                        "INSTANCE_PROFILE_NAME": self.ec2_forensic_profile.instance_profile_name,
-                                                        "SECURITY_GROUP": self.forensic_security_group.security_group_id,
-                                                        "INSTANCE_TYPE": "m5a.large"
+                                               str(pathlib.Path(__file__).parents[0] / 'assets' / 'snapshot_event')),
+                                           layers=[self.common_layer],
+                                           timeout=cdk.Duration.seconds(30),
+                                           role=role,
+                                           environment={"SNAPSHOT_WAIT_TABLE": self.snapshot_wait_table.table_name})
 
-                                                        }
-                                           )
+        rule = events.Rule(self, "SnapshotEventRule",
+                           description="EBS snapshot completion for the disk forensic checks",
+                           event_pattern=events.EventPattern(
+                               source=["aws.ec2"],
+                               detail_type=["EBS Snapshot Notification"],
+                               detail={"event": ["createSnapshot", "createSnapshots", "copySnapshot"]}
+                           ),
+                           enabled=True)
+        rule.add_target(events_targets.LambdaFunction(lambda_function))
         return lambda_function
 
-    def _build_mount_volume(self):
+    def _build_snapshot_poller(self, interval: cdk.Duration) -> _lambda.Function:
         """
-        diskFunctions.yaml -  line 261 - DiskForensicsMountVolume
-        :return:
+        Builds the function checking, on a schedule, every snapshot the check stages wait on, with batched
+        DescribeSnapshots calls per account and region, and invoking the checks of the finished ones again.
+        Its own role, like the SnapshotEvent function, and trusted by the member role since most of the
+        snapshots are in the member accounts.
+        :param interval: How often the snapshots are checked.  EventBridge schedules run at most every minute.
+        :return: The lambda function created.
         """
-        lambda_function = _lambda.Function(self, f"MountVolume",
+        role = iam.Role(self, "SnapshotPollerRole",
+                        assumed_by=iam.ServicePrincipal("lambda.amazonaws.com"),
+                        managed_policies=[iam.ManagedPolicy.from_aws_managed_policy_name(
+                            "service-role/AWSLambdaBasicExecutionRole")],
+                        description="Role of the function checking the snapshots of the disk forensic checks")
+        self.snapshot_wait_table.grant_read_write_data(role)
+        for function in self._check_functions():
+            function.grant_invoke(role)
+        role.add_to_policy(iam.PolicyStatement(
+            sid='SnapshotPollerPermissions',
+            actions=['ec2:DescribeSnapshots'],
+            resources=["*"],
+            effect=iam.Effect.ALLOW
+        ))
+        role.add_to_policy(iam.PolicyStatement(
+            sid='STSPermissions',
+            actions=['sts:AssumeRole'],
+            resources=[self.member_role.role_arn],
+            effect=iam.Effect.ALLOW
+        ))
+        self.member_role.assume_role_policy.add_statements(iam.PolicyStatement(
+            actions=['sts:AssumeRole'],
+            principals=[role],
+            effect=iam.Effect.ALLOW
+        ))
+
+        lambda_function = _lambda.Function(self, "SnapshotPoller",
                                            runtime=_lambda.Runtime.PYTHON_3_8,
-                                           description="Mount Volume Function",
+                                           description="Snapshot Poller Function",
                                            handler="lambda_function.lambda_handler",
                                            code=_lambda.Code.from_asset(
-                                               str(pathlib.Path(__file__).parents[0] / 'assets/mount_volume/')),
+                                               str(pathlib.Path(__file__).parents[0] / 'assets' / 'snapshot_poller')),
+                                           layers=[self.common_layer],
                                            timeout=cdk.Duration.seconds(60),
-                                           memory_size=128,
-                                           role=self.automation_role,
-                                           environment={"LOG_GROUP": self.audit_log_group.log_group_name,
-                                                        "READINESS_LOG_GROUP": self.readiness_log_group.log_group_name}
-                                           )
+                                           role=role,
+                                           environment={"SNAPSHOT_WAIT_TABLE": self.snapshot_wait_table.table_name,
+                                                        "ROLE_NAME": self.member_role.role_name})
+
+        rule = events.Rule(self, "SnapshotPollerRule",
+                           description="Batched snapshot checks for the disk forensic checks",
+                           schedule=events.Schedule.rate(interval),
+                           enabled=True)
+        rule.add_target(events_targets.LambdaFunction(lambda_function))
         return lambda_function
 
+    def _build_cleanup(self, retention_days: int, dry_run: bool) -> _lambda.Function:
+        """
+        Builds the function deleting the snapshots and volumes of the captures whose image is verified, invoked
+        by the collection logs written to the evidence bucket and by a daily sweep.  Its own role, trusted by
+        the member role for the snapshots in the member accounts, and only allowed to delete the resources
+        tagged by the pipeline.
+        :param retention_days: Days the final copy is kept
+        :param dry_run: Only write the report of what would be deleted
+        :return: The lambda function created.
+        """
+        role = iam.Role(self, "CleanupRole",
+                        assumed_by=iam.ServicePrincipal("lambda.amazonaws.com"),
+                        managed_policies=[iam.ManagedPolicy.from_aws_managed_policy_name(
+                            "service-role/AWSLambdaBasicExecutionRole")],
+                        description="Role of the function cleaning up the disk forensic snapshots and volumes")
+        role.add_to_policy(iam.PolicyStatement(
+            sid='CleanupDescribePermissions',
+            actions=['ec2:DescribeSnapshots',
+                     'ec2:DescribeVolumes'],
+            resources=["*"],
+            effect=iam.Effect.ALLOW
+        ))
+        pipeline_tagged = {"Null": {"aws:ResourceTag/FindingID": "false"}}
+        role.add_to_policy(iam.PolicyStatement(
+            sid='CleanupDeletePermissions',
+            actions=['ec2:DeleteSnapshot',
+                     'ec2:DeleteVolume'],
+            resources=["*"],
+            conditions=pipeline_tagged,
+            effect=iam.Effect.ALLOW
+        ))
+        role.add_to_policy(iam.PolicyStatement(
+            sid='STSPermissions',
+            actions=['sts:AssumeRole'],
+            resources=[self.member_role.role_arn],
+            effect=iam.Effect.ALLOW
+        ))
+        self.member_role.assume_role_policy.add_statements(iam.PolicyStatement(
+            actions=['sts:AssumeRole'],
+            principals=[role],
+            effect=iam.Effect.ALLOW
+        ))
+        self.member_role.add_to_policy(iam.PolicyStatement(
+            sid='CleanupPermissions',
+            actions=['ec2:DeleteSnapshot'],
+            resources=["*"],
+            conditions=pipeline_tagged,
+            effect=iam.Effect.ALLOW
+        ))
+        self.evidence_bucket.grant_read_write(role)
+        if self.copy_lineage_table is not None:
+            self.copy_lineage_table.grant_read_data(role)
+
+        environment = {"ROLE_NAME": self.member_role.role_name,
+                       "EVIDENCE_BUCKET": self.evidence_bucket.bucket_name,
+                       "RETENTION_DAYS": str(retention_days),
+                       "DRY_RUN": str(dry_run).lower()}
+        if self.copy_lineage_table is not None:
+            environment["COPY_LINEAGE_TABLE"] = self.copy_lineage_table.table_name
+        lambda_function = _lambda.Function(self, "Cleanup",
+                                           runtime=_lambda.Runtime.PYTHON_3_8,
+                                           description="Cleanup Function",
+                                           handler="lambda_function.lambda_handler",
+                                           code=_lambda.Code.from_asset(
+                                               str(pathlib.Path(__file__).parents[0] / 'assets' / 'cleanup')),
+                                           layers=[self.common_layer],
+                                           timeout=cdk.Duration.minutes(5),
+                                           role=role,
+                                           environment=environment)
+
+        self.evidence_bucket.add_event_notification(s3.EventType.OBJECT_CREATED,
+                                                    s3_notifications.LambdaDestination(lambda_function),
+                                                    s3.NotificationKeyFilter(suffix=".collection.log"))
+        rule = events.Rule(self, "CleanupRule",
+                           description="Daily sweep of the disk forensic snapshots and volumes",
+                           schedule=events.Schedule.rate(cdk.Duration.days(1)),
+                           enabled=True)
+        rule.add_target(events_targets.LambdaFunction(lambda_function))
+        return lambda_function
@@ -5,12 +5,9 @@
 #  This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, express or implied.
 #  See the License for the specific language governing permissions and limitations under the License.
 
-import json
-import os
-import boto3
-import time
+from forensic_common import executions, instrumentation, log
 
-sfnArn = os.environ['ForensicSFNARN']
+LOG = log.get_logger("diskInvoke")
 
 
 def buildEvent(event):
@@ -39,24 +36,13 @@ def buildEvent(event):
             if 'Tags' in item:
                 triggeredEvent['Resource']['Tags'] = item['Tags']
 
-            print(triggeredEvent)
-            invokeStep(triggeredEvent)
-
-
-def invokeStep(event):
-    client = boto3.client('stepfunctions')
-
-    response = client.start_execution(
-        stateMachineArn=sfnArn,
-        name=str(time.time()) + "-" + event['Resource']['Id'],
-        input=json.dumps(event)
-    )
-
-    print(response)
+            LOG.info("Starting the forensic step function", Event=triggeredEvent)
+            executions.start(triggeredEvent, LOG)
 
 
+@instrumentation.instrumented("diskInvoke")
 def lambda_handler(event, context):
-    print(event)
+    LOG.debug("Received event", Event=event)
     for item in event['Resources']:
         ### Add More filters here to invoke only for certain evens such as different finding Types. event['Types']
         if item['Type'] == "AwsEc2Instance":
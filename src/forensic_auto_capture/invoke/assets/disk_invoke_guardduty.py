@@ -5,12 +5,9 @@
 #  This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, express or implied.
 #  See the License for the specific language governing permissions and limitations under the License.
 
-import json
-import os
-import boto3
-import time
-
+from forensic_common import executions, instrumentation, log, malware_scan
 
+LOG = log.get_logger("diskInvokeGuardDuty")
 
 
 def buildEvent(event):
@@ -34,26 +31,18 @@ def buildEvent(event):
     triggeredEvent['Resource']['Details'] = event["detail"]['resource']["instanceDetails"]
     if 'Tags' in event["detail"]["resource"]["instanceDetails"]:
         triggeredEvent['Resource']['Tags'] = event["detail"]["resource"]["instanceDetails"]['Tags']
+    # Malware Protection findings carry the scan whose snapshots can be reused
+    if malware_scan.scan_id(event["detail"]):
+        triggeredEvent['MalwareScanId'] = malware_scan.scan_id(event["detail"])
 
-    print(triggeredEvent)
+    LOG.info("Starting the forensic step function", Event=triggeredEvent)
     # TODO - Removing so we can test more easily
-    invokeStep(triggeredEvent)
-
-
-def invokeStep(event):
-    client = boto3.client('stepfunctions')
-    sfnArn = os.environ['ForensicSFNARN']
-    response = client.start_execution(
-        stateMachineArn=sfnArn,
-        name=str(time.time()) + "-" + event['Resource']['Id'],
-        input=json.dumps(event)
-    )
-
-    print(response)
+    executions.start(triggeredEvent, LOG)
 
 
+@instrumentation.instrumented("diskInvokeGuardDuty")
 def lambda_handler(event, context):
-    print(event)
+    LOG.debug("Received event", Event=event)
         ### Add More filters here to invoke only for certain evens such as different finding Types. event['Types']
     if (event['source'] == "aws.guardduty") and (event['detail']['resource']['resourceType'] == "Instance"):
         triggeredEvent = buildEvent(event)
@@ -3,6 +3,8 @@ from aws_cdk import (
     aws_iam as iam,
     aws_stepfunctions as stepfunctions,
     aws_lambda as _lambda,
+    aws_kms as kms,
+    aws_s3 as s3,
     aws_events as events,
     aws_events_targets as events_targets
 )
@@ -14,16 +16,34 @@ class InvokeConstruct(cdk.Construct):
     def __init__(self, scope: cdk.Construct,
                  id: str,
                  automation_role: Union[iam.Role, iam.IRole],
-                 forensic_sfn: stepfunctions.StateMachine):
+                 forensic_sfn: stepfunctions.StateMachine,
+                 common_layer: _lambda.ILayerVersion,
+                 evidence_bucket: s3.IBucket = None,
+                 evidence_key: kms.IKey = None,
+                 member_role: iam.Role = None,
+                 snapshot_environment: dict = None):
         """
         Invoke construct builds the resources that will monitor for an event and generate
         the execution.
         :param automation_role:
         :param forensic_sfn:
+        :param common_layer: The layer with the shared forensic_common runtime package
+        :param evidence_bucket: The bucket the instance details of the finding are stored in, so that
+        the execution input only carries a reference to them.  Without it they are passed inline.
+        :param evidence_key: The KMS key encrypting the evidence bucket
+        :param member_role: The member automation role.  When given, the invoke function starts the
+        snapshots itself, before the step function execution, and CreateSnapshotTask adopts them.
+        :param snapshot_environment: The environment variables selecting how the snapshots are started,
+        from DiskFunctions.snapshot_environment.  Used with member_role.
         """
         super().__init__(scope, id=id)
         self.automation_role = automation_role
         self.forensic_sfn = forensic_sfn
+        self.common_layer = common_layer
+        self.evidence_bucket = evidence_bucket
+        self.evidence_key = evidence_key
+        self.member_role = member_role
+        self.snapshot_environment = snapshot_environment or {}
         self.securityhub_event = None
         self.guardduty_event = None
         self.disk_process = self.build_disk_process_lambda()
@@ -58,6 +78,37 @@ class InvokeConstruct(cdk.Construct):
             resources=["*"]
 
         ))
+        environment = {"ForensicSFNARN": self.forensic_sfn.state_machine_arn}
+        if self.evidence_bucket is not None:
+            role.add_to_policy(iam.PolicyStatement(
+                sid="S3Permissions",
+                actions=['s3:PutObject'],
+                effect=iam.Effect.ALLOW,
+                resources=[f"{self.evidence_bucket.bucket_arn}/*"]
+            ))
+            environment["EVIDENCE_BUCKET"] = self.evidence_bucket.bucket_name
+        if self.evidence_key is not None:
+            role.add_to_policy(iam.PolicyStatement(
+                sid="KMSPermissions",
+                actions=['kms:Encrypt', 'kms:GenerateDataKey*'],
+                effect=iam.Effect.ALLOW,
+                resources=[self.evidence_key.key_arn]
+            ))
+        if self.member_role is not None:
+            role.add_to_policy(iam.PolicyStatement(
+                sid="STSPermissions",
+                actions=['sts:AssumeRole'],
+                effect=iam.Effect.ALLOW,
+                resources=[self.member_role.role_arn]
+            ))
+            self.member_role.assume_role_policy.add_statements(iam.PolicyStatement(
+                actions=['sts:AssumeRole'],
+                effect=iam.Effect.ALLOW,
+                principals=[role]
+            ))
+            environment.update(self.snapshot_environment,
+                               FAST_PATH_SNAPSHOTS="true",
+                               ROLE_NAME=self.member_role.role_name)
 
         lambda_function = _lambda.Function(self, f"DiskInvokeGuardDuty",
                                            runtime=_lambda.Runtime.PYTHON_3_8,
@@ -65,9 +116,10 @@ class InvokeConstruct(cdk.Construct):
                                            handler="disk_invoke_guardduty.lambda_handler",
                                            code=_lambda.Code.from_asset(
                                                str(pathlib.Path(__file__).parents[0] / 'assets/')),
+                                           layers=[self.common_layer],
                                            timeout=cdk.Duration.seconds(180),
                                            role=role,
-                                           environment={"ForensicSFNARN": self.forensic_sfn.state_machine_arn}
+                                           environment=environment
                                            )
         cdk.CfnOutput(scope=self,
                       id="OutputInvoke",
@@ -7,20 +7,75 @@ from aws_cdk import (
 )
 from ..disk_functions.construct import DiskFunctions
 
+# In callback mode, a check task waiting this long for its snapshot event, or the poller, checks again with a new token
+CALLBACK_FALLBACK_INTERVAL = cdk.Duration.minutes(5)
+CALLBACK_FALLBACK_ATTEMPTS = 12
+
+# A copy over the copy budget is queued by retrying it this often, for up to about two hours
+COPY_QUEUE_INTERVAL = cdk.Duration.seconds(30)
+COPY_QUEUE_ATTEMPTS = 240
+
+# Timeout of an execution that neither queues copies nor waits on callbacks
+BASE_EXECUTION_TIMEOUT = cdk.Duration.minutes(20)
+
 # TODO - May need to assign an IAM role to the step function
 class StepFunctionConstruct(cdk.Construct):
-    def __init__(self, scope: cdk.Construct, id: str, functions_construct: DiskFunctions):
+    def __init__(self, scope: cdk.Construct, id: str, functions_construct: DiskFunctions,
+                 same_account: bool = False,
+                 execution_timeout: cdk.Duration = None):
+        """
+        Builds the state machine capturing the volumes of an instance.
+        :param functions_construct: The functions run by the tasks
+        :param same_account: The member account is the security account.  The snapshot is then copied once,
+        re-encrypted under the evidence key, and the volume is created from that copy, without the share and
+        the final copy in the security account.
+        :param execution_timeout: The timeout of an execution.  It has to cover the longest a copy can be queued
+        and a check can wait on its callbacks or on Fast Snapshot Restore.  None uses the shortest timeout that
+        does.
+
+        :ivar execution_timeout: The timeout of an execution, which the copy leases and wait registrations
+        expire after
+        """
         super().__init__(scope, id=id)
         self.functions_construct = functions_construct
+        self.same_account = same_account
+        self.execution_timeout = self._execution_timeout(execution_timeout)
+        self.functions_construct.bound_to_execution(self.execution_timeout)
 
         self._build_other_tasks()
         self._build_all_lambda_tasks()
+        self._build_poll_loops()
         self._iterator_group = self._create_iterator_group()
         self._map_state = self._create_map_state()
         self._process_incident_task = self._create_process_incident_task()
         self._state_definition = self.build_state_machine()
         self.state_machine = stepfunctions.StateMachine(self, "StateMachine", definition=self._state_definition,
-                                                         timeout=cdk.Duration.minutes(20))
+                                                         timeout=self.execution_timeout)
+
+    def _execution_timeout(self, timeout: cdk.Duration = None) -> cdk.Duration:
+        """
+        The timeout of an execution, long enough for each copy of a volume to be queued for as long as the
+        retries of its copy stage last, for each check to wait through all of its callback fallbacks, and for
+        Fast Snapshot Restore to be waited on.
+        :param timeout: The timeout asked for
+        :raises Exception: The timeout asked for is shorter than that
+        """
+        seconds = BASE_EXECUTION_TIMEOUT.to_seconds()
+        if self.functions_construct.copy_lease_table is not None:
+            queued_stages = 1 if self.same_account else 2
+            seconds += queued_stages * COPY_QUEUE_INTERVAL.to_seconds() * COPY_QUEUE_ATTEMPTS
+        if self.functions_construct.snapshot_wait_table is not None:
+            check_stages = 2 if self.same_account else 3
+            seconds += check_stages * CALLBACK_FALLBACK_INTERVAL.to_seconds() * (CALLBACK_FALLBACK_ATTEMPTS + 1)
+        if self.functions_construct.fast_restore_max_wait is not None:
+            # The checks back off by 1.5, so the one giving up comes up to half the wait late
+            seconds += self.functions_construct.fast_restore_max_wait.to_seconds() * 1.5
+        if timeout is None:
+            return cdk.Duration.seconds(seconds)
+        if timeout.to_seconds() < seconds:
+            raise Exception("The execution timeout of {} seconds is shorter than the {} seconds the copies can "
+                            "be queued and waited on".format(timeout.to_seconds(), seconds))
+        return timeout
 
     def _build_other_tasks(self) -> None:
         self._error_alert_sns = sns.Topic(scope=self, id="ErrorTopic", display_name="Disk Forensics Error Topic",
@@ -30,6 +85,27 @@ class StepFunctionConstruct(cdk.Construct):
         self._map_error_alert_task = tasks.SnsPublish(self, "MapErrorAlert", topic=self._error_alert_sns,
                                                       message=stepfunctions.TaskInput.from_text(
                                                           '"Input.$":"$.error-info"'))
+        self._copy_error_alert_task = self._map_error_alert_task
+        self._incident_error_alert_task = None
+        if self.functions_construct.failure_cleanup_lambda is not None:
+            # The copy leases and wait registrations of a failed volume are released before the alert
+            self._copy_error_alert_task = self._create_lambda_task("FailureCleanup",
+                                                                   function=self.functions_construct.failure_cleanup_lambda,
+                                                                   stage="FailureCleanup",
+                                                                   catch_alert=self._map_error_alert_task,
+                                                                   result_path=stepfunctions.JsonPath.DISCARD)
+            self._copy_error_alert_task.next(self._map_error_alert_task)
+        if self.functions_construct.snapshot_wait_table is not None:
+            # Same for the snapshots of the instance, after which the execution still fails
+            self._incident_error_alert_task = self._create_lambda_task("IncidentFailureCleanup",
+                                                                       function=self.functions_construct.failure_cleanup_lambda,
+                                                                       stage="FailureCleanup",
+                                                                       result_path=stepfunctions.JsonPath.DISCARD)
+            self._incident_error_alert_task.add_catch(handler=self._error_alert_task,
+                                                      errors=["States.ALL"],
+                                                      result_path="$.cleanup-error-info")
+            self._incident_error_alert_task.next(self._error_alert_task)
+            self._error_alert_task.next(stepfunctions.Fail(self, "CaptureFailed"))
 
         self._instance_wait_task = stepfunctions.Wait(self,
                                                       "CreateInstanceWait",
@@ -38,60 +114,169 @@ class StepFunctionConstruct(cdk.Construct):
     def _build_all_lambda_tasks(self) -> None:
         self._create_snapshot_task = self._create_lambda_task("CreateSnapshotTask",
                                                               function=self.functions_construct.create_snapshot_lambda,
+                                                              stage="CreateSnapshot",
                                                               task_input={"DiskProcess.$": "$"})
 
         self._check_snapshot_task = self._create_lambda_task("CheckSnapshotTask",
                                                              self.functions_construct.check_snapshot_lambda,
-                                                             retry=True)
+                                                             stage="CheckSnapshot",
+                                                             catch_alert=self._incident_error_alert_task,
+                                                             retry=True,
+                                                             callback=True)
         self._copy_snapshot_task = self._create_lambda_task("CopySnapshotTask",
                                                             function=self.functions_construct.copy_snapshot_lambda,
-                                                            task_input={"DiskProcess.$": "$"})
+                                                            stage="CopySnapshot",
+                                                            task_input={"DiskProcess.$": "$"},
+                                                            queued=True)
         self._check_copy_snapshot_task = self._create_lambda_task("CheckCopySnapshotTask",
                                                                   function=self.functions_construct.check_copy_snapshot_lambda,
-                                                                  catch_alert=self._map_error_alert_task,
-                                                                  retry=True)
+                                                                  stage="CheckCopySnapshot",
+                                                                  catch_alert=self._copy_error_alert_task,
+                                                                  retry=True,
+                                                                  callback=True)
 
         self._share_snapshot_task = self._create_lambda_task("ShareSnapshotTask",
                                                              function=self.functions_construct.share_snapshot_lambda,
-                                                             catch_alert=self._map_error_alert_task)
+                                                             stage="ShareSnapshot",
+                                                             catch_alert=self._copy_error_alert_task)
         self._final_copy_snapshot_task = self._create_lambda_task("FinalCopySnapshot",
                                                                   function=self.functions_construct.final_copy_snapshot_lambda,
-                                                                  catch_alert=self._map_error_alert_task)
+                                                                  stage="FinalCopySnapshot",
+                                                                  catch_alert=self._copy_error_alert_task,
+                                                                  queued=True)
         self._final_check_snapshot_task = self._create_lambda_task("FinalCheckSnapshot",
                                                                    function=self.functions_construct.final_check_copy_snapshot_lambda,
-                                                                   catch_alert=self._map_error_alert_task,
-                                                                   retry=True)
+                                                                   stage="FinalCheckSnapshot",
+                                                                   catch_alert=self._copy_error_alert_task,
+                                                                   retry=True,
+                                                                   callback=True)
+        self._build_fast_restore_tasks()
         self._create_volume_task = self._create_lambda_task("CreateVolume",
                                                             function=self.functions_construct.create_volume_lambda,
-                                                            catch_alert=self._map_error_alert_task)
+                                                            stage="CreateVolume",
+                                                            catch_alert=self._volume_error_alert_task)
         self._run_instance_task = self._create_lambda_task("RunInstance",
                                                            function=self.functions_construct.run_instance_lambda,
-                                                           catch_alert=self._map_error_alert_task)
+                                                           stage="RunInstances",
+                                                           catch_alert=self._volume_error_alert_task)
         self._mount_volume_task = self._create_lambda_task("MountVolume",
                                                            function=self.functions_construct.mount_volume_lambda,
-                                                           catch_alert=self._map_error_alert_task,
+                                                           stage="MountVolume",
+                                                           catch_alert=self._volume_error_alert_task,
                                                            retry=True)
 
+    def _build_fast_restore_tasks(self) -> None:
+        """
+        With fast restore, builds the tasks enabling it before CreateVolume and disabling it after MountVolume.
+        The errors from CheckFastRestore to MountVolume disable it too before the alert, so a failed volume does
+        not leave it enabled.  Without fast restore, the errors go straight to the alert.
+        """
+        self._volume_error_alert_task = self._map_error_alert_task
+        if self.functions_construct.enable_fast_restore_lambda is None:
+            return
+        self._enable_fast_restore_task = self._create_lambda_task("EnableFastRestore",
+                                                                  function=self.functions_construct.enable_fast_restore_lambda,
+                                                                  stage="EnableFastRestore",
+                                                                  catch_alert=self._map_error_alert_task)
+        self._disable_fast_restore_task = self._create_lambda_task("DisableFastRestore",
+                                                                   function=self.functions_construct.disable_fast_restore_lambda,
+                                                                   stage="DisableFastRestore",
+                                                                   catch_alert=self._map_error_alert_task)
+        self._volume_error_alert_task = self._create_lambda_task("DisableFastRestoreOnError",
+                                                                 function=self.functions_construct.disable_fast_restore_lambda,
+                                                                 stage="DisableFastRestore",
+                                                                 catch_alert=self._map_error_alert_task,
+                                                                 result_path=stepfunctions.JsonPath.DISCARD)
+        self._volume_error_alert_task.next(self._map_error_alert_task)
+        self._check_fast_restore_task = self._create_lambda_task("CheckFastRestore",
+                                                                 function=self.functions_construct.check_fast_restore_lambda,
+                                                                 stage="CheckFastRestore",
+                                                                 catch_alert=self._volume_error_alert_task,
+                                                                 retry=True)
+
+    def _build_poll_loops(self) -> None:
+        self._check_snapshot_step = self._create_poll_loop("CheckSnapshotTask", self._check_snapshot_task)
+        self._check_copy_snapshot_step = self._create_poll_loop("CheckCopySnapshotTask",
+                                                                self._check_copy_snapshot_task)
+        self._final_check_snapshot_step = self._create_poll_loop("FinalCheckSnapshot",
+                                                                 self._final_check_snapshot_task)
+
+    def _create_poll_loop(self, id: str, check_task: tasks.LambdaInvoke) -> stepfunctions.IChainable:
+        """
+        With adaptive polling, loops the check task through a Wait of the NextPollSeconds it returned for
+        as long as its SnapshotStatus is pending.  Otherwise the check task is retried on RuntimeError,
+        and is returned as is.
+        :param id: The ID of the check task, used as the prefix of the loop states
+        :return: The check task, or the loop chain ending once the snapshots completed
+        """
+        if not self.functions_construct.adaptive_polling:
+            return check_task
+        wait = stepfunctions.Wait(self, f"{id}Wait",
+                                  time=stepfunctions.WaitTime.seconds_path("$.Payload.NextPollSeconds"))
+        done = stepfunctions.Pass(self, f"{id}Completed")
+        choice = stepfunctions.Choice(self, f"{id}Pending")
+        choice.when(stepfunctions.Condition.string_equals("$.Payload.SnapshotStatus", "pending"),
+                    wait.next(check_task))
+        choice.otherwise(done)
+        check_task.next(choice)
+        return stepfunctions.Chain.custom(check_task, [done], done)
+
     def _create_error_sns(self) -> sns.Topic:
         return sns.Topic(scope=self, id="ErrorTopic", display_name="Disk Forensics Error Topic",
                          topic_name="DiskForensicsErrorTopic")
 
     def _create_lambda_task(self, id: str, function: _lambda.Function,
+                            stage: str,
                             task_input: {} = {"DiskProcess.$": "$.Payload"},
                             catch_alert: stepfunctions.Task = None,
-                            retry: bool = False) -> tasks:
+                            retry: bool = False,
+                            callback: bool = False,
+                            queued: bool = False,
+                            result_path: str = None) -> tasks:
+        """
+        Creates the task invoking the Lambda function of one stage.  Only the Payload of the invocation
+        result is kept, so the Lambda response metadata does not ride along with the state.
+        :param stage: The name of the stage.  Sent in the Stage key of the payload when all stages run
+        in the single stage dispatcher function.
+        :param callback: The stage waits on snapshots.  When the functions were built with snapshot
+        callbacks, the task waits for its task token instead of being retried until the snapshots complete,
+        and times out into a new check every CALLBACK_FALLBACK_INTERVAL in case the snapshot event is missed.
+        :param queued: The stage starts a snapshot copy.  With a copy budget, it is retried on CopyQuotaExceeded
+        until the budget has room.
+        :param result_path: Where the result goes in the state, such as JsonPath.DISCARD to keep the input
+        """
+        callback = callback and self.functions_construct.snapshot_wait_table is not None
+        if callback:
+            task_input = dict(task_input, TaskToken=stepfunctions.JsonPath.task_token)
         if task_input is None:
             payload = None
         else:
+            if self.functions_construct.stage_dispatcher_lambda is not None:
+                task_input = dict(task_input, Stage=stage)
             payload = stepfunctions.TaskInput.from_object(task_input)
         task = tasks.LambdaInvoke(self, id=id,
                                   lambda_function=function,
                                   payload=payload,
-                                  retry_on_service_exceptions=False)
+                                  result_selector={"Payload.$": "$.Payload"},
+                                  result_path=result_path,
+                                  retry_on_service_exceptions=False,
+                                  integration_pattern=stepfunctions.IntegrationPattern.WAIT_FOR_TASK_TOKEN
+                                  if callback else stepfunctions.IntegrationPattern.REQUEST_RESPONSE,
+                                  timeout=CALLBACK_FALLBACK_INTERVAL if callback else None)
+        if callback:
+            task.add_retry(errors=["States.Timeout"],
+                           interval=cdk.Duration.seconds(1),
+                           backoff_rate=1,
+                           max_attempts=CALLBACK_FALLBACK_ATTEMPTS)
         if catch_alert:
             task.add_catch(handler=catch_alert,
                            errors=["States.ALL"],
                            result_path="$.error-info")
+        if queued and self.functions_construct.copy_lease_table is not None:
+            task.add_retry(errors=["CopyQuotaExceeded"],
+                           interval=COPY_QUEUE_INTERVAL,
+                           backoff_rate=1,
+                           max_attempts=COPY_QUEUE_ATTEMPTS)
         if retry:
             task.add_retry(errors=["RuntimeError"],
                            interval=cdk.Duration.seconds(30),
@@ -100,8 +285,9 @@ class StepFunctionConstruct(cdk.Construct):
         return task
 
     def _create_map_state(self) -> stepfunctions.Map:
+        # With a copy budget, one execution never runs more volumes at once than the budget admits
         map_state = stepfunctions.Map(self, "ProcessSnaps",
-                                      max_concurrency=0,
+                                      max_concurrency=self.functions_construct.copy_concurrency or 0,
                                       items_path=stepfunctions.JsonPath.string_at("$.Payload.CapturedSnapshots"))
         map_state.iterator(self._iterator_group)
         return map_state
@@ -109,14 +295,30 @@ class StepFunctionConstruct(cdk.Construct):
     def _create_iterator_group(self) -> stepfunctions.Chain:
         state_definition = stepfunctions.Chain \
             .start(self._copy_snapshot_task) \
-            .next(self._check_copy_snapshot_task) \
-            .next(self._share_snapshot_task) \
-            .next(self._final_copy_snapshot_task) \
-            .next(self._final_check_snapshot_task) \
+            .next(self._check_copy_snapshot_step)
+        if self.same_account:
+            # The copy is already in the security account under the evidence key, so it is the final copy
+            state_definition = state_definition.next(stepfunctions.Pass(
+                self, "SameAccountFinalCopy",
+                input_path="$.Payload.CopiedSnapshotID",
+                result_path="$.Payload.FinalCopiedSnapshotID"))
+        else:
+            state_definition = state_definition \
+                .next(self._share_snapshot_task) \
+                .next(self._final_copy_snapshot_task) \
+                .next(self._final_check_snapshot_step)
+        fast_restore = self.functions_construct.enable_fast_restore_lambda is not None
+        if fast_restore:
+            state_definition = state_definition \
+                .next(self._enable_fast_restore_task) \
+                .next(self._check_fast_restore_task)
+        state_definition = state_definition \
             .next(self._create_volume_task) \
             .next(self._run_instance_task) \
             .next(self._instance_wait_task) \
             .next(self._mount_volume_task)
+        if fast_restore:
+            state_definition = state_definition.next(self._disable_fast_restore_task)
         return state_definition
 
     def _create_process_incident_task(self) -> tasks:
@@ -124,11 +326,27 @@ class StepFunctionConstruct(cdk.Construct):
         # TODO - The branch is here to support additional applications such as grabbing logs, performing memory capture, etc
 
         parallel.branch(self._map_state)
+        parallel.branch(self._create_snapshot_failure_alert())
         return parallel
 
+    def _create_snapshot_failure_alert(self) -> stepfunctions.Choice:
+        """
+        Alerts on the volumes of the instance whose snapshot could not be started, while the others are captured.
+        """
+        alert = tasks.SnsPublish(self, "PublishSnapshotFailures", topic=self._error_alert_sns,
+                                 subject="Forensic capture incomplete",
+                                 message=stepfunctions.TaskInput.from_object({
+                                     "IncidentID": stepfunctions.JsonPath.string_at("$.Payload.IncidentID"),
+                                     "FailedSnapshots": stepfunctions.JsonPath.string_at("$.Payload.FailedSnapshots")
+                                 }),
+                                 result_path=stepfunctions.JsonPath.DISCARD)
+        return stepfunctions.Choice(self, "AnySnapshotFailed") \
+            .when(stepfunctions.Condition.is_present("$.Payload.FailedSnapshots[0]"), alert) \
+            .otherwise(stepfunctions.Succeed(self, "AllSnapshotsStarted"))
+
     def build_state_machine(self):
         state_definition = stepfunctions.Chain \
             .start(self._create_snapshot_task) \
-            .next(self._check_snapshot_task) \
+            .next(self._check_snapshot_step) \
             .next(self._process_incident_task)
         return state_definition
@@ -0,0 +1,10 @@
+"""
+Shared pytest configuration
+"""
+import pathlib
+import sys
+
+# The Lambda functions import forensic_common from their layer, which Lambda extracts
+# under /opt/python.  Put the layer's python directory on the path the same way.
+COMMON_LAYER_PATH = pathlib.Path(__file__).parents[1] / 'src/forensic_auto_capture/common_layer/python'
+sys.path.insert(0, str(COMMON_LAYER_PATH))
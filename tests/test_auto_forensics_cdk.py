@@ -1,6 +1,8 @@
 """
 Unit test for the CDK constructs
 """
+import json
+
 import pytest
 from aws_cdk import (
     core as cdk,
@@ -71,3 +73,74 @@ def test_build_invoke(auto_forensics_construct, machine_image):
     auto_forensics_construct.build_invoke()
     auto_forensics_construct.invoke_construct.invoke_from_securityhub()
     assert True
+
+
+@pytest.mark.order(6)
+def test_build_stage_dispatcher(stack_environment, machine_image):
+    construct = AutoForensicsConstruct(stack_environment.stack, "UNITAutoForensicsDispatcher",
+                                       member_account_id=constants.ACCOUNT_ID,
+                                       security_account_id=constants.ACCOUNT_ID,
+                                       region=constants.REGION,
+                                       vpc=stack_environment.vpc,
+                                       supported_azs=constants.SUPPORTED_AZS,
+                                       stage_dispatcher=True)
+    construct.forensic_image = machine_image
+    construct.build_forensic_resource()
+    construct.build_functions()
+    construct.build_step_function()
+    functions = construct.functions_construct
+    assert functions.create_snapshot_lambda is functions.stage_dispatcher_lambda
+    assert functions.mount_volume_lambda is functions.stage_dispatcher_lambda
+
+
+def _definition(construct: AutoForensicsConstruct) -> dict:
+    """
+    The definition of the state machine, with the tokens of the other resources left as "token".
+    """
+    state_machine = construct.step_function_construct.state_machine.node.default_child
+    definition = cdk.Stack.of(construct).resolve(state_machine.definition_string)
+    if isinstance(definition, dict):
+        definition = ''.join(part if isinstance(part, str) else 'token' for part in definition['Fn::Join'][1])
+    return json.loads(definition)
+
+
+def _states(definition: dict) -> dict:
+    """
+    Every state of the definition by name, including the ones of the Parallel branches and the Map iterator.
+    """
+    found = {}
+    for name, state in definition['States'].items():
+        found[name] = state
+        for branch in state.get('Branches', []) + ([state['Iterator']] if 'Iterator' in state else []):
+            found.update(_states(branch))
+    return found
+
+
+@pytest.mark.order(7)
+def test_same_account_skips_the_share_and_final_copy(auto_forensics_construct):
+    # The member account of the fixture is the security account
+    assert auto_forensics_construct.step_function_construct.same_account
+    states = _states(_definition(auto_forensics_construct))
+    assert not {'ShareSnapshotTask', 'FinalCopySnapshot', 'FinalCheckSnapshot'} & set(states)
+    final_copy = states['SameAccountFinalCopy']
+    assert (final_copy['Type'], final_copy['InputPath'], final_copy['ResultPath']) == \
+        ('Pass', '$.Payload.CopiedSnapshotID', '$.Payload.FinalCopiedSnapshotID')
+    assert final_copy['Next'] == 'CreateVolume'
+
+
+@pytest.mark.order(8)
+def test_cross_account_shares_and_copies_again(stack_environment, machine_image):
+    construct = AutoForensicsConstruct(stack_environment.stack, "UNITAutoForensicsCrossAccount",
+                                       member_account_id="111122223333",
+                                       security_account_id=constants.ACCOUNT_ID,
+                                       region=constants.REGION,
+                                       vpc=stack_environment.vpc,
+                                       supported_azs=constants.SUPPORTED_AZS)
+    construct.forensic_image = machine_image
+    construct.build_forensic_resource()
+    construct.build_functions()
+    construct.build_step_function()
+    assert not construct.step_function_construct.same_account
+    states = _states(_definition(construct))
+    assert {'ShareSnapshotTask', 'FinalCopySnapshot', 'FinalCheckSnapshot'} <= set(states)
+    assert 'SameAccountFinalCopy' not in states
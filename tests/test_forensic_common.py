@@ -0,0 +1,896 @@
+"""
+Unit tests for the forensic_common runtime layer
+"""
+import datetime
+import io
+import json
+import threading
+
+import boto3
+import pytest
+from botocore.awsrequest import AWSResponse
+from botocore.config import Config
+from botocore.exceptions import ClientError, EndpointConnectionError
+from botocore.response import StreamingBody
+from botocore.stub import ANY, Stubber
+
+from forensic_common import audit, batch_polling, callbacks, claim_check, clients, copy_quota, events, executions, fast_restore, instrumentation, lineage, log, malware_scan, metrics, placement, polling, regions, retention, sessions, snapshots, tagging, volume_profile, volumes
+from forensic_common.handler import forensic_handler
+
+
+def _credentials(expires_in: datetime.timedelta) -> dict:
+    return {'Credentials': {'AccessKeyId': 'AKIAEXAMPLEEXAMPLE12',
+                            'SecretAccessKey': 'secret',
+                            'SessionToken': 'token',
+                            'Expiration': datetime.datetime.now(datetime.timezone.utc) + expires_in}}
+
+
+@pytest.fixture()
+def sts():
+    client = boto3.client('sts', region_name='us-east-1')
+    with Stubber(client) as stubber:
+        yield client, stubber
+        stubber.assert_no_pending_responses()
+
+
+def test_session_cache_reuses_credentials(sts):
+    client, stubber = sts
+    stubber.add_response('assume_role', _credentials(datetime.timedelta(hours=1)),
+                         {'RoleArn': 'arn:aws:iam::111111111111:role/Member',
+                          'RoleSessionName': 'i-0123-snapshot-status-check'})
+    cache = sessions.SessionCache(sts_client=client)
+
+    first = cache.client('ec2', '111111111111', 'Member', 'us-east-1',
+                         session_name='i-0123-snapshot-status-check')
+    second = cache.client('ec2', '111111111111', 'Member', 'us-east-1')
+
+    assert first is second
+    assert cache.stats()['Hits'] == 1
+    assert cache.stats()['Misses'] == 1
+
+
+def test_session_cache_refreshes_expiring_credentials(sts):
+    client, stubber = sts
+    stubber.add_response('assume_role', _credentials(datetime.timedelta(minutes=2)))
+    stubber.add_response('assume_role', _credentials(datetime.timedelta(hours=1)))
+    cache = sessions.SessionCache(sts_client=client)
+
+    cache.credentials('111111111111', 'Member', 'us-east-1')
+    cache.credentials('111111111111', 'Member', 'us-east-1')
+
+    assert cache.stats()['Misses'] == 2
+    assert cache.stats()['Refreshes'] == 1
+
+
+def test_session_cache_keys_by_region(sts):
+    client, stubber = sts
+    stubber.add_response('assume_role', _credentials(datetime.timedelta(hours=1)))
+    stubber.add_response('assume_role', _credentials(datetime.timedelta(hours=1)))
+    cache = sessions.SessionCache(sts_client=client)
+
+    cache.credentials('111111111111', 'Member', 'us-east-1')
+    cache.credentials('111111111111', 'Member', 'us-west-2')
+
+    assert cache.stats()['Sessions'] == 2
+
+
+def test_client_registry_reuses_clients():
+    clients.clear()
+    first = clients.client('ec2', region_name='us-east-1')
+
+    assert clients.client('ec2', region_name='us-east-1') is first
+    assert clients.client('ec2', region_name='us-west-2') is not first
+    assert first.meta.config.retries['mode'] == 'adaptive'
+    assert first.meta.config.tcp_keepalive
+
+
+def test_member_clients_share_the_botocore_session(sts):
+    client, stubber = sts
+    stubber.add_response('assume_role', _credentials(datetime.timedelta(hours=1)))
+    cache = sessions.SessionCache(sts_client=client)
+
+    member = cache.client('ec2', '111111111111', 'Member', 'us-east-1')
+
+    assert member.meta.config.retries['mode'] == 'adaptive'
+    assert member._request_signer._credentials.access_key == 'AKIAEXAMPLEEXAMPLE12'
+    assert clients.botocore_session() is clients.botocore_session()
+
+
+def test_event_accessors_handle_both_event_shapes():
+    incident = {'AwsAccountId': '111111111111', 'FindingId': 'finding/abc',
+                'Resource': {'Id': 'i-0123', 'Region': 'us-east-1'}}
+    volume = {'AccountID': '111111111111', 'FindingID': 'finding/abc',
+              'InstanceID': 'i-0123', 'Region': 'us-east-1'}
+
+    for event in (incident, volume):
+        assert events.account_id(event) == '111111111111'
+        assert events.finding_id(event) == 'finding/abc'
+        assert events.instance_id(event) == 'i-0123'
+        assert events.region(event) == 'us-east-1'
+    assert events.incident_id('finding/abc') == 'abc'
+
+
+def test_volume_tag_specifications():
+    event = {'InstanceID': 'i-0123', 'SourceVolumeID': 'vol-0123', 'FindingID': 'finding/abc',
+             'SourceDeviceName': '/dev/xvda'}
+
+    spec = tagging.volume_tag_specifications('volume', 'i-0123-vol-0123', event)
+
+    assert spec[0]['ResourceType'] == 'volume'
+    assert {'Key': 'VolumeID', 'Value': 'vol-0123'} in spec[0]['Tags']
+    assert {'Key': 'Name', 'Value': 'i-0123-vol-0123'} in spec[0]['Tags']
+
+
+def test_forensic_handler_unwraps_and_reraises():
+    @forensic_handler("checkSnapshot")
+    def handler(event, context):
+        if event['State'] == 'pending':
+            raise RuntimeError("Snapshots not finished")
+        return event
+
+    assert handler({'DiskProcess': {'State': 'completed'}}, None) == {'State': 'completed'}
+    with pytest.raises(RuntimeError):
+        handler({'DiskProcess': {'State': 'pending'}}, None)
+
+
+class _Body:
+    def __init__(self, body: bytes) -> None:
+        self.body = body
+
+    def stream(self, **kwargs):
+        yield self.body
+
+
+def test_histogram_percentiles():
+    histogram = instrumentation.Histogram()
+    for latency in range(1, 101):
+        histogram.add(latency)
+
+    assert histogram.count == 100
+    assert histogram.percentile(50) == pytest.approx(50, abs=1)
+    assert 95 <= histogram.percentile(99) <= 100
+    assert histogram.percentile(100) == 100
+
+    other = instrumentation.Histogram.from_dict(histogram.to_dict())
+    other.merge(histogram)
+    assert other.count == 200
+
+
+def test_instrumentation_records_throttled_retries(capsys):
+    instrumentation.RECORDER.reset()
+    client = clients.botocore_session().create_client(
+        'ec2', region_name='us-east-1', aws_access_key_id='a', aws_secret_access_key='b',
+        config=Config(retries={'mode': 'standard', 'max_attempts': 2}))
+    responses = [
+        (503, b'<Response><Errors><Error><Code>RequestLimitExceeded</Code><Message>Slow down</Message>'
+              b'</Error></Errors><RequestID>1</RequestID></Response>'),
+        (200, b'<DescribeInstancesResponse><reservationSet/></DescribeInstancesResponse>'),
+    ]
+
+    def send(request, **kwargs):
+        status, body = responses.pop(0)
+        return AWSResponse(request.url, status, {}, _Body(body))
+    client.meta.events.register('before-send.ec2.DescribeInstances', send)
+
+    client.describe_instances()
+    instrumentation.flush('describeTest')
+
+    line = json.loads(capsys.readouterr().out.strip().splitlines()[-1])
+    stats = line['Operations']['ec2.DescribeInstances']
+    assert line['Stage'] == 'describeTest'
+    assert stats['Calls'] == 1
+    assert stats['Retries'] == 1
+    assert stats['Throttles'] == 1
+    assert instrumentation.RECORDER.operations() == {}
+
+
+def test_instrumentation_keeps_the_connection_error(capsys):
+    instrumentation.RECORDER.reset()
+    client = clients.botocore_session().create_client(
+        'ec2', region_name='us-east-1', aws_access_key_id='a', aws_secret_access_key='b',
+        config=Config(retries={'mode': 'standard', 'max_attempts': 1}))
+
+    def send(request, **kwargs):
+        raise EndpointConnectionError(endpoint_url=request.url)
+    client.meta.events.register('before-send.ec2.DescribeInstances', send)
+
+    with pytest.raises(EndpointConnectionError):
+        client.describe_instances()
+    instrumentation.flush('describeTest')
+
+    stats = json.loads(capsys.readouterr().out.strip().splitlines()[-1])['Operations']['ec2.DescribeInstances']
+    assert stats['Calls'] == 1
+    assert stats['Errors'] == {'EndpointConnectionError': 1}
+
+
+def test_metrics_document_uses_event_dimensions():
+    event = {'AccountID': '111111111111', 'FindingID': 'finding/abc', 'InstanceID': 'i-0123',
+             'Region': 'us-east-1', 'VolumeSize': 100}
+
+    doc = metrics.document({'CopyTime': (42.0, 'Seconds')}, metrics.dimensions('checkCopySnapshot', event))
+
+    directive = doc['_aws']['CloudWatchMetrics'][0]
+    assert directive['Metrics'] == [{'Name': 'CopyTime', 'Unit': 'Seconds'}]
+    assert ['Stage', 'VolumeSizeBucket'] in directive['Dimensions']
+    assert doc['VolumeSizeBucket'] == '<=128GiB'
+    assert doc['IncidentId'] == 'abc'
+    assert doc['CopyTime'] == 42.0
+
+
+def test_metrics_drop_dimension_sets_missing_from_the_event():
+    dims = metrics.dimensions('createSnapshot', {'AwsAccountId': '111111111111',
+                                                 'Resource': {'Id': 'i-0123', 'Region': 'us-east-1'}})
+
+    doc = metrics.document({'SnapshotsStarted': (2, 'Count')}, dims)
+
+    assert doc['_aws']['CloudWatchMetrics'][0]['Dimensions'] == [['Stage'], ['Stage', 'AccountId', 'Region']]
+
+
+def test_forensic_handler_emits_stage_outcome(capsys):
+    @forensic_handler("checkSnapshot")
+    def handler(event, context):
+        raise RuntimeError("Snapshots not finished")
+
+    with pytest.raises(RuntimeError):
+        handler({'DiskProcess': {'AccountID': '111111111111', 'Region': 'us-east-1'}}, None)
+
+    lines = [json.loads(line) for line in capsys.readouterr().out.splitlines() if line.startswith('{')]
+    stage = [line for line in lines if '_aws' in line][0]
+    assert stage['Outcome'] == 'Pending'
+    assert stage['StagePending'] == 1
+    assert 'StageFailed' not in stage
+
+
+def test_forensic_handler_holds_back_the_metrics_of_pending_polls(monkeypatch, capsys):
+    monkeypatch.setenv('POLL_LOG_EVERY', '3')
+    log.reset()
+
+    @forensic_handler("checkCopySnapshot")
+    def handler(event, context):
+        if event['State'] == 'pending':
+            raise RuntimeError("Snapshot copy not finished")
+        return event
+
+    volume = {'AccountID': '111111111111', 'Region': 'us-east-1', 'SourceVolumeID': 'vol-1'}
+    for _ in range(5):
+        with pytest.raises(RuntimeError):
+            handler({'DiskProcess': dict(volume, State='pending')}, None)
+    handler({'DiskProcess': dict(volume, State='completed')}, None)
+    log.reset()
+
+    lines = [json.loads(line) for line in capsys.readouterr().out.splitlines() if line.startswith('{')]
+    # The first poll, then one in every three, and the last one held back with the completion
+    assert [(line['Outcome'], line['StagePending']) for line in lines if '_aws' in line] == \
+        [('Pending', 1), ('Pending', 3), ('Completed', 1)]
+
+
+def test_logger_keeps_the_poll_counts_of_the_last_polled_keys(monkeypatch):
+    monkeypatch.setattr(log, 'MAX_POLL_KEYS', 2)
+    logger = log.Logger('checkSnapshot', stream=io.StringIO())
+    for key in ('snap-1', 'snap-2', 'snap-1', 'snap-3'):
+        logger.count(key)
+
+    assert logger.forget('snap-2') == 0
+    assert logger.forget('snap-1') == 2
+
+
+@pytest.fixture()
+def logs():
+    client = boto3.client('logs', region_name='us-east-1')
+    with Stubber(client) as stubber:
+        yield client, stubber
+        stubber.assert_no_pending_responses()
+
+
+def test_audit_logger_writes_one_batch_per_stream(logs):
+    client, stubber = logs
+    stubber.add_response('put_log_events', {}, {'logGroupName': 'Audit', 'logStreamName': 'abc',
+                                                'logEvents': ANY})
+    logger = audit.AuditLogger(logs_client=client)
+
+    logger.record({'IncidentID': 'abc', 'Step': 1}, log_group='Audit')
+    logger.record({'IncidentID': 'abc', 'Step': 2}, log_group='Audit')
+    logger.flush()
+
+    assert logger.calls == 1
+    assert logger.pending() == 0
+
+
+def test_audit_logger_creates_missing_stream(logs):
+    client, stubber = logs
+    stubber.add_client_error('put_log_events', 'ResourceNotFoundException')
+    stubber.add_response('create_log_stream', {}, {'logGroupName': 'Audit', 'logStreamName': 'abc'})
+    stubber.add_response('put_log_events', {})
+    logger = audit.AuditLogger(logs_client=client)
+
+    logger.record({'IncidentID': 'abc'}, log_group='Audit')
+    logger.flush()
+
+    assert logger.calls == 3
+
+
+def test_audit_logger_retries_with_expected_sequence_token(logs):
+    client, stubber = logs
+    stubber.add_client_error('put_log_events', 'InvalidSequenceTokenException',
+                             response_meta={}, modeled_fields={'expectedSequenceToken': '42'})
+    stubber.add_response('put_log_events', {}, {'logGroupName': 'Audit', 'logStreamName': 'abc',
+                                                'logEvents': ANY, 'sequenceToken': '42'})
+    logger = audit.AuditLogger(logs_client=client)
+
+    logger.record({'IncidentID': 'abc'}, log_group='Audit')
+    logger.flush()
+
+    assert logger.calls == 2
+
+
+@pytest.fixture()
+def s3(monkeypatch):
+    client = boto3.client('s3', region_name='us-east-1')
+    monkeypatch.setattr(clients, 'client', lambda service, region_name=None: client)
+    claim_check.clear()
+    with Stubber(client) as stubber:
+        yield client, stubber
+        stubber.assert_no_pending_responses()
+    claim_check.clear()
+
+
+def _incident() -> dict:
+    return {'AwsAccountId': '111111111111', 'FindingId': 'arn:aws:guardduty:us-east-1:111111111111:detector/d1/finding/abc123',
+            'Resource': {'Id': 'i-0123', 'Region': 'us-east-1',
+                         'Details': {'AwsEc2Instance': {'VpcId': 'vpc-1'}},
+                         'Tags': [{'Key': 'Name', 'Value': 'web'}]}}
+
+
+def test_claim_check_offloads_context_once(s3):
+    client, stubber = s3
+    stubber.add_response('put_object', {}, {'Bucket': 'evidence', 'Key': 'abc123/IncidentContext.json',
+                                            'Body': ANY})
+    event = claim_check.offload(_incident(), 'evidence')
+    claim_check.offload(event, 'evidence')
+
+    assert event['ContextRef'] == {'Bucket': 'evidence', 'Key': 'abc123/IncidentContext.json'}
+    assert 'Details' not in event['Resource'] and 'Tags' not in event['Resource']
+    assert claim_check.expand(event) == _incident()
+
+
+def test_claim_check_resolves_from_s3_once_per_container(s3):
+    client, stubber = s3
+    context = {'Details': {'AwsEc2Instance': {'VpcId': 'vpc-1'}}, 'Tags': []}
+    body = json.dumps(context).encode()
+    stubber.add_response('get_object', {'Body': StreamingBody(io.BytesIO(body), len(body))},
+                         {'Bucket': 'evidence', 'Key': 'abc123/IncidentContext.json'})
+    event = {'ContextRef': {'Bucket': 'evidence', 'Key': 'abc123/IncidentContext.json'}}
+
+    assert claim_check.resolve(event) == context
+    assert claim_check.resolve(event) == context
+
+
+def _instance() -> dict:
+    return {'InstanceId': 'i-0123', 'RootDeviceName': '/dev/xvda',
+            'BlockDeviceMappings': [
+                {'DeviceName': '/dev/xvda', 'Ebs': {'VolumeId': 'vol-root', 'Status': 'attached'}},
+                {'DeviceName': '/dev/sdf', 'Ebs': {'VolumeId': 'vol-data', 'Status': 'attached'}},
+                {'DeviceName': '/dev/sdg', 'Ebs': {'VolumeId': 'vol-swap', 'Status': 'attached'}},
+                {'DeviceName': '/dev/sdh', 'Ebs': {'VolumeId': 'vol-gone', 'Status': 'detaching'}},
+            ]}
+
+
+def _volume_ids(mappings: list) -> list:
+    return [mapping['Ebs']['VolumeId'] for mapping in mappings]
+
+
+def test_volume_filter_excludes_boot_volume_and_device_names():
+    volume_filter = volumes.VolumeFilter(exclude_boot_volume=True, exclude_device_names=('/dev/sdg',))
+
+    captured, excluded = volumes.select(None, _instance(), volume_filter)
+
+    assert _volume_ids(captured) == ['vol-data']
+    assert _volume_ids(excluded) == ['vol-root', 'vol-swap']
+
+
+def test_volume_filter_excludes_tagged_volumes(monkeypatch):
+    monkeypatch.setenv('EXCLUDE_VOLUME_TAGS', 'Scratch, Tier=cache')
+    client = boto3.client('ec2', region_name='us-east-1')
+    with Stubber(client) as stubber:
+        stubber.add_response('describe_volumes', {'Volumes': [
+            {'VolumeId': 'vol-root', 'Tags': [{'Key': 'Tier', 'Value': 'os'}]},
+            {'VolumeId': 'vol-data', 'Tags': [{'Key': 'Scratch', 'Value': 'yes'}]},
+            {'VolumeId': 'vol-swap', 'Tags': [{'Key': 'Tier', 'Value': 'cache'}]},
+        ]}, {'VolumeIds': ['vol-root', 'vol-data', 'vol-swap']})
+
+        captured, excluded = volumes.select(client, _instance(), volumes.VolumeFilter.from_environment())
+
+    assert _volume_ids(captured) == ['vol-root']
+    assert _volume_ids(excluded) == ['vol-data', 'vol-swap']
+
+
+def test_snapshots_start_instance_mode_is_serializable():
+    client = boto3.client('ec2', region_name='us-east-1')
+    started_at = datetime.datetime(2021, 6, 1, tzinfo=datetime.timezone.utc)
+    with Stubber(client) as stubber:
+        stubber.add_response('describe_instances', {'Reservations': [{'Instances': [_instance()]}]},
+                             {'InstanceIds': ['i-0123']})
+        stubber.add_response('create_snapshots', {'Snapshots': [
+            {'SnapshotId': 'snap-data', 'VolumeId': 'vol-data', 'VolumeSize': 100, 'StartTime': started_at},
+            {'SnapshotId': 'snap-swap', 'VolumeId': 'vol-swap', 'VolumeSize': 4, 'StartTime': started_at},
+        ]}, {'Description': ANY, 'TagSpecifications': ANY,
+             'InstanceSpecification': {'InstanceId': 'i-0123', 'ExcludeBootVolume': True,
+                                       'ExcludeDataVolumeIds': []}})
+
+        started = snapshots.start(client, 'i-0123', 'finding/abc', volumes.VolumeFilter(exclude_boot_volume=True),
+                                  mode='Instance')
+
+    assert json.loads(json.dumps(started)) == started
+    assert [snap['DeviceName'] for snap in started['Snapshots']] == ['/dev/sdf', '/dev/sdg']
+    assert started['ExcludedVolumes'] == [{'VolumeId': 'vol-root', 'DeviceName': '/dev/xvda'}]
+    assert started['SnapshotStartSkew'] == 0.0
+
+
+def test_snapshots_start_skew_leaves_out_the_adopted_snapshots():
+    client = boto3.client('ec2', region_name='us-east-1')
+    now = datetime.datetime.now(datetime.timezone.utc)
+    with Stubber(client) as stubber:
+        stubber.add_response('describe_instances', {'Reservations': [{'Instances': [_instance()]}]},
+                             {'InstanceIds': ['i-0123']})
+        stubber.add_response('describe_snapshots', {'Snapshots': [
+            {'SnapshotId': 'snap-scan', 'VolumeId': 'vol-data', 'VolumeSize': 100, 'State': 'completed',
+             'StartTime': now - datetime.timedelta(hours=2),
+             'Tags': [{'Key': malware_scan.SCAN_ID_TAG, 'Value': 'scan-1'}]},
+        ]})
+        stubber.add_response('create_snapshots', {'Snapshots': [
+            {'SnapshotId': 'snap-swap', 'VolumeId': 'vol-swap', 'VolumeSize': 4, 'StartTime': now},
+        ]})
+
+        started = snapshots.start(client, 'i-0123', 'finding/abc', volumes.VolumeFilter(exclude_boot_volume=True),
+                                  mode='Instance', scan_snapshot_max_age=86400)
+
+    assert [snap['SnapshotId'] for snap in started['Snapshots']] == ['snap-scan', 'snap-swap']
+    assert started['SnapshotStartSkew'] == 0.0
+    assert 7200 <= started['AdoptedSnapshotAge'] < 7260
+
+
+class _Ec2:
+    """
+    Answers CreateSnapshot from any thread, failing for one volume.
+    """
+    def create_snapshot(self, VolumeId, **kwargs):
+        if VolumeId == 'vol-data':
+            raise ClientError({'Error': {'Code': 'SnapshotCreationPerVolumeRateExceeded'}}, 'CreateSnapshot')
+        return {'SnapshotId': VolumeId.replace('vol', 'snap'), 'VolumeId': VolumeId, 'VolumeSize': 8,
+                'StartTime': datetime.datetime.now(datetime.timezone.utc)}
+
+
+def test_snapshots_isolate_volume_failures():
+    captured = volumes.attached_volumes(_instance())
+
+    started, failed = snapshots.start_volume_snapshots(_Ec2(), 'i-0123', captured, 'finding/abc', concurrency=4)
+
+    assert [snap['SnapshotId'] for snap, device_name in started] == ['snap-root', 'snap-swap']
+    assert failed == [{'SourceVolumeID': 'vol-data', 'SourceDeviceName': '/dev/sdf',
+                       'Error': 'SnapshotCreationPerVolumeRateExceeded'}]
+
+
+def test_executions_start_with_the_fast_path_snapshots_or_without(monkeypatch):
+    monkeypatch.setenv('FAST_PATH_SNAPSHOTS', 'true')
+    monkeypatch.setenv('ROLE_NAME', 'ForensicRole')
+    monkeypatch.setenv('ForensicSFNARN', 'arn:aws:states:us-east-1:111122223333:stateMachine:forensics')
+    monkeypatch.delenv('EVIDENCE_BUCKET', raising=False)
+    monkeypatch.setattr(sessions, 'member_ec2_client', lambda *args, **kwargs: None)
+    started = {'Snapshots': [{'SnapshotId': 'snap-root'}], 'FailedSnapshots': []}
+    outcomes = [started, ClientError({'Error': {'Code': 'AccessDenied'}}, 'DescribeInstances')]
+
+    def start_from_environment(ec2, instance_id, finding_id, scan_id=None):
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+    monkeypatch.setattr(snapshots, 'start_from_environment', start_from_environment)
+    sfn = boto3.client('stepfunctions', region_name='us-east-1')
+    monkeypatch.setattr(clients, 'client', lambda name, **kwargs: sfn)
+    fast, slow = ({'AwsAccountId': '111122223333', 'FindingId': 'finding/abc',
+                   'Resource': {'Id': 'i-0123', 'Region': 'us-east-1'}} for _ in range(2))
+
+    with Stubber(sfn) as stubber:
+        for arn in ('arn:fast', 'arn:slow'):
+            stubber.add_response('start_execution', {'executionArn': arn, 'startDate': datetime.datetime(2021, 6, 1)})
+        assert executions.start(fast, log.get_logger('test')) == 'arn:fast'
+        # The step function starts the snapshots when the fast path could not
+        assert executions.start(slow, log.get_logger('test')) == 'arn:slow'
+
+    assert fast[snapshots.PRE_CAPTURED] == started
+    assert snapshots.PRE_CAPTURED not in slow
+
+
+class _ParallelEc2(_Ec2):
+    """
+    Answers CreateSnapshot only once every volume has called it, so the calls have to be in flight at once.
+    """
+    def __init__(self, parties: int, timeout: float = 5):
+        self.barrier = threading.Barrier(parties, timeout=timeout)
+
+    def describe_instances(self, InstanceIds):
+        return {'Reservations': [{'Instances': [_instance()]}]}
+
+    def create_snapshot(self, VolumeId, **kwargs):
+        self.barrier.wait()
+        return super().create_snapshot(VolumeId, **kwargs)
+
+
+def test_snapshots_start_in_parallel_and_report_the_failed_volumes():
+    started = snapshots.start(_ParallelEc2(3), 'i-0123', 'finding/abc', volumes.VolumeFilter(), concurrency=4)
+
+    assert json.loads(json.dumps(started)) == started
+    assert [(snap['SnapshotId'], snap['DeviceName']) for snap in started['Snapshots']] == \
+        [('snap-root', '/dev/xvda'), ('snap-swap', '/dev/sdg')]
+    assert started['FailedSnapshots'] == [{'SourceVolumeID': 'vol-data', 'SourceDeviceName': '/dev/sdf',
+                                           'Error': 'SnapshotCreationPerVolumeRateExceeded'}]
+    # One call at a time never gets past the barrier
+    with pytest.raises(threading.BrokenBarrierError):
+        snapshots.start(_ParallelEc2(3, timeout=0.2), 'i-0123', 'finding/abc', volumes.VolumeFilter(), concurrency=1)
+
+
+def _scan_snapshot(snapshot_id: str, volume_id: str, scan_id: str, minutes_ago: int, state: str = 'completed') -> dict:
+    return {'SnapshotId': snapshot_id, 'VolumeId': volume_id, 'VolumeSize': 8, 'State': state,
+            'StartTime': datetime.datetime(2021, 6, 1, 12, tzinfo=datetime.timezone.utc)
+            - datetime.timedelta(minutes=minutes_ago),
+            'Tags': [{'Key': 'GuardDutyScanId', 'Value': scan_id}]}
+
+
+def test_malware_scan_snapshots_are_fresh_and_prefer_the_finding_scan():
+    client = boto3.client('ec2', region_name='us-east-1')
+    with Stubber(client) as stubber:
+        stubber.add_response('describe_snapshots', {'Snapshots': [
+            _scan_snapshot('snap-new', 'vol-data', 'other-scan', minutes_ago=1),
+            _scan_snapshot('snap-scan', 'vol-data', 'finding-scan', minutes_ago=10),
+            _scan_snapshot('snap-stale', 'vol-swap', 'old-scan', minutes_ago=120),
+            _scan_snapshot('snap-error', 'vol-root', 'finding-scan', minutes_ago=5, state='error'),
+        ]}, {'OwnerIds': ['self'], 'Filters': ANY})
+
+        found = malware_scan.find(client, ['vol-root', 'vol-data', 'vol-swap'], max_age=3600,
+                                  preferred_scan_id='finding-scan',
+                                  now=datetime.datetime(2021, 6, 1, 12, tzinfo=datetime.timezone.utc))
+
+    assert {volume_id: snapshot['SnapshotId'] for volume_id, snapshot in found.items()} == {'vol-data': 'snap-scan'}
+    assert malware_scan.find(client, ['vol-data'], max_age=0) == {}
+
+
+def test_callbacks_read_snapshot_ids():
+    assert callbacks.waited_snapshot_ids({'CapturedSnapshots': [{'SourceSnapshotID': 'snap-1'},
+                                                                {'SourceSnapshotID': 'snap-2'}]}) == ['snap-1', 'snap-2']
+    assert callbacks.waited_snapshot_ids({'SourceSnapshotID': 'snap-1', 'CopiedSnapshotID': 'snap-2',
+                                          'FinalCopiedSnapshotID': 'snap-3'}) == ['snap-3']
+    assert callbacks.event_snapshot_ids({'event': 'copySnapshot', 'result': 'succeeded',
+                                         'snapshot_id': 'arn:aws:ec2::us-east-1:snapshot/snap-4'}) == ['snap-4']
+    assert callbacks.event_snapshot_ids({'event': 'createSnapshots', 'snapshots': [
+        {'snapshot_id': 'arn:aws:ec2::us-east-1:snapshot/snap-5', 'status': 'completed'}]}) == ['snap-5']
+
+
+class _Context:
+    function_name = 'CheckCopySnapshot'
+
+
+def test_callbacks_forget_the_registrations_of_a_failed_capture(monkeypatch):
+    assert callbacks.forget({'CopiedSnapshotID': 'snap-2'}) == 0
+
+    monkeypatch.setenv('SNAPSHOT_WAIT_TABLE', 'waits')
+    dynamodb = boto3.client('dynamodb', region_name='us-east-1')
+    monkeypatch.setattr(clients, 'client', lambda name, **kwargs: dynamodb)
+    with Stubber(dynamodb) as stubber:
+        stubber.add_response('query', {'Items': []})
+        stubber.add_response('query', {'Items': [{'SnapshotId': {'S': 'snap-2'}, 'TokenHash': {'S': h}}
+                                                 for h in ('old', 'new')]})
+        for token_hash in ('old', 'new'):
+            stubber.add_response('delete_item', {}, {
+                'TableName': 'waits', 'Key': {'SnapshotId': {'S': 'snap-2'}, 'TokenHash': {'S': token_hash}}})
+        # Both the source snapshot and the copy of the volume are looked up
+        assert callbacks.forget({'SourceSnapshotID': 'snap-1', 'CopiedSnapshotID': 'snap-2'}) == 2
+        stubber.assert_no_pending_responses()
+
+
+def test_forensic_handler_waits_on_the_task_token(monkeypatch):
+    monkeypatch.setenv('SNAPSHOT_WAIT_TABLE', 'Waits')
+    dynamodb = boto3.client('dynamodb', region_name='us-east-1')
+    sfn = boto3.client('stepfunctions', region_name='us-east-1')
+    monkeypatch.setattr(clients, 'client', lambda service, region_name=None: {'dynamodb': dynamodb,
+                                                                             'stepfunctions': sfn}[service])
+    snapshot_state = {'State': 'pending'}
+
+    @forensic_handler("checkCopySnapshot")
+    def handler(event, context):
+        if snapshot_state['State'] == 'pending':
+            raise RuntimeError("Snapshots not finished")
+        return event
+
+    state = {'AccountID': '111122223333', 'Region': 'us-east-1', 'CopiedSnapshotID': 'snap-1'}
+    task_input = {'TaskToken': 'token', 'DiskProcess': state}
+    key = {'SnapshotId': {'S': 'snap-1'}, 'TokenHash': {'S': callbacks.token_hash('token')}}
+    with Stubber(dynamodb) as dynamodb_stubber, Stubber(sfn) as sfn_stubber:
+        dynamodb_stubber.add_response('put_item', {}, {'TableName': 'Waits', 'Item': ANY})
+        assert handler(task_input, _Context()) == {'Waiting': ['snap-1']}
+
+        snapshot_state['State'] = 'completed'
+        dynamodb_stubber.add_response('put_item', {}, {'TableName': 'Waits', 'Item': ANY})
+        dynamodb_stubber.add_response('delete_item', {}, {'TableName': 'Waits', 'Key': key})
+        sfn_stubber.add_response('send_task_success', {}, {
+            'taskToken': 'token', 'output': json.dumps({'Payload': state})})
+        assert handler(task_input, _Context()) == state
+
+        dynamodb_stubber.assert_no_pending_responses()
+        sfn_stubber.assert_no_pending_responses()
+
+
+def test_batch_polling_checks_snapshots_in_batches():
+    client = boto3.client('ec2', region_name='us-east-1')
+    snapshot_ids = ['snap-{:03d}'.format(i) for i in range(250)]
+    with Stubber(client) as stubber:
+        stubber.add_response('describe_snapshots', {'Snapshots': [
+            {'SnapshotId': 'snap-000', 'State': 'completed'},
+            {'SnapshotId': 'snap-001', 'State': 'pending'},
+        ]}, {'Filters': [{'Name': 'snapshot-id', 'Values': snapshot_ids[:200]}]})
+        stubber.add_response('describe_snapshots', {'Snapshots': [
+            {'SnapshotId': 'snap-249', 'State': 'error'},
+        ]}, {'Filters': [{'Name': 'snapshot-id', 'Values': snapshot_ids[200:]}]})
+
+        done, calls = batch_polling.finished(client, set(snapshot_ids))
+
+        stubber.assert_no_pending_responses()
+    assert done == {'snap-000', 'snap-249'}
+    assert calls == 2
+
+
+def test_lineage_base_is_the_last_usable_copy_under_the_same_key(monkeypatch):
+    monkeypatch.setenv('COPY_LINEAGE_TABLE', 'Lineage')
+    dynamodb = boto3.client('dynamodb', region_name='us-east-1')
+    ec2 = boto3.client('ec2', region_name='us-east-1')
+    monkeypatch.setattr(clients, 'client', lambda service, region_name=None: dynamodb)
+    item = {'Lineage': {'S': '111122223333#vol-1'}, 'Stage': {'S': 'Copy'}, 'SourceSnapshotId': {'S': 'snap-1'},
+            'SnapshotId': {'S': 'snap-copy'}, 'KmsKeyId': {'S': 'key'}, 'Region': {'S': 'us-east-1'}}
+    with Stubber(dynamodb) as dynamodb_stubber, Stubber(ec2) as ec2_stubber:
+        for _ in range(4):
+            dynamodb_stubber.add_response('get_item', {'Item': item})
+        ec2_stubber.add_response('describe_snapshots', {'Snapshots': [{'SnapshotId': 'snap-copy',
+                                                                       'State': 'completed'}]})
+        ec2_stubber.add_response('describe_snapshots', {'Snapshots': [{'SnapshotId': 'snap-copy', 'State': 'error'}]})
+
+        # Whatever the snapshot being copied, the last copy of the volume is the base of the next one
+        copy = lineage.base(ec2, lineage.COPY, '111122223333', 'vol-1', 'us-east-1', 'key')
+        assert (copy['SourceSnapshotId'], copy['SnapshotId']) == ('snap-1', 'snap-copy')
+        # A copy under another key, in another region or failed is no base
+        assert lineage.base(ec2, lineage.COPY, '111122223333', 'vol-1', 'us-east-1', 'other-key') is None
+        assert lineage.base(ec2, lineage.COPY, '111122223333', 'vol-1', 'us-west-2', 'key') is None
+        assert lineage.base(ec2, lineage.COPY, '111122223333', 'vol-1', 'us-east-1', 'key') is None
+        ec2_stubber.assert_no_pending_responses()
+
+
+def test_copy_quota_drops_expired_leases_then_queues(monkeypatch):
+    monkeypatch.setenv('COPY_LEASE_TABLE', 'Leases')
+    monkeypatch.setenv('COPY_CONCURRENCY_BUDGET', '2')
+    dynamodb = boto3.client('dynamodb', region_name='us-east-1')
+    with Stubber(dynamodb) as stubber:
+        stubber.add_client_error('update_item', 'ConditionalCheckFailedException')
+        stubber.add_response('get_item', {'Item': {'Leases': {'SS': ['snap-1@500', 'snap-2@2000']}}})
+        stubber.add_response('update_item', {}, {'TableName': 'Leases', 'Key': {'Destination': {'S': 'self#us-east-1'}},
+                                                 'UpdateExpression': 'DELETE Leases :expired',
+                                                 'ExpressionAttributeValues': {':expired': {'SS': ['snap-1@500']}}})
+        stubber.add_response('update_item', {})
+        assert copy_quota.acquire(dynamodb, 'self#us-east-1', 'snap-3', now=1000) == \
+            'snap-3@{}'.format(1000 + copy_quota.LEASE_SECONDS)
+
+        stubber.add_client_error('update_item', 'ConditionalCheckFailedException')
+        stubber.add_response('get_item', {'Item': {'Leases': {'SS': ['snap-2@2000', 'snap-3@22600']}}})
+        with pytest.raises(copy_quota.CopyQuotaExceeded):
+            copy_quota.acquire(dynamodb, 'self#us-east-1', 'snap-4', now=1000)
+        stubber.assert_no_pending_responses()
+
+
+def _pending_snapshot(progress: str, seconds_ago: int, volume_size: int = 100) -> dict:
+    now = datetime.datetime(2021, 6, 1, 12, tzinfo=datetime.timezone.utc)
+    return {'SnapshotId': 'snap-1', 'State': 'pending', 'Progress': progress, 'VolumeSize': volume_size,
+            'StartTime': now - datetime.timedelta(seconds=seconds_ago)}
+
+
+def test_copy_quota_releases_the_leases_of_a_failed_capture(monkeypatch):
+    monkeypatch.setenv('COPY_LEASE_TABLE', 'leases')
+    monkeypatch.setenv('COPY_LEASE_SECONDS', '3600')
+    monkeypatch.setenv('AWS_REGION', 'us-east-1')
+    dynamodb = boto3.client('dynamodb', region_name='us-east-1')
+    monkeypatch.setattr(clients, 'client', lambda name, **kwargs: dynamodb)
+    state = {'AccountID': '111122223333', 'Region': 'eu-west-1', 'CopyRegion': 'us-east-1',
+             'CopyLease': 'snap-1@100', 'FinalCopyLease': 'snap-2@100'}
+
+    assert copy_quota.lease_seconds() == 3600
+    with Stubber(dynamodb) as stubber:
+        for dest, lease in (('111122223333#us-east-1#eu-west-1', 'snap-1@100'), ('self#us-east-1', 'snap-2@100')):
+            stubber.add_response('update_item', {}, {
+                'TableName': 'leases', 'Key': {'Destination': {'S': dest}},
+                'UpdateExpression': 'DELETE Leases :lease',
+                'ExpressionAttributeValues': {':lease': {'SS': [lease]}}})
+        assert copy_quota.release_held(state) == ['snap-1@100', 'snap-2@100']
+        assert copy_quota.release_held(state) == []
+        stubber.assert_no_pending_responses()
+
+
+def test_polling_estimates_the_next_poll_from_progress():
+    now = datetime.datetime(2021, 6, 1, 12, tzinfo=datetime.timezone.utc)
+
+    # 90% in 90 seconds leaves about 10 seconds
+    assert polling.next_poll_seconds([_pending_snapshot('90%', 90)], now=now) == 10
+    # Nearly done, or large and slow, stays within the bounds
+    assert polling.next_poll_seconds([_pending_snapshot('99%', 100)], now=now) == polling.MIN_POLL_SECONDS
+    assert polling.next_poll_seconds([_pending_snapshot('1%', 60)], now=now) == polling.MAX_POLL_SECONDS
+    # Without progress yet the volume size is used
+    assert polling.next_poll_seconds([_pending_snapshot('', 0, volume_size=8)], now=now) == 48
+    # The slowest snapshot decides
+    assert polling.next_poll_seconds([_pending_snapshot('90%', 90), _pending_snapshot('50%', 60)], now=now) == 60
+
+
+def test_regions_copy_into_the_forensic_region(monkeypatch):
+    monkeypatch.setenv('FORENSIC_REGION', 'us-east-1')
+    monkeypatch.setenv('CROSS_REGION_SECONDS_PER_GIB', '{"ap-southeast-2": 30, "*": 20}')
+    monkeypatch.setenv('REGIONAL_COPY_BUDGETS', '{"eu-west-1": 3}')
+    monkeypatch.setenv('COPY_CONCURRENCY_BUDGET', '10')
+
+    assert regions.copy_region('eu-west-1') == 'us-east-1'
+    assert regions.transfer_seconds(100, 'ap-southeast-2', 'us-east-1') == 3000
+    assert regions.transfer_seconds(100, 'eu-west-1', 'us-east-1') == 2000
+    assert regions.transfer_seconds(100, 'us-east-1', 'us-east-1') == 100 * polling.DEFAULT_SECONDS_PER_GIB
+    assert copy_quota.destination('111122223333', 'us-east-1', 'eu-west-1') == '111122223333#us-east-1#eu-west-1'
+    assert copy_quota.budget('eu-west-1') == 3
+    assert copy_quota.budget('us-west-2') == 10
+    assert callbacks.waited_location({'AccountID': '111122223333', 'Region': 'eu-west-1',
+                                      'CopiedSnapshotID': 'snap-1', 'CopyRegion': 'us-east-1'}) == \
+        ('111122223333', 'us-east-1')
+
+
+def test_retention_keeps_what_the_policy_requires(monkeypatch):
+    monkeypatch.setenv('AWS_REGION', 'us-east-1')
+    monkeypatch.setenv('RETENTION_DAYS', '7')
+    now = datetime.datetime(2021, 6, 10, tzinfo=datetime.timezone.utc)
+    finding = 'arn:aws:guardduty:us-east-1:111122223333:detector/d/finding/f1'
+    tags = [{'Key': 'FindingID', 'Value': finding}]
+
+    assert retention.capture_of_key('f1/disk_evidence/vol-1.collection.log') == ('f1', 'vol-1')
+    assert retention.capture_of_key('f1/disk_evidence/vol-1.image.dd') is None
+    state = {'AccountID': '111122223333', 'Region': 'us-east-1', 'SourceSnapshotID': 'snap-src',
+             'CopiedSnapshotID': 'snap-copy', 'FinalCopiedSnapshotID': 'snap-final', 'ForensicVolumeID': 'vol-f'}
+    source, copy, final, volume = retention.candidates(state)
+    assert (final['Role'], final['AccountId']) == ('FinalCopy', callbacks.SELF_ACCOUNT)
+    copies = {lineage.COPY: {'SourceSnapshotId': 'snap-src', 'SnapshotId': 'snap-copy'},
+              lineage.FINAL_COPY: {'SourceSnapshotId': 'snap-copy', 'SnapshotId': 'snap-final'}}
+    monkeypatch.setattr(lineage, 'previous', lambda stage, account_id, volume_id: copies[stage])
+    assert retention.lineage_ids(dict(state, SourceVolumeID='vol-1')) == {'snap-src', 'snap-copy', 'snap-final'}
+
+    old = {'Tags': tags, 'StartTime': now - datetime.timedelta(days=8), 'State': 'completed'}
+    recent = dict(old, StartTime=now - datetime.timedelta(days=1))
+    assert retention.decide(source, None, finding, True, set(), now)[0] == 'gone'
+    assert retention.decide(source, dict(old, Tags=[]), finding, True, set(), now)[0] == 'keep'
+    assert retention.decide(source, old, finding, False, set(), now)[0] == 'keep'
+    assert retention.decide(copy, old, finding, True, {'snap-copy'}, now)[0] == 'keep'
+    assert retention.decide(source, old, finding, True, {'snap-src', 'snap-copy'}, now)[0] == 'keep'
+    assert retention.decide(source, old, finding, True, {'snap-copy'}, now)[0] == 'delete'
+    assert retention.decide(final, recent, finding, True, set(), now)[0] == 'keep'
+    assert retention.decide(final, old, finding, True, set(), now)[0] == 'delete'
+    assert retention.decide(volume, dict(old, State='in-use'), finding, True, set(), now)[0] == 'keep'
+    assert retention.decide(volume, dict(old, State='available'), finding, True, set(), now)[0] == 'delete'
+
+
+def test_retention_sweeps_by_finding_and_instance_tags():
+    finding = 'arn:aws:guardduty:us-east-1:111122223333:detector/d/finding/f1'
+    tags = [{'Key': 'FindingID', 'Value': finding}, {'Key': 'InstanceID', 'Value': 'i-0123'}]
+    tagged = [{'Name': 'tag-key', 'Values': ['FindingID']}, {'Name': 'tag-key', 'Values': ['InstanceID']}]
+    ec2 = boto3.client('ec2', region_name='us-east-1')
+    with Stubber(ec2) as stubber:
+        stubber.add_response('describe_snapshots', {'Snapshots': [
+            {'SnapshotId': 'snap-final', 'VolumeId': 'vol-ffffffff',
+             'Tags': tags + [{'Key': 'VolumeID', 'Value': 'vol-1'}]},
+            # Started by CreateSnapshots, tagged per instance only
+            {'SnapshotId': 'snap-src', 'VolumeId': 'vol-2', 'Tags': tags},
+        ]}, {'OwnerIds': ['self'], 'Filters': tagged})
+        stubber.add_response('describe_volumes', {'Volumes': [
+            {'VolumeId': 'vol-f', 'Tags': tags + [{'Key': 'VolumeID', 'Value': 'vol-1'}]},
+            {'VolumeId': 'vol-g', 'Tags': tags},
+        ]}, {'Filters': tagged})
+
+        assert retention.swept_captures(ec2) == {('f1', 'vol-1'), ('f1', 'vol-2')}
+
+
+def test_volume_profile_sizes_throughput_within_the_cost_ceiling(monkeypatch):
+    monkeypatch.setenv('TARGET_IMAGING_MIBPS', '500')
+    profile = volume_profile.select(100)
+    assert (profile['VolumeType'], profile['Throughput'], profile['Iops']) == ('gp3', 500, 3000)
+    assert profile['ImagingSeconds'] == 205
+    assert volume_profile.create_volume_parameters(profile) == {'VolumeType': 'gp3', 'Iops': 3000, 'Throughput': 500}
+
+    monkeypatch.setenv('TARGET_IMAGING_MIBPS', '2000')
+    profile = volume_profile.select(8192)
+    assert (profile['VolumeType'], profile['Throughput']) == ('io2', 2000)
+    assert 'Throughput' not in volume_profile.create_volume_parameters(profile)
+
+    # io2 over the ceiling falls back to gp3, whose throughput is lowered until it fits
+    monkeypatch.setenv('MAX_VOLUME_MONTHLY_COST', '680')
+    profile = volume_profile.select(8192)
+    assert profile['VolumeType'] == 'gp3' and profile['CostCapped']
+    assert profile['MonthlyCost'] <= 680 < volume_profile.gp3(8192, profile['Throughput'] + 5)['MonthlyCost']
+    # Storage alone over the ceiling keeps the baseline
+    monkeypatch.setenv('MAX_VOLUME_MONTHLY_COST', '1')
+    assert volume_profile.select(100)['Throughput'] == volume_profile.GP3_BASELINE_THROUGHPUT
+
+
+def test_fast_restore_is_enabled_above_the_size_threshold(monkeypatch):
+    assert not fast_restore.applies(2000)
+    monkeypatch.setenv('FAST_RESTORE_MIN_GIB', '500')
+    assert not fast_restore.applies(100)
+    assert fast_restore.applies(500)
+    # About an hour per TiB, so the default wait of an hour fits a TiB and no more
+    assert fast_restore.expected_enable_seconds(1024) == 3600
+    assert fast_restore.applies(1024)
+    assert fast_restore.wanted(2000) and not fast_restore.applies(2000)
+    assert fast_restore.skip(2000) == {'State': fast_restore.SKIPPED,
+                                       'Reason': "Expected to take 7032 seconds, over the wait of 3600"}
+    monkeypatch.setenv('FAST_RESTORE_MAX_WAIT_SECONDS', '7200')
+    assert fast_restore.applies(2000)
+
+    now = datetime.datetime(2021, 6, 1, 12, tzinfo=datetime.timezone.utc)
+    ec2 = boto3.client('ec2', region_name='us-east-1')
+    with Stubber(ec2) as stubber:
+        stubber.add_response('enable_fast_snapshot_restores', {'Successful': [{'SnapshotId': 'snap-1'}]},
+                             {'AvailabilityZones': ['us-east-1a'], 'SourceSnapshotIds': ['snap-1']})
+        stubber.add_response('enable_fast_snapshot_restores', {'Unsuccessful': [{
+            'SnapshotId': 'snap-2', 'FastSnapshotRestoreStateErrors': [{
+                'AvailabilityZone': 'us-east-1a', 'Error': {'Code': 'x', 'Message': 'limit exceeded'}}]}]})
+        stubber.add_response('disable_fast_snapshot_restores', {},
+                             {'AvailabilityZones': ['us-east-1a'], 'SourceSnapshotIds': ['snap-1']})
+        enabled = fast_restore.enable(ec2, 'snap-1', 'us-east-1a', now)
+        skipped = fast_restore.enable(ec2, 'snap-2', 'us-east-1a', now)
+        assert enabled['State'] == fast_restore.ENABLING
+        assert (skipped['State'], skipped['Reason']) == (fast_restore.SKIPPED, 'limit exceeded')
+        assert fast_restore.waited_seconds(enabled, now + datetime.timedelta(seconds=90)) == 90
+        # Only what was enabled gets disabled
+        assert fast_restore.disable(ec2, 'snap-2', skipped) == skipped
+        assert fast_restore.disable(ec2, 'snap-1', enabled)['State'] == fast_restore.DISABLED
+
+
+def test_placement_picks_the_zone_with_capacity_and_the_fewest_captures(monkeypatch):
+    monkeypatch.setenv('SUPPORTED_AZS', '["us-east-1a", "us-east-1b", "us-east-1c", "us-east-1d"]')
+    monkeypatch.setenv('SUBNET_TOPOLOGY', '[{"SubnetId": "subnet-a"}, {"SubnetId": "subnet-b1"}, '
+                                          '{"SubnetId": "subnet-b2"}, {"SubnetId": "subnet-c"}, {"SubnetId": "subnet-d"}]')
+    monkeypatch.setenv('INSTANCE_TYPE', 'm5a.large')
+    placement.clear()
+
+    ec2 = boto3.client('ec2', region_name='us-east-1')
+    running = {'Reservations': [{'Instances': [{'Placement': {'AvailabilityZone': zone}} for zone in zones]}
+                                for zones in (['us-east-1a'], ['us-east-1b', 'us-east-1b'])]}
+    with Stubber(ec2) as stubber:
+        stubber.add_response('describe_subnets', {'Subnets': [
+            {'SubnetId': subnet_id, 'AvailabilityZone': zone, 'AvailableIpAddressCount': free}
+            for subnet_id, zone, free in (('subnet-a', 'us-east-1a', 10), ('subnet-b1', 'us-east-1b', 5),
+                                          ('subnet-b2', 'us-east-1b', 50), ('subnet-c', 'us-east-1c', 0),
+                                          ('subnet-d', 'us-east-1d', 10))]},
+            {'SubnetIds': ['subnet-a', 'subnet-b1', 'subnet-b2', 'subnet-c', 'subnet-d']})
+        stubber.add_response('describe_instance_type_offerings', {'InstanceTypeOfferings': [
+            {'Location': zone} for zone in ('us-east-1a', 'us-east-1b', 'us-east-1c')]})
+        stubber.add_response('describe_instances', running)
+        stubber.add_response('describe_instances', running)
+        stubber.add_response('describe_instances', running)
+
+        # us-east-1c has no free IP address and us-east-1d does not offer the instance type
+        assert placement.choose_zone(ec2) == 'us-east-1a'
+        placement.mark_constrained('us-east-1a')
+        assert placement.choose_zone(ec2) == 'us-east-1b'
+        # A zone out of capacity is still picked when it is the only one left
+        assert placement.choose_zone(ec2, exclude=['us-east-1b']) == 'us-east-1a'
+        # The subnets come from the cache
+        assert placement.choose_subnet(ec2, 'us-east-1b') == 'subnet-b2'
+        stubber.assert_no_pending_responses()
+    placement.clear()
+
+
+def test_polling_returns_pending_state_when_adaptive(monkeypatch):
+    with pytest.raises(RuntimeError):
+        polling.pending({}, [_pending_snapshot('50%', 60)])
+
+    monkeypatch.setenv('ADAPTIVE_POLLING', 'true')
+    state = polling.pending({'VolumeSize': 8}, [_pending_snapshot('50%', 60)])
+    assert state['SnapshotStatus'] == 'pending'
+    assert polling.MIN_POLL_SECONDS <= state['NextPollSeconds'] <= polling.MAX_POLL_SECONDS
+    assert polling.completed(state) == {'VolumeSize': 8, 'SnapshotStatus': 'completed'}
@@ -18,6 +18,7 @@ from moto import mock_cloudwatch, mock_logs, mock_ec2, mock_s3, mock_stepfunctio
 from src.forensic_auto_capture.auto_forensics import AutoForensicsConstruct
 from src.forensic_auto_capture.disk_functions.assets.mount_volume.lambda_function import lambda_handler as mount_volume_handler
 from src.forensic_auto_capture.invoke.assets.disk_invoke_guardduty import buildEvent as invoke_guardduty_buildevent
+from src.forensic_auto_capture.disk_functions.assets import stage_dispatcher
 StackEnvironment = collections.namedtuple('StackEnvironment', ['stack', 'vpc'])
 
 @pytest.fixture(scope="session")
@@ -113,4 +114,16 @@ def test_invoke_guardduty(monkeypatch):
     )["stateMachineArn"]
     monkeypatch.setenv("ForensicSFNARN", state_machine_arn)
     input_json = json.loads((pathlib.Path(__file__).parents[0] / 'assets/guardduty_cc.json').read_text())
-    invoke_guardduty_buildevent(event=input_json)
\ No newline at end of file
+    invoke_guardduty_buildevent(event=input_json)
+
+
+def test_stage_dispatcher_routes_on_stage(monkeypatch):
+    # Lambda puts the root of the dispatcher's asset on the path
+    monkeypatch.syspath_prepend(str(pathlib.Path(__file__).parents[1] / 'src/forensic_auto_capture/disk_functions/assets'))
+
+    handler = stage_dispatcher.get_handler("FinalCheckSnapshot")
+
+    assert handler.__module__ == "final_check_snapshot.lambda_function"
+    assert stage_dispatcher.get_handler("FinalCheckSnapshot") is handler
+    with pytest.raises(ValueError):
+        stage_dispatcher.get_handler("Unknown")
@@ -0,0 +1,136 @@
+"""
+Bytes logged by the Lambda handlers for one simulated capture.
+
+The capture runs every stage of the step function against canned AWS responses, with the
+snapshots pending for POLLS checks and the forensic instance not ready for a few checks
+of MountVolume.  LOG_LEVEL=DEBUG with POLL_LOG_EVERY=1 logs every poll, every event and
+every API response in full, as the handlers did with print before, and is compared with
+the default INFO level.  Every line reaches CloudWatch Logs, so the metric lines (EMF and
+API call latency) are counted too.  The handlers printed none before, and the check stages
+emit them on one pending poll in every POLL_LOG_EVERY.
+"""
+import importlib
+import importlib.util
+import json
+import pathlib
+
+import botocore.client
+import pytest
+
+from forensic_common import audit, clients, instrumentation, log, placement, sessions
+
+ROOT = pathlib.Path(__file__).parents[1]
+
+# Number of times each snapshot is found pending before it completes
+POLLS = 20
+# Number of times the forensic instance is found not ready
+INSTANCE_POLLS = 3
+
+
+def _load_fixtures():
+    spec = importlib.util.spec_from_file_location('benchmark_fixtures', ROOT / 'benchmarks/fixtures.py')
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+fixtures = _load_fixtures()
+
+
+class _FakeAws:
+    def __init__(self) -> None:
+        self.polls = {}
+
+    def _polled(self, key) -> int:
+        self.polls[key] = self.polls.get(key, 0) + 1
+        return self.polls[key]
+
+    def __call__(self, client, operation_name, api_params):
+        response = fixtures.response(operation_name)
+        if operation_name == 'DescribeSnapshots':
+            ids = api_params['SnapshotIds']
+            state = 'pending' if self._polled(tuple(ids)) <= POLLS else 'completed'
+            response['Snapshots'] = [{'SnapshotId': snapshot_id, 'State': state, 'Progress': '50%',
+                                      'VolumeSize': 8, 'StartTime': fixtures.RESPONSES['CreateSnapshot']['StartTime']}
+                                     for snapshot_id in ids]
+        elif operation_name == 'GetLogEvents':
+            if self._polled(api_params['logStreamName']) <= INSTANCE_POLLS:
+                response['events'] = [{'timestamp': 0, 'message': 'incron stopped'}]
+        return response
+
+
+def _handler(module: str):
+    return importlib.import_module(module).lambda_handler
+
+
+def _until_done(handler, state: dict) -> dict:
+    while True:
+        try:
+            return handler({'DiskProcess': state}, None)
+        except RuntimeError:
+            pass
+
+
+def _is_metric(line: str) -> bool:
+    if not line.startswith('{'):
+        return False
+    record = json.loads(line)
+    return '_aws' in record or record.get('Type') == instrumentation.LOG_TYPE
+
+
+def _capture() -> None:
+    state = _handler('create_snapshot.lambda_function')(fixtures.stage_event('CreateSnapshot'), None)
+    state = _until_done(_handler('check_snapshot.lambda_function'), state)
+    for volume in state['CapturedSnapshots']:
+        volume = _handler('copy_snapshot.lambda_function')({'DiskProcess': volume}, None)
+        volume = _until_done(_handler('check_copy_snapshot.lambda_function'), volume)
+        volume = _handler('share_snapshot.lambda_function')({'DiskProcess': volume}, None)
+        volume = _handler('final_copy_snapshot.lambda_function')({'DiskProcess': volume}, None)
+        volume = _until_done(_handler('final_check_snapshot.lambda_function'), volume)
+        volume = _handler('create_volume.lambda_function')({'DiskProcess': volume}, None)
+        volume = _handler('run_instances.lambda_function')({'DiskProcess': volume}, None)
+        _until_done(_handler('mount_volume.lambda_function'), volume)
+
+
+@pytest.fixture()
+def simulated_capture(monkeypatch, capsys):
+    for name, value in fixtures.ENVIRONMENT.items():
+        monkeypatch.setenv(name, value)
+    monkeypatch.syspath_prepend(str(fixtures.ASSETS_PATH))
+
+    def run(**environment) -> dict:
+        for name, value in environment.items():
+            monkeypatch.setenv(name, value)
+        fake_aws = _FakeAws()
+        monkeypatch.setattr(botocore.client.BaseClient, '_make_api_call',
+                            lambda client, operation_name, api_params: fake_aws(client, operation_name, api_params))
+        clients.clear()
+        placement.clear()
+        sessions.CACHE.clear()
+        audit.LOGGER = audit.AuditLogger()
+        log.reset()
+        capsys.readouterr()
+        _capture()
+        lines = capsys.readouterr().out.splitlines()
+        logs = sum(len(line.encode('utf-8')) + 1 for line in lines if not _is_metric(line))
+        metrics = sum(len(line.encode('utf-8')) + 1 for line in lines if _is_metric(line))
+        return {'Logs': logs, 'Metrics': metrics, 'Total': logs + metrics}
+
+    yield run
+    log.reset()
+
+
+def test_bytes_logged_per_capture(simulated_capture, capsys, record_property):
+    verbose = simulated_capture(LOG_LEVEL='DEBUG', POLL_LOG_EVERY='1')
+    default = simulated_capture(LOG_LEVEL='INFO', POLL_LOG_EVERY='10')
+
+    record_property('verbose_log_bytes_per_capture', verbose['Total'])
+    record_property('default_log_bytes_per_capture', default['Total'])
+    with capsys.disabled():
+        print("\nLog bytes per simulated capture: {} with full dumps and metrics on every poll, {} by default, "
+              "of which metric lines: {} and {}".format(verbose['Total'], default['Total'], verbose['Metrics'],
+                                                         default['Metrics']))
+    assert default['Logs'] < verbose['Logs'] / 4
+    assert default['Metrics'] < verbose['Metrics'] / 2
+    # Less than the handlers printed before, without any metric line
+    assert default['Total'] < verbose['Logs'] * 0.75